@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark writing, submitting and parsing qtools scripts at scale
+
+For every number of commands and every mode, this measures how long
+``qtools.Submitter`` takes to write the scripts, its peak memory, how many
+files it writes, how long ``qtools.parser.commands_from_sh`` takes to read
+them back and, with ``--submit``, how long submitting them to the stand-in
+scheduler of ``qtools.fakeq`` takes. The results are written as JSON, and
+comparing them to the results of an earlier release with ``--compare``
+flags any measurement that got slower.
+
+Modes
+-----
+serial
+    All the commands in one script, run one after the other
+array
+    An array job, split into several scripts of MAX_ARRAY_JOBS commands
+    when there are more
+manifest
+    An array job reading its commands from a shared manifest
+chunksize
+    Serial scripts of ``--chunks`` equal subsets of the commands
+
+Example
+-------
+    python benchmarks/bench_submitter.py --sizes 100 10000 --submit \\
+        --output bench.json
+    python benchmarks/bench_submitter.py --compare bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import qtools
+from qtools import fakeq
+from qtools.parser import commands_from_sh
+
+MODES = ('serial', 'array', 'manifest', 'chunksize')
+
+SIZES = (10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6)
+
+# Measurements compared between runs, all of which are better when smaller
+COMPARED = ('write_seconds', 'peak_memory_bytes', 'parse_seconds',
+            'submit_seconds')
+
+
+def generate_commands(n):
+    """Commands like those of a real batch, made on the fly"""
+    for i in range(n):
+        yield ('bedtools intersect -a /projects/ps-yeolab/shards/'
+               'sample_{0:07d}.bed -b exons.bed > /projects/ps-yeolab/out/'
+               'sample_{0:07d}.bed'.format(i))
+
+
+def submitter_kwargs(mode, n, chunks):
+    if mode == 'serial':
+        return dict(array=False)
+    elif mode == 'array':
+        return dict(array=True)
+    elif mode == 'manifest':
+        return dict(array=True, manifest=True)
+    elif mode == 'chunksize':
+        return dict(array=False, chunksize=max(1, -(-n // chunks)))
+    raise ValueError('Unknown mode {!r}'.format(mode))
+
+
+def folder_size(folder):
+    """Number of files and total bytes in a folder"""
+    n_files = 0
+    n_bytes = 0
+    for entry in os.scandir(folder):
+        if entry.is_file():
+            n_files += 1
+            n_bytes += entry.stat().st_size
+    return n_files, n_bytes
+
+
+def benchmark(mode, n, chunks, submit, dispatch_threads):
+    """Measure one mode for one number of commands, in the current folder"""
+    kwargs = submitter_kwargs(mode, n, chunks)
+
+    # tracemalloc slows down allocating several times over, so the peak
+    # memory is measured in a run of its own, which isn't timed
+    os.mkdir('memory')
+    os.chdir('memory')
+    try:
+        tracemalloc.start()
+        qtools.Submitter(generate_commands(n), 'bench', submit=False,
+                         **kwargs)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        os.chdir(os.pardir)
+        shutil.rmtree('memory')
+
+    start = time.time()
+    sub = qtools.Submitter(generate_commands(n), 'bench', submit=False,
+                           dispatch_threads=dispatch_threads, **kwargs)
+    write_seconds = time.time() - start
+
+    n_files, n_bytes = folder_size('.')
+
+    start = time.time()
+    for sh_filename in sub.sh_filenames:
+        commands_from_sh(sh_filename)
+    parse_seconds = time.time() - start
+
+    result = dict(mode=mode, n_commands=n, n_scripts=len(sub.sh_filenames),
+                  n_files=n_files, n_bytes=n_bytes,
+                  write_seconds=write_seconds,
+                  peak_memory_bytes=peak_memory,
+                  parse_seconds=parse_seconds)
+
+    if submit:
+        start = time.time()
+        job_ids = sub._dispatch(sub.sh_filenames)
+        result['submit_seconds'] = time.time() - start
+        scheduler = fakeq.FakeScheduler()
+        for job_id in job_ids:
+            scheduler.delete(job_id)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Print the measurements that got slower than the baseline
+
+    Returns
+    -------
+    n_regressions : int
+        Number of measurements more than ``tolerance`` times the baseline
+    """
+    previous = dict(((r['mode'], r['n_commands']), r)
+                    for r in baseline['results'])
+    n_regressions = 0
+    for result in results:
+        before = previous.get((result['mode'], result['n_commands']))
+        if before is None:
+            continue
+        for measurement in COMPARED:
+            if not before.get(measurement) or measurement not in result:
+                continue
+            ratio = result[measurement] / before[measurement]
+            if ratio > tolerance:
+                n_regressions += 1
+                sys.stdout.write(
+                    'REGRESSION {mode} n={n_commands} {measurement}: '
+                    '{before:.4g} -> {after:.4g} ({ratio:.2f}x)\n'.format(
+                        measurement=measurement, before=before[measurement],
+                        after=result[measurement], ratio=ratio, **result))
+    return n_regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='Numbers of commands (default: %(default)s)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--chunks', type=int, default=10,
+                        help='Number of scripts of the chunksize mode')
+    parser.add_argument('--submit', action='store_true',
+                        help='Also time submitting the scripts to the fake '
+                             'scheduler of qtools.fakeq')
+    parser.add_argument('--submit-latency', type=float, default=0,
+                        help='Seconds each fake qsub takes to answer')
+    parser.add_argument('--dispatch-threads', type=int, default=None)
+    parser.add_argument('--output', default='bench_submitter.json',
+                        help='JSON file of the results')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='JSON results of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='Flag measurements more than this many times '
+                             'the baseline')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='qtools-bench-')
+    cwd = os.getcwd()
+    output = os.path.abspath(args.output)
+    if args.submit:
+        # Jobs never run, so only submission is measured, without
+        # starting a runner process per script
+        bin_dir = fakeq.install(os.path.join(workdir, 'bin'),
+                                submit_latency=args.submit_latency,
+                                run_jobs=False)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ.update(fakeq.FakeScheduler(
+            os.path.join(bin_dir, 'state')).environment)
+
+    # Keep the progress messages of Submitter out of the way
+    stderr = sys.stderr
+    results = []
+    try:
+        for n in args.sizes:
+            for mode in args.modes:
+                folder = os.path.join(workdir, '{}-{}'.format(mode, n))
+                os.makedirs(folder)
+                os.chdir(folder)
+                sys.stderr = open(os.devnull, 'w')
+                try:
+                    result = benchmark(mode, n, args.chunks, args.submit,
+                                       args.dispatch_threads)
+                finally:
+                    sys.stderr.close()
+                    sys.stderr = stderr
+                    os.chdir(cwd)
+                    shutil.rmtree(folder)
+                results.append(result)
+                sys.stdout.write(
+                    '{mode:>10} n={n_commands:<8} scripts={n_scripts:<5} '
+                    'files={n_files:<5} write={write_seconds:.3f}s '
+                    'peak={peak_memory_bytes:,}B '
+                    'parse={parse_seconds:.3f}s'.format(**result))
+                if 'submit_seconds' in result:
+                    sys.stdout.write(
+                        ' submit={submit_seconds:.3f}s'.format(**result))
+                sys.stdout.write('\n')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = dict(qtools_version=qtools.__version__,
+                  python_version=platform.python_version(),
+                  platform=platform.platform(),
+                  time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  results=results)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        n_regressions = compare(results, baseline, args.tolerance)
+    else:
+        n_regressions = 0
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    sys.stdout.write('Wrote results to {}\n'.format(output))
+    return 1 if n_regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 
 from .submitter import Submitter
+from .executor import ClusterExecutor
 
 __author__ = 'Olga Botvinnik'
 __email__ = 'olga.botvinnik@gmail.com'
 __version__ = '0.1.2a'
 
-__all__ = ['Submitter']
+__all__ = ['Submitter', 'ClusterExecutor']
@@ -0,0 +1,929 @@
+# -*- coding: utf-8 -*-
+"""Job schedulers that qtools can write scripts for and submit to"""
+
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+import functools
+import getpass
+import itertools
+import os
+import re
+import subprocess
+import tempfile
+import threading
+from xml.etree import ElementTree
+
+import six
+
+__author__ = 'Olga Botvinnik'
+
+# States of jobs and tasks, the same for every scheduler
+QUEUED = 'queued'
+HELD = 'held'
+RUNNING = 'running'
+COMPLETED = 'completed'
+
+#: State of a job, or of one task of an array job (task_id is None for the
+#: whole job), as reported by the scheduler. exit_status is None unless the
+#: scheduler reports it.
+TaskStatus = namedtuple('TaskStatus',
+                        ['job_id', 'task_id', 'state', 'exit_status'])
+
+
+class QueryError(Exception):
+    """The status command of the scheduler failed, e.g. because it couldn't
+    reach the server, so the jobs it didn't report may still be queued
+
+    Attributes
+    ----------
+    statuses : list of TaskStatus
+        States of the jobs it did report
+    unknown : list of str
+        IDs of the jobs it said it doesn't know, which have left the queue
+    """
+
+    def __init__(self, message, statuses=(), unknown=()):
+        super(QueryError, self).__init__(message)
+        self.statuses = list(statuses)
+        self.unknown = list(unknown)
+
+
+def parse_array_spec(spec):
+    """Get the task indices and the throttle out of a PBS -t option
+
+    Parameters
+    ----------
+    spec : str
+        Ranges and single indices separated by commas, optionally followed
+        by "%" and the maximum number of tasks to run at once, e.g.
+        "1-500%20" or "3,7,19-21"
+
+    Returns
+    -------
+    tasks : list of int
+        Indices of the tasks, in order
+    max_running : int or None
+        Maximum number of tasks to run at once
+    """
+    spec, _, max_running = spec.partition('%')
+    tasks = []
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        tasks.extend(range(int(first), int(last or first) + 1))
+    return tasks, int(max_running) if max_running else None
+
+
+class Backend(object):
+    """How to write and submit a job script for one kind of scheduler
+
+    Subclass this and register an instance with ``register_backend`` to
+    teach qtools about a new scheduler. The instance's ``name`` is then a
+    valid ``queue_type`` for ``qtools.Submitter``.
+    """
+    #: Name of the queue type, e.g. "PBS"
+    name = None
+
+    #: Start of every scheduler directive in the script, e.g. "#PBS"
+    directive_prefix = None
+
+    #: Environment variable holding the index of an array task
+    array_task_id = None
+
+    #: Resources that every job gets, as (keyword, value) pairs
+    default_resources = ()
+
+    #: Maximum number of processors per node, or None for no limit
+    max_ppn = None
+
+    #: Lines run before the commands, e.g. to change directory
+    preamble = ()
+
+    #: Whether the scheduler can hold each task of an array job until the
+    #: same task of other array jobs has finished. Without it,
+    #: qtools.Submitter has each task wait for the sentinel files of those
+    #: tasks instead.
+    elementwise_dependencies = False
+
+    #: Starts of the options of array jobs, e.g. "-t "
+    array_option_prefixes = ()
+
+    #: Starts of the options holding the job for other jobs, e.g.
+    #: "-W depend="
+    dependency_option_prefixes = ()
+
+    #: Starts of the options naming the stdout and stderr files, e.g. "-o "
+    output_option_prefixes = ()
+
+    #: Start of the option naming the job
+    job_name_option_prefix = '-N '
+
+    def directive(self, *words):
+        """A single scheduler directive line of the script"""
+        return ' '.join((self.directive_prefix,) + tuple(
+            str(word) for word in words))
+
+    def job_options(self, submitter, job_name, out_filename, err_filename):
+        """Options naming the job, its output files and its resources
+
+        Returns
+        -------
+        options : list of str
+            Each option becomes one directive line
+        """
+        raise NotImplementedError
+
+    def array_options(self, n_tasks, max_running=None):
+        """Options making the job an array of tasks 1 to n_tasks
+
+        Returns
+        -------
+        options : list of str
+            Each option becomes one directive line
+        """
+        raise NotImplementedError
+
+    def sparse_array_options(self, tasks, max_running=None):
+        """Options making the job an array of only some task indices
+
+        Returns
+        -------
+        options : list of str or None
+            Each option becomes one directive line, or None if the
+            scheduler only runs arrays of consecutive indices
+        """
+        return None
+
+    def read_array_options(self, options):
+        """Get the task indices and the throttle back from the array
+        options of a script
+
+        Parameters
+        ----------
+        options : list of str
+            Options of the directives of the script which start with one of
+            ``array_option_prefixes``
+
+        Returns
+        -------
+        tasks : list of int
+        max_running : int or None
+        """
+        for option in options:
+            for prefix in self.array_option_prefixes:
+                if option.startswith(prefix):
+                    return parse_array_spec(option[len(prefix):].strip())
+        return [], None
+
+    def dependency_options(self, dependencies):
+        """Options holding the job until other jobs have succeeded
+
+        Parameters
+        ----------
+        dependencies : list of (str, bool)
+            Job ID of each job to wait for, and whether it is an array job
+
+        Returns
+        -------
+        options : list of str
+            Each option becomes one directive line
+        """
+        raise NotImplementedError
+
+    def elementwise_dependency_options(self, job_ids):
+        """Options holding each task of an array job until the same task
+        of each of these array jobs has finished, if the scheduler has them
+
+        Returns
+        -------
+        options : list of str
+            Each option becomes one directive line
+        """
+        raise NotImplementedError
+
+    def wait_options(self, dependencies, elementwise=()):
+        """Options holding the job until other jobs have succeeded, and
+        each of its tasks until the same task of other array jobs has
+        finished
+
+        Parameters
+        ----------
+        dependencies : list of (str, bool)
+            As for ``dependency_options``
+        elementwise : list of str, optional
+            As for ``elementwise_dependency_options``
+
+        Returns
+        -------
+        options : list of str
+            Each option becomes one directive line
+        """
+        options = []
+        if dependencies:
+            options.extend(self.dependency_options(dependencies))
+        if elementwise:
+            options.extend(self.elementwise_dependency_options(elementwise))
+        return options
+
+    def render_header(self, submitter, job_name, out_filename, err_filename,
+                      n_tasks, array=None, elementwise=()):
+        """Lines of the script up to the commands
+
+        Parameters
+        ----------
+        submitter : qtools.Submitter
+            Job whose resources to request
+        job_name : str
+            Name of the job for the queue list
+        out_filename, err_filename : str
+            Where to write stdout and stderr of the job
+        n_tasks : int
+            Number of tasks, if this is an array job
+        array : bool, optional
+            Whether this is an array job. By default, ``submitter.array``
+        elementwise : list of str, optional
+            IDs of the array jobs whose tasks each task of this job waits
+            for, if ``elementwise_dependencies``
+
+        Returns
+        -------
+        lines : list of str
+            Lines of the header, without newlines
+        """
+        lines = ['#!/bin/bash']
+        lines.extend(self.directive(option) for option in self.job_options(
+            submitter, job_name, out_filename, err_filename))
+        for keyword, values in six.iteritems(submitter.additional_resources):
+            lines.extend(self.directive(keyword, value) for value in values)
+        if array is None:
+            array = submitter.array
+        if array:
+            lines.extend(self.directive(option) for option in
+                         self.array_options(n_tasks, submitter.max_running))
+        lines.extend(self.directive(option) for option in
+                     self.wait_options(submitter.wait_for, elementwise))
+        lines.extend(self.preamble)
+        return lines
+
+    def submit_command(self, sh_filename):
+        """Command line submitting the script to the queue"""
+        raise NotImplementedError
+
+    def parse_job_id(self, output):
+        """Get the job ID from the output of the submit command"""
+        return re.findall(r'\d+', output)[0]
+
+    def submit(self, sh_filename):
+        """Submit the script to the queue
+
+        Returns
+        -------
+        job_id : str
+            Identifier of the job in the queue
+        """
+        output = subprocess.check_output(self.submit_command(sh_filename),
+                                         universal_newlines=True)
+        return self.parse_job_id(output)
+
+    def cancel_command(self, job_id, task=None, array=False):
+        """Command line deleting a job, or one task of an array job, from
+        the queue. ``array`` says whether the job is an array job, which
+        some schedulers name differently."""
+        raise NotImplementedError
+
+    def cancel(self, job_id, task=None, array=False):
+        """Delete a job, or one task of an array job, from the queue
+
+        Returns
+        -------
+        cancelled : bool
+            Whether the scheduler deleted it, which it doesn't for jobs that
+            have already left the queue
+        """
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(
+                self.cancel_command(job_id, task, array),
+                stdout=devnull, stderr=devnull) == 0
+
+    def status_command(self, job_ids, arrays=()):
+        """Command line reporting the state of all of these jobs at once.
+        ``arrays`` are the IDs among them of array jobs."""
+        raise NotImplementedError
+
+    def parse_status(self, stream):
+        """Read the output of the status command as it streams in
+
+        Parameters
+        ----------
+        stream : file
+            Output of the status command, opened in binary mode
+
+        Returns
+        -------
+        statuses : iterator of TaskStatus
+            State of each job or task in the output. Job IDs are the same
+            as returned by ``submit``.
+        """
+        raise NotImplementedError
+
+    def parse_unknown(self, errors):
+        """IDs of the jobs which the status command said it doesn't know,
+        from its error output, as returned by ``submit``"""
+        return []
+
+    def query(self, job_ids, arrays=()):
+        """Ask the scheduler for the state of several jobs in one call
+
+        Jobs which have left the queue are missing from the statuses.
+
+        Parameters
+        ----------
+        job_ids : list of str
+            Jobs to ask about
+        arrays : list of str, optional
+            The job IDs among them of array jobs
+
+        Returns
+        -------
+        statuses : list of TaskStatus
+
+        Raises
+        ------
+        QueryError : if the status command failed, in which case jobs
+            missing from its statuses haven't necessarily left the queue
+        """
+        # A file rather than a pipe, which could fill up while the output
+        # is read
+        command = self.status_command(job_ids, arrays)
+        with tempfile.TemporaryFile() as errors:
+            process = subprocess.Popen(command,
+                                       stdout=subprocess.PIPE,
+                                       stderr=errors)
+            try:
+                statuses = list(self.parse_status(process.stdout))
+            finally:
+                process.stdout.close()
+                returncode = process.wait()
+            if returncode == 0:
+                return statuses
+            errors.seek(0)
+            message = errors.read().decode('utf-8', 'replace')
+        raise QueryError('{} exited with {}: {}'.format(
+            command[0], returncode,
+            message.strip()), statuses, self.parse_unknown(message))
+
+
+def _iterparse(stream, tag):
+    """Yield each element with this tag of an XML stream, then clear it so
+    the document never builds up in memory"""
+    try:
+        for _, element in ElementTree.iterparse(stream):
+            if element.tag == tag:
+                yield element
+                element.clear()
+    except ElementTree.ParseError:
+        # No jobs makes for an empty or truncated document
+        return
+
+
+class PBSBackend(Backend):
+    """PBS/Torque, as on TSCC"""
+    name = 'PBS'
+    directive_prefix = '#PBS'
+    array_task_id = 'PBS_ARRAYID'
+    max_ppn = 16
+    array_option_prefixes = ('-t ',)
+    dependency_option_prefixes = ('-W depend=',)
+    output_option_prefixes = ('-o ', '-e ')
+    preamble = ('', '# Go to the directory from which the script was called',
+                'cd $PBS_O_WORKDIR')
+
+    def job_options(self, submitter, job_name, out_filename, err_filename):
+        return ['-N {}'.format(job_name),
+                '-o {}'.format(out_filename),
+                '-e {}'.format(err_filename),
+                '-V',
+                '-l walltime={}'.format(submitter.walltime),
+                '-l nodes={}:ppn={}'.format(submitter.nodes, submitter.ppn),
+                '-A {}'.format(submitter.account),
+                '-q {}'.format(submitter.queue)]
+
+    def array_options(self, n_tasks, max_running=None):
+        if max_running is not None:
+            return ['-t 1-{}%{}'.format(n_tasks, max_running)]
+        return ['-t 1-{}'.format(n_tasks)]
+
+    def sparse_array_options(self, tasks, max_running=None):
+        return ['-t {}'.format(_array_spec(tasks, max_running))]
+
+    def dependency_options(self, dependencies):
+        # Torque only waits for every task of an array with afterokarray
+        jobs = [job_id for job_id, array in dependencies if not array]
+        arrays = ['{}[]'.format(job_id) for job_id, array in dependencies
+                  if array]
+        types = []
+        if jobs:
+            types.append('afterok:' + ':'.join(jobs))
+        if arrays:
+            types.append('afterokarray:' + ':'.join(arrays))
+        return ['-W depend={}'.format(','.join(types))]
+
+    def submit_command(self, sh_filename):
+        return ['qsub', sh_filename]
+
+    def cancel_command(self, job_id, task=None, array=False):
+        if task is not None:
+            job_id = '{}[{}]'.format(job_id, task)
+        elif array:
+            job_id = '{}[]'.format(job_id)
+        return ['qdel', str(job_id)]
+
+    # Job states of Torque: exiting (E) jobs are still running, waiting (W)
+    # and moving (T) ones are as good as queued
+    states = dict(Q=QUEUED, W=QUEUED, T=QUEUED, H=HELD, S=HELD, R=RUNNING,
+                  E=RUNNING, C=COMPLETED)
+
+    def status_command(self, job_ids, arrays=()):
+        # Torque only knows array jobs as 123[]
+        arrays = set(str(job_id) for job_id in arrays)
+        return ['qstat', '-x', '-t'] + [
+            '{}[]'.format(job_id) if str(job_id) in arrays else str(job_id)
+            for job_id in job_ids]
+
+    def parse_status(self, stream):
+        for job in _iterparse(stream, 'Job'):
+            # e.g. 123.tscc-mgr, 123[].tscc-mgr or 123[4].tscc-mgr
+            job_id, _, task_id = job.findtext('Job_Id').split(
+                '.')[0].partition('[')
+            task_id = task_id.rstrip(']')
+            exit_status = job.findtext('exit_status')
+            yield TaskStatus(job_id, int(task_id) if task_id else None,
+                             self.states.get(job.findtext('job_state')),
+                             int(exit_status) if exit_status else None)
+
+    def parse_unknown(self, errors):
+        # Torque reports every job which has left the queue, and carries on
+        # with the rest, e.g. "qstat: Unknown Job Id Error 123[].tscc-mgr"
+        return [job_id.split('.')[0].partition('[')[0] for job_id in
+                re.findall(r'Unknown Job Id (?:Error )?(\S+)', errors)]
+
+
+class SGEBackend(Backend):
+    """Sun Grid Engine, as on oolite"""
+    name = 'SGE'
+    directive_prefix = '#$'
+    array_task_id = 'SGE_TASK_ID'
+    default_resources = (('-l', 'bigmem'), ('-l', 'h_vmem=16G'))
+    elementwise_dependencies = True
+    array_option_prefixes = ('-t ', '-tc ')
+    dependency_option_prefixes = ('-hold_jid ', '-hold_jid_ad ')
+    output_option_prefixes = ('-o ', '-e ')
+
+    def job_options(self, submitter, job_name, out_filename, err_filename):
+        return ['-N {}'.format(job_name),
+                '-o {}'.format(out_filename),
+                '-e {}'.format(err_filename),
+                '-V',
+                '-S /bin/bash',
+                '-cwd']
+
+    def array_options(self, n_tasks, max_running=None):
+        options = ['-t 1-{}'.format(n_tasks)]
+        if max_running is not None:
+            options.append('-tc {}'.format(max_running))
+        return options
+
+    def read_array_options(self, options):
+        tasks, max_running = [], None
+        for option in options:
+            if option.startswith('-tc '):
+                max_running = int(option[4:])
+            elif option.startswith('-t '):
+                # e.g. 1-500, or 1-500:2 with a step
+                span, _, step = option[3:].strip().partition(':')
+                first, _, last = span.partition('-')
+                tasks = list(six.moves.range(int(first), int(last or first) +
+                                             1, int(step or 1)))
+        return tasks, max_running
+
+    def dependency_options(self, dependencies):
+        # SGE holds the job until the others have finished, but runs it
+        # even if they failed, unless they exit with 100
+        return ['-hold_jid {}'.format(','.join(
+            job_id for job_id, _ in dependencies))]
+
+    def elementwise_dependency_options(self, job_ids):
+        return ['-hold_jid_ad {}'.format(','.join(job_ids))]
+
+    def submit_command(self, sh_filename):
+        return ['qsub', sh_filename]
+
+    def cancel_command(self, job_id, task=None, array=False):
+        if task is not None:
+            return ['qdel', str(job_id), '-t', str(task)]
+        return ['qdel', str(job_id)]
+
+    def status_command(self, job_ids, arrays=()):
+        # SGE can't list only some jobs, so list all of the user's jobs
+        return ['qstat', '-xml', '-u', getpass.getuser()]
+
+    def parse_status(self, stream):
+        for job in _iterparse(stream, 'job_list'):
+            state = job.findtext('state') or ''
+            if 'h' in state or 'E' in state:
+                state = HELD
+            elif 'r' in state or 't' in state:
+                state = RUNNING
+            else:
+                state = QUEUED
+            # Pending tasks of an array are listed as a range, e.g. 2-10:1
+            tasks = job.findtext('tasks') or ''
+            yield TaskStatus(job.findtext('JB_job_number'),
+                             int(tasks) if tasks.isdigit() else None, state,
+                             None)
+
+
+class SLURMBackend(Backend):
+    """SLURM, which starts jobs in the directory they were submitted from"""
+    name = 'SLURM'
+    directive_prefix = '#SBATCH'
+    array_task_id = 'SLURM_ARRAY_TASK_ID'
+    elementwise_dependencies = True
+    array_option_prefixes = ('--array=',)
+    dependency_option_prefixes = ('--dependency=',)
+    output_option_prefixes = ('--output=', '--error=')
+    job_name_option_prefix = '--job-name='
+
+    def job_options(self, submitter, job_name, out_filename, err_filename):
+        return ['--job-name={}'.format(job_name),
+                '--output={}'.format(out_filename),
+                '--error={}'.format(err_filename),
+                '--export=ALL',
+                '--time={}'.format(submitter.walltime),
+                '--nodes={}'.format(submitter.nodes),
+                '--ntasks-per-node={}'.format(submitter.ppn),
+                '--account={}'.format(submitter.account),
+                '--partition={}'.format(submitter.queue)]
+
+    def array_options(self, n_tasks, max_running=None):
+        if max_running is not None:
+            return ['--array=1-{}%{}'.format(n_tasks, max_running)]
+        return ['--array=1-{}'.format(n_tasks)]
+
+    def sparse_array_options(self, tasks, max_running=None):
+        return ['--array={}'.format(_array_spec(tasks, max_running))]
+
+    def dependency_options(self, dependencies):
+        return ['--dependency=afterok:{}'.format(':'.join(
+            job_id for job_id, _ in dependencies))]
+
+    def elementwise_dependency_options(self, job_ids):
+        return ['--dependency=aftercorr:{}'.format(':'.join(job_ids))]
+
+    def wait_options(self, dependencies, elementwise=()):
+        # sbatch only keeps the last --dependency, so give every type of
+        # dependency in one, e.g. --dependency=afterok:11,aftercorr:12
+        prefix = self.dependency_option_prefixes[0]
+        types = [option[len(prefix):] for option in super(
+            SLURMBackend, self).wait_options(dependencies, elementwise)]
+        if not types:
+            return []
+        return ['{}{}'.format(prefix, ','.join(types))]
+
+    def submit_command(self, sh_filename):
+        return ['sbatch', sh_filename]
+
+    def cancel_command(self, job_id, task=None, array=False):
+        if task is not None:
+            job_id = '{}_{}'.format(job_id, task)
+        return ['scancel', str(job_id)]
+
+    # Job states of squeue, of which completing (CG) jobs are still running
+    states = dict(PD=QUEUED, CF=QUEUED, R=RUNNING, CG=RUNNING, S=HELD,
+                  ST=HELD, RH=HELD, RQ=QUEUED, RS=HELD, CD=COMPLETED,
+                  F=COMPLETED, CA=COMPLETED, TO=COMPLETED, NF=COMPLETED,
+                  OOM=COMPLETED)
+
+    def status_command(self, job_ids, arrays=()):
+        return ['squeue', '--noheader', '--format=%i %t',
+                '--jobs={}'.format(','.join(str(j) for j in job_ids))]
+
+    def parse_status(self, stream):
+        for line in stream:
+            # e.g. "123 R", "123_4 R" or "123_[5-10%2] PD"
+            words = line.decode('utf-8').split()
+            if len(words) != 2:
+                continue
+            job_id, _, task_id = words[0].partition('_')
+            yield TaskStatus(job_id,
+                             int(task_id) if task_id.isdigit() else None,
+                             self.states.get(words[1], QUEUED), None)
+
+
+def _run_local_task(sh_filename, cwd, out_filename, err_filename,
+                    environment):
+    """Run one task of a local job in a worker process
+
+    Returns
+    -------
+    exit_code : int
+        Exit code of the script
+    """
+    env = dict(os.environ, **environment)
+    with open(out_filename, 'w') as out, open(err_filename, 'w') as err:
+        return subprocess.call(['bash', sh_filename], cwd=cwd, env=env,
+                               stdout=out, stderr=err)
+
+
+class LocalBackend(Backend):
+    """Run jobs on a process pool on this machine instead of a cluster
+
+    The script is written just like for a cluster, and "submitting" it runs
+    it right away in ``ppn`` worker processes, or ``max_running`` if that
+    is smaller. Each task of an array job runs the script with its index in
+    QTOOLS_ARRAY_TASK_ID. Submitting returns immediately; use
+    ``exit_codes`` to wait for the job. Jobs depending on other local jobs
+    are held until those have succeeded, and cancelled if one failed.
+    """
+    name = 'local'
+    directive_prefix = '#LOCAL'
+    array_task_id = 'QTOOLS_ARRAY_TASK_ID'
+    array_option_prefixes = ('-t ',)
+    dependency_option_prefixes = ('-W depend=',)
+    output_option_prefixes = ('-o ', '-e ')
+
+    def __init__(self):
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # Futures of the exit codes of each job's tasks, by job ID
+        self.jobs = {}
+        # Indices of the tasks of each array job, by job ID
+        self.tasks = {}
+        # IDs of the jobs waiting for others to succeed
+        self.held = set()
+
+    def job_options(self, submitter, job_name, out_filename, err_filename):
+        return ['-N {}'.format(job_name),
+                '-o {}'.format(out_filename),
+                '-e {}'.format(err_filename),
+                '-l ppn={}'.format(submitter.ppn)]
+
+    def array_options(self, n_tasks, max_running=None):
+        if max_running is not None:
+            return ['-t 1-{}%{}'.format(n_tasks, max_running)]
+        return ['-t 1-{}'.format(n_tasks)]
+
+    def sparse_array_options(self, tasks, max_running=None):
+        return ['-t {}'.format(_array_spec(tasks, max_running))]
+
+    def dependency_options(self, dependencies):
+        return ['-W depend=afterok:{}'.format(':'.join(
+            job_id for job_id, _ in dependencies))]
+
+    def submit_command(self, sh_filename):
+        return ['bash', sh_filename]
+
+    def _read_directives(self, sh_filename):
+        """Get the output files, the tasks, the number of workers and the
+        jobs to wait for back from the directives of a script"""
+        # Values of each option, which may be given several times, e.g.
+        # -l ppn=4 and -l mem=4gb from add_resource
+        directives = {}
+        prefix = self.directive_prefix + ' '
+        with open(sh_filename) as f:
+            for line in f:
+                if line.startswith(prefix):
+                    option, _, value = line[len(prefix):].strip().partition(
+                        ' ')
+                    directives.setdefault(option, []).append(value)
+        n_workers = 1
+        for value in directives.get('-l', ()):
+            match = re.search(r'(?:^|[:,])ppn=(\d+)', value)
+            if match:
+                n_workers = int(match.group(1))
+        if '-t' in directives:
+            tasks, max_running = parse_array_spec(directives['-t'][-1])
+            if max_running:
+                n_workers = min(n_workers, max_running)
+        else:
+            tasks = None
+        dependencies = [job_id for value in directives.get('-W', ())
+                        if value.startswith('depend=')
+                        for job_id in value.split(':')[1:]]
+        return (directives['-o'][-1], directives['-e'][-1], tasks, n_workers,
+                dependencies)
+
+    def submit(self, sh_filename):
+        out_filename, err_filename, tasks, n_workers, dependencies = \
+            self._read_directives(sh_filename)
+        cwd = os.getcwd()
+
+        if tasks is None:
+            n_workers = 1
+            arguments = [(out_filename, err_filename, {})]
+        else:
+            n_workers = max(1, min(n_workers, len(tasks)))
+            arguments = [('{}.{}'.format(out_filename, task),
+                          '{}.{}'.format(err_filename, task),
+                          {self.array_task_id: str(task)}) for task in tasks]
+
+        with self._lock:
+            job_id = str(next(self._job_ids))
+            self.tasks[job_id] = tasks
+            if dependencies:
+                # Stand-ins for the tasks until they are started
+                self.jobs[job_id] = [Future() for _ in arguments]
+                self.held.add(job_id)
+            else:
+                self.jobs[job_id] = self._start(sh_filename, cwd, n_workers,
+                                                arguments)
+        if dependencies:
+            thread = threading.Thread(target=self._start_after, args=(
+                job_id, dependencies, sh_filename, cwd, n_workers,
+                arguments))
+            thread.daemon = True
+            thread.start()
+        return job_id
+
+    def _start(self, sh_filename, cwd, n_workers, arguments):
+        """Start the tasks of a job and return the futures of their exit
+        codes"""
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        futures = [executor.submit(_run_local_task, sh_filename, cwd, *args)
+                   for args in arguments]
+        # The futures still finish after the pool stops taking new work
+        executor.shutdown(wait=False)
+        return futures
+
+    def _start_after(self, job_id, dependencies, sh_filename, cwd,
+                     n_workers, arguments):
+        """Start a held job once the jobs it depends on have succeeded, or
+        cancel it if one of them failed"""
+        futures = [future for dependency in dependencies
+                   for future in self.jobs.get(dependency, [])]
+        wait(futures)
+        succeeded = all(not future.cancelled() and
+                        future.exception() is None and future.result() == 0
+                        for future in futures)
+        with self._lock:
+            self.held.discard(job_id)
+        if not succeeded:
+            for future in self.jobs[job_id]:
+                future.cancel()
+            return
+        # Tasks cancelled while the job was held never start, and the rest
+        # can't be cancelled from here on, like running tasks
+        starting = [(future, args) for future, args in zip(
+            self.jobs[job_id], arguments)
+            if future.set_running_or_notify_cancel()]
+        if not starting:
+            return
+        for (future, _), started in zip(starting, self._start(
+                sh_filename, cwd, min(n_workers, len(starting)),
+                [args for _, args in starting])):
+            started.add_done_callback(functools.partial(_copy_result,
+                                                        future))
+
+    def cancel(self, job_id, task=None, array=False):
+        """Cancel a job, or one task of an array job, which hasn't started
+        yet. Tasks that are already running run to the end."""
+        futures = self.jobs.get(str(job_id), [])
+        tasks = self.tasks.get(str(job_id)) or [None] * len(futures)
+        cancelled = False
+        for task_id, future in zip(tasks, futures):
+            if task is None or task_id == task:
+                cancelled = future.cancel() or cancelled
+        return cancelled
+
+    def exit_codes(self, job_id, timeout=None):
+        """Wait for a local job to finish
+
+        Parameters
+        ----------
+        job_id : str
+            Identifier returned when the job was submitted
+        timeout : float, optional
+            Seconds to wait for each task before raising a
+            concurrent.futures.TimeoutError
+
+        Returns
+        -------
+        exit_codes : list of int
+            Exit code of each task of the job, in order
+
+        Raises
+        ------
+        concurrent.futures.CancelledError : if the job never ran, because
+            a job it depended on failed
+        """
+        return [future.result(timeout) for future in self.jobs[job_id]]
+
+    def query(self, job_ids, arrays=()):
+        statuses = []
+        for job_id in job_ids:
+            job_id = str(job_id)
+            futures = self.jobs.get(job_id, [])
+            tasks = self.tasks.get(job_id) or [None] * len(futures)
+            for task_id, future in zip(tasks, futures):
+                if future.cancelled():
+                    # Never ran, as a dependency failed
+                    state, exit_status = COMPLETED, None
+                elif future.done():
+                    state = COMPLETED
+                    exit_status = (future.result() if future.exception() is
+                                   None else -1)
+                elif job_id in self.held:
+                    state, exit_status = HELD, None
+                else:
+                    state = RUNNING if future.running() else QUEUED
+                    exit_status = None
+                statuses.append(TaskStatus(job_id, task_id, state,
+                                           exit_status))
+        return statuses
+
+
+def _array_spec(tasks, max_running=None):
+    """Task indices as ranges and single indices separated by commas,
+    e.g. "3,7,19-21%2", the opposite of parse_array_spec"""
+    parts = []
+    for _, group in itertools.groupby(enumerate(sorted(tasks)),
+                                      lambda item: item[1] - item[0]):
+        group = [task for _, task in group]
+        if len(group) > 1:
+            parts.append('{}-{}'.format(group[0], group[-1]))
+        else:
+            parts.append(str(group[0]))
+    spec = ','.join(parts)
+    if max_running is not None:
+        spec += '%{}'.format(max_running)
+    return spec
+
+
+def _copy_result(future, started):
+    """Finish the stand-in future of a task with the result of the task"""
+    if started.exception() is not None:
+        future.set_exception(started.exception())
+    else:
+        future.set_result(started.result())
+
+
+# Backends by lowercase queue type
+BACKENDS = {}
+
+
+def register_backend(backend):
+    """Make a backend available as a queue_type of qtools.Submitter
+
+    Parameters
+    ----------
+    backend : Backend
+        Instance of the backend. Registering a backend with the name of an
+        existing one replaces it.
+
+    Returns
+    -------
+    backend : Backend
+        The same backend
+    """
+    BACKENDS[backend.name.lower()] = backend
+    return backend
+
+
+def get_backend(queue_type):
+    """Get the registered backend of a queue type, ignoring case
+
+    Raises
+    ------
+    ValueError : if no backend is registered for the queue type
+    """
+    try:
+        return BACKENDS[queue_type.lower()]
+    except (KeyError, AttributeError):
+        raise ValueError('Unknown queue type {!r}. Known queue types are: '
+                         '{}'.format(queue_type,
+                                     ', '.join(sorted(b.name for b in
+                                                      BACKENDS.values()))))
+
+
+def script_backend(sh_filename):
+    """Get the registered backend a script was written for, from the
+    prefix of its directives
+
+    Raises
+    ------
+    ValueError : if the script has no directives of a registered backend
+    """
+    prefixes = dict((backend.directive_prefix + ' ', backend)
+                    for backend in BACKENDS.values())
+    with open(sh_filename) as f:
+        for line in f:
+            for prefix, backend in prefixes.items():
+                if line.startswith(prefix):
+                    return backend
+    raise ValueError('{} has no directives of any known queue '
+                     'type'.format(sh_filename))
+
+
+register_backend(PBSBackend())
+register_backend(SGEBackend())
+register_backend(SLURMBackend())
+register_backend(LocalBackend())
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Connections to the sqlite databases qtools keeps on shared filesystems
+
+The work queues of pilot jobs, the runtime history and the index of scripts
+are all sqlite databases written to by many processes at once, possibly on
+many nodes, so they are all opened the same way.
+"""
+
+import sqlite3
+
+__author__ = 'Olga Botvinnik'
+
+# Seconds to wait for the locks of other processes, e.g. of hundreds of
+# tasks finishing at once
+TIMEOUT = 600
+
+
+def connect(filename):
+    """Open a sqlite database for a ``with`` block, which closes it
+
+    The connection is in autocommit mode, so each statement is a
+    transaction of its own unless it is between an explicit BEGIN and
+    COMMIT.
+    """
+    return _Closing(sqlite3.connect(filename, timeout=TIMEOUT,
+                                    isolation_level=None))
+
+
+class _Closing(object):
+    """Close a sqlite connection at the end of a ``with`` block"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.close()
@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+"""Run Python callables on the cluster as futures
+
+A ``ClusterExecutor`` is a ``concurrent.futures.Executor`` whose calls run
+as the tasks of array jobs. The callables and their arguments are pickled to
+a folder on the shared filesystem, an array job is written and submitted
+with ``qtools.Submitter``, and each task runs ``python -m qtools.executor``,
+which unpickles a batch of calls, runs them, and pickles their results next
+to them. The futures resolve as the result files appear.
+
+Calls are batched twice over, so that the scheduler's overhead is paid per
+batch and not per call: every array task runs many calls, and every array
+job holds all the calls made within ``batch_delay`` seconds of each other.
+
+With pickle protocol 5 (Python 3.8 and later), large buffers such as the
+data of NumPy arrays are written raw to files of their own instead of into
+the pickle, and are memory-mapped back when loaded, so gathering large
+results copies nothing into memory until it's read.
+"""
+
+import argparse
+import itertools
+import mmap
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Executor, Future
+
+import six
+
+from .monitor import SENTINEL_SUFFIX
+from .submitter import Submitter, _batches
+from .watch import DirectoryWatcher
+
+__author__ = 'Olga Botvinnik'
+
+# Suffixes of the files of the calls of a task, and of their results
+CALLS_SUFFIX = '.calls'
+RESULTS_SUFFIX = '.results'
+
+# Most seconds between looks for new array jobs and results
+MAX_POLL_INTERVAL = 10
+
+# Whether pickles can keep large buffers out of band, in files of their own
+PICKLE_BUFFERS = pickle.HIGHEST_PROTOCOL >= 5
+
+# Smallest buffer, in bytes, written to a file of its own instead of into
+# the pickle
+OUT_OF_BAND_BYTES = 1 << 20
+
+
+class ClusterExecutor(Executor):
+    """Run Python callables as the tasks of array jobs
+
+    Parameters
+    ----------
+    folder : str, optional
+        Folder on a filesystem shared with the compute nodes for the scripts,
+        calls and results. By default, a new folder in the current one.
+    calls_per_task : int, optional
+        Most calls run by each array task, one after the other
+    batch_delay : float, optional
+        Seconds to wait after a call for more calls to submit in the same
+        array job
+    job_name : str, optional
+        Name of the array jobs
+    **submitter_kwargs
+        Keyword arguments of qtools.Submitter for every array job, e.g.
+        queue_type, walltime or max_running
+
+    The callables, their arguments and their results must be picklable, so
+    the callables must be importable by name on the compute nodes, e.g.
+    functions defined at the top level of a module.
+
+    Example
+    -------
+    >>> with ClusterExecutor(walltime='1:00:00') as executor:
+    ...     sizes = list(executor.map(os.path.getsize, filenames,
+    ...                               chunksize=100))
+    """
+
+    def __init__(self, folder=None, calls_per_task=100, batch_delay=1,
+                 job_name='qtools-executor', **submitter_kwargs):
+        if folder is None:
+            folder = tempfile.mkdtemp(prefix='qtools-executor-', dir='.')
+        elif not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.folder = os.path.abspath(folder)
+        self.calls_per_task = calls_per_task
+        self.batch_delay = batch_delay
+        self.job_name = job_name
+        self.submitter_kwargs = submitter_kwargs
+        # Submitter of each array job
+        self.submitters = []
+
+        # Calls not submitted yet, as (future, number of calls it stands
+        # for, fn, args, kwargs)
+        self._pending = []
+        self._timer = None
+        self._batches = itertools.count()
+        # Futures of the calls of each task of each submitted array job,
+        # by folder of the job and task index
+        self._running = {}
+        self._collector = None
+        self._shutdown = False
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) to run in an array task
+
+        The call is submitted with the other calls made within batch_delay
+        seconds of each other, or when flush is called.
+        """
+        return self._submit(1, fn, args, kwargs)
+
+    def _submit(self, n_calls, fn, args, kwargs):
+        """Schedule a call standing for n_calls calls, e.g. a chunk of
+        map, in the tasks of the next array job"""
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Cannot schedule new calls after '
+                                   'shutdown')
+            future = Future()
+            self._pending.append((future, n_calls, fn, args, kwargs))
+            if self._timer is None:
+                self._timer = threading.Timer(self.batch_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+    def map(self, fn, *iterables, **kwargs):
+        """Like the builtin map, with each call run on the cluster
+
+        Parameters
+        ----------
+        fn : callable
+        *iterables
+            Arguments of the calls
+        timeout : float, optional
+            Raise concurrent.futures.TimeoutError if a result isn't there
+            this many seconds after map was called
+        chunksize : int, optional
+            Calls run by each array task. Defaults to calls_per_task.
+
+        Returns
+        -------
+        results : iterator
+            Result of each call, in order, as they come in
+        """
+        timeout = kwargs.pop('timeout', None)
+        chunksize = kwargs.pop('chunksize', None) or self.calls_per_task
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: {}'.format(
+                ', '.join(sorted(kwargs))))
+        # Each array task runs one chunk of the calls as a single call
+        chunks = _batches(zip(*iterables), chunksize)
+        futures = [self._submit(len(chunk), _run_chunk, (fn, chunk), {})
+                   for chunk in chunks]
+        self.flush()
+        end = None if timeout is None else time.time() + timeout
+
+        def results():
+            try:
+                for future in futures:
+                    remaining = None if end is None else end - time.time()
+                    for result in future.result(remaining):
+                        yield result
+            finally:
+                for future in futures:
+                    future.cancel()
+        return results()
+
+    def flush(self):
+        """Submit the pending calls now, as one array job"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending = [call for call in self._pending
+                       if call[0].set_running_or_notify_cancel()]
+            self._pending = []
+        if not pending:
+            return
+        try:
+            self._submit_batch(pending)
+        except BaseException as e:
+            for call in pending:
+                call[0].set_exception(e)
+            raise
+
+    def _submit_batch(self, calls):
+        """Pickle the calls into tasks and submit them as an array job"""
+        batch = os.path.join(self.folder, 'batch{}'.format(
+            next(self._batches)))
+        os.makedirs(batch)
+        tasks = {}
+        commands = []
+        for i, task_calls in enumerate(_tasks(calls, self.calls_per_task)):
+            task = i + 1
+            dump([call[2:] for call in task_calls], os.path.join(
+                batch, '{}{}'.format(task, CALLS_SUFFIX)))
+            tasks[task] = [call[0] for call in task_calls]
+            commands.append('{} -m qtools.executor {} {}'.format(
+                sys.executable, six.moves.shlex_quote(batch), task))
+
+        kwargs = dict(self.submitter_kwargs, array=True, sentinels=True)
+        submitter = Submitter(commands, self.job_name,
+                              sh=os.path.join(batch, 'job.sh'), **kwargs)
+        # Array jobs of more than one script number their tasks anew
+        sentinels = []
+        offset = 0
+        for _, status_dir, n_tasks in submitter.array_parts:
+            sentinels.append((status_dir, offset))
+            offset += n_tasks
+        with self._condition:
+            self.submitters.append(submitter)
+            self._running[batch] = (tasks, sentinels)
+            if self._collector is None:
+                self._collector = threading.Thread(target=self._collect)
+                self._collector.daemon = True
+                self._collector.start()
+            self._condition.notify()
+
+    def _collect(self):
+        """Resolve the futures of the tasks whose results are in, until
+        shut down with nothing left to wait for
+
+        The folders of the running array jobs and of their sentinels are
+        watched, so results are noticed as soon as they are written, and so
+        is the folder of the executor, where new array jobs appear.
+        """
+        watcher = DirectoryWatcher([self.folder])
+        try:
+            while True:
+                with self._condition:
+                    while not self._running:
+                        if self._shutdown and not self._pending:
+                            self._collector = None
+                            return
+                        self._condition.wait(MAX_POLL_INTERVAL)
+                    running = list(self._running.items())
+
+                for batch, (tasks, sentinels) in running:
+                    folders = [batch] + [status_dir
+                                         for status_dir, _ in sentinels]
+                    for folder in folders:
+                        watcher.add(folder)
+                    for task, futures in _finished_tasks(batch, tasks,
+                                                         sentinels):
+                        del tasks[task]
+                    if not tasks:
+                        for folder in folders:
+                            watcher.remove(folder)
+                        with self._condition:
+                            del self._running[batch]
+                            self._condition.notify_all()
+                watcher.wait(MAX_POLL_INTERVAL)
+        except Exception as e:
+            # Fail whatever is still running rather than leave shutdown
+            # waiting for it forever
+            with self._condition:
+                for tasks, _ in self._running.values():
+                    for futures in tasks.values():
+                        for future in futures:
+                            if not future.done():
+                                future.set_exception(e)
+                self._running.clear()
+                self._collector = None
+                self._condition.notify_all()
+            raise
+        finally:
+            watcher.close()
+
+    def shutdown(self, wait=True):
+        """Submit the pending calls, and with wait, block until all the
+        calls have finished"""
+        with self._lock:
+            self._shutdown = True
+        self.flush()
+        if wait:
+            with self._condition:
+                self._condition.notify_all()
+                while self._running:
+                    self._condition.wait()
+
+
+def _tasks(calls, calls_per_task):
+    """Group consecutive pending calls into tasks of up to calls_per_task
+    calls, each of which stands for a number of calls"""
+    task = []
+    n_calls = 0
+    for call in calls:
+        if task and n_calls + call[1] > calls_per_task:
+            yield task
+            task = []
+            n_calls = 0
+        task.append(call)
+        n_calls += call[1]
+    if task:
+        yield task
+
+
+def _run_chunk(fn, chunk):
+    """Results of fn on each tuple of arguments of a chunk of map"""
+    return [fn(*args) for args in chunk]
+
+
+def _finished_tasks(batch, tasks, sentinels):
+    """Resolve the futures of the finished tasks of an array job
+
+    Parameters
+    ----------
+    batch : str
+        Folder of the array job
+    tasks : dict
+        Futures of the calls of each unfinished task, by task index
+    sentinels : list of (str, int)
+        Sentinel folder of each script of the array job, and the number of
+        tasks of the scripts before it
+
+    Yields
+    ------
+    task, futures
+        Index and futures of each task whose futures were just resolved
+    """
+    names = set(os.listdir(batch))
+    for task, futures in list(tasks.items()):
+        results = os.path.join(batch, '{}{}'.format(task, RESULTS_SUFFIX))
+        if os.path.basename(results) in names:
+            try:
+                outcomes = load(results)
+            except Exception as e:
+                # e.g. an exception whose class can't be rebuilt from its
+                # args, so fail the task's calls rather than the collector
+                for future in futures:
+                    future.set_exception(e)
+                yield task, futures
+                continue
+            for future, (succeeded, value) in zip(futures, outcomes):
+                if succeeded:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+            yield task, futures
+            continue
+
+        exit_code = _task_exit_code(task, sentinels)
+        if exit_code is not None and not os.path.exists(results):
+            # The task died without writing its results, e.g. out of
+            # memory
+            error = RuntimeError(
+                'Array task {} of {} exited with code {} without any '
+                'results'.format(task, batch, exit_code))
+            for future in futures:
+                future.set_exception(error)
+            yield task, futures
+
+
+def _task_exit_code(task, sentinels):
+    """Exit code of a task from its sentinel file, or None if it's still
+    running"""
+    for status_dir, offset in reversed(sentinels):
+        if task > offset:
+            sentinel = os.path.join(status_dir, '{}{}'.format(
+                task - offset, SENTINEL_SUFFIX))
+            try:
+                with open(sentinel) as f:
+                    return int(f.read().strip() or 0)
+            except (IOError, OSError):
+                return None
+    return None
+
+
+def _buffer_filename(filename, i):
+    """File of the i-th out-of-band buffer of a pickle"""
+    return '{}.{}.buf'.format(filename, i)
+
+
+def dump(obj, filename):
+    """Pickle an object to a file, with its large buffers in files of
+    their own
+
+    With pickle protocol 5, every contiguous buffer of at least
+    OUT_OF_BAND_BYTES, e.g. the data of a NumPy array, is written raw to
+    filename.0.buf, filename.1.buf and so on instead of being copied into
+    the pickle. The pickle itself is written to a temporary file first and
+    renamed last, so it only appears once everything is written.
+    """
+    temporary = '{}.{}.tmp'.format(filename, os.getpid())
+    n_buffers = [0]
+
+    def write_buffer(buffer):
+        try:
+            data = buffer.raw()
+        except BufferError:
+            # Not contiguous, so pickle it in band
+            return True
+        if data.nbytes < OUT_OF_BAND_BYTES:
+            return True
+        with open(_buffer_filename(filename, n_buffers[0]), 'wb') as f:
+            f.write(data)
+        n_buffers[0] += 1
+        return False
+
+    try:
+        with open(temporary, 'wb') as f:
+            if PICKLE_BUFFERS:
+                pickle.dump(obj, f, 5, buffer_callback=write_buffer)
+            else:
+                pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+    except BaseException:
+        os.remove(temporary)
+        raise
+    os.rename(temporary, filename)
+
+
+def load(filename):
+    """Unpickle an object written by dump, memory-mapping its buffers
+
+    The buffers are mapped copy-on-write, so e.g. NumPy arrays loaded from
+    them are writeable, and only the pages that are read are loaded.
+    """
+    with open(filename, 'rb') as f:
+        if PICKLE_BUFFERS:
+            return pickle.load(f, buffers=_mapped_buffers(filename))
+        return pickle.load(f)
+
+
+def _mapped_buffers(filename):
+    """Memory maps of the out-of-band buffers of a pickle, in order"""
+    for i in itertools.count():
+        with open(_buffer_filename(filename, i), 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                # Empty files can't be mapped
+                yield bytearray()
+                continue
+            yield mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+
+def run_task(batch, task):
+    """Run the calls of a task and pickle their outcomes
+
+    Each outcome is (True, result) or (False, exception), written next to
+    the calls with ``dump``.
+    """
+    calls = load(os.path.join(batch, '{}{}'.format(task, CALLS_SUFFIX)))
+    outcomes = []
+    for fn, args, kwargs in calls:
+        try:
+            outcomes.append((True, fn(*args, **kwargs)))
+        except Exception as e:
+            outcomes.append((False, e))
+
+    results = os.path.join(batch, '{}{}'.format(task, RESULTS_SUFFIX))
+    try:
+        dump(outcomes, results)
+    except Exception as e:
+        # Results or exceptions that can't be pickled
+        error = RuntimeError('Could not pickle the results of task {}: '
+                             '{!r}'.format(task, e))
+        dump([(False, error)] * len(calls), results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m qtools.executor',
+        description='Run the pickled calls of a task of a ClusterExecutor')
+    parser.add_argument('batch', help='Folder of the array job')
+    parser.add_argument('task', type=int, help='Index of the task')
+    args = parser.parse_args(argv)
+    run_task(args.batch, args.task)
+
+
+if __name__ == '__main__':
+    main()
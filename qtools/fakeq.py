@@ -0,0 +1,651 @@
+# -*- coding: utf-8 -*-
+"""A stand-in PBS scheduler running jobs on this machine
+
+``install`` writes ``qsub``, ``qstat`` and ``qdel`` executables into a folder.
+With that folder first on the PATH, ``qtools.Submitter`` (and anything else
+calling the PBS commands) submits to the fake scheduler instead of a
+cluster. The state of the jobs is kept in a sqlite database, so the fake
+commands can be called from any process, and each submitted job is run by a
+detached runner process which waits for a free slot, runs the tasks with
+the PBS environment variables set and records their exit codes. This makes
+benchmarks and tests of submission and monitoring reproducible on any
+Linux box.
+
+Example
+-------
+>>> import os
+>>> from qtools import fakeq
+>>> bin_dir = fakeq.install('fakeq', slots=8, start_latency=1)
+>>> os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+"""
+
+import argparse
+import getpass
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from xml.sax.saxutils import escape
+
+from .backends import parse_array_spec
+
+__author__ = 'Olga Botvinnik'
+
+# Domain appended to the job IDs, like the PBS server name
+SERVER = 'fakeq'
+
+# Exit code of a task deleted with qdel, as on Torque
+DELETED_EXIT_CODE = 271
+
+# Dependencies understood: wait for jobs to succeed (ok) or only to finish
+# (any). The *array types wait for every task of an array job.
+DEPENDENCY_TYPES = ('afterok', 'afterokarray', 'afterany', 'afteranyarray')
+
+# How often runners look for a free slot, in seconds
+POLL_INTERVAL = 0.05
+
+COMMANDS = ('qsub', 'qstat', 'qdel')
+
+# Run the runners and the tasks in sessions of their own, so that deleting
+# a task kills its whole process group. Python 2 has no start_new_session.
+if sys.version_info[0] >= 3:
+    NEW_SESSION = dict(start_new_session=True)
+else:
+    NEW_SESSION = dict(preexec_fn=os.setsid)
+
+# Folder containing the qtools package, so runners can import it
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    script TEXT,
+    cwd TEXT,
+    out TEXT,
+    err TEXT,
+    array INTEGER,
+    max_running INTEGER,
+    submitted REAL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    job_id INTEGER,
+    task_id INTEGER,
+    state TEXT,
+    pid INTEGER,
+    exit_code INTEGER,
+    start REAL,
+    finish REAL,
+    PRIMARY KEY (job_id, task_id)
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state);
+CREATE TABLE IF NOT EXISTS dependencies (
+    job_id INTEGER,
+    depends_on INTEGER,
+    type TEXT
+);
+"""
+
+
+def parse_depend(spec):
+    """Get the jobs to wait for out of a PBS -W depend= option
+
+    Parameters
+    ----------
+    spec : str
+        Dependency types, each followed by job IDs, separated by commas,
+        e.g. "depend=afterok:12.fakeq:13,afterokarray:14[]"
+
+    Returns
+    -------
+    dependencies : list of (str, int)
+        Type of each dependency, and the job it depends on
+    """
+    dependencies = []
+    for part in spec.partition('depend=')[2].split(','):
+        words = part.split(':')
+        for job_id in words[1:]:
+            if words[0] not in DEPENDENCY_TYPES:
+                raise ValueError('Unknown dependency type {!r}'.format(
+                    words[0]))
+            dependencies.append((words[0], _parse_job_id(job_id)[0]))
+    return dependencies
+
+
+def parse_directives(sh_filename, prefix='#PBS'):
+    """Read the options of the PBS directives of a script
+
+    Returns
+    -------
+    options : dict
+        Value of each option, e.g. {'-N': 'job', '-t': '1-10'}. Options
+        without a value map to the empty string, and repeated options
+        keep their last value.
+    """
+    options = {}
+    with open(sh_filename) as f:
+        for line in f:
+            if line.startswith(prefix + ' '):
+                option, _, value = line[len(prefix):].strip().partition(' ')
+                options[option] = value.strip()
+    return options
+
+
+class FakeScheduler(object):
+    """State of the fake scheduler, shared through a sqlite database
+
+    Parameters
+    ----------
+    state_dir : str, optional
+        Folder of the database. Defaults to $QTOOLS_FAKEQ_DIR, or a folder
+        in the temporary directory.
+    slots : int, optional
+        Maximum number of tasks running at once, over all jobs. Defaults to
+        $QTOOLS_FAKEQ_SLOTS, or 4.
+    submit_latency : float, optional
+        Seconds that qsub, qstat and qdel take to answer, like a busy head
+        node. Defaults to $QTOOLS_FAKEQ_SUBMIT_LATENCY, or 0.
+    start_latency : float, optional
+        Seconds that a job waits in the queue before it can start. Defaults
+        to $QTOOLS_FAKEQ_START_LATENCY, or 0.
+    run_jobs : bool, optional
+        Whether qsub starts a runner for each job. Without runners, jobs
+        stay queued forever, which is enough to measure submission without
+        starting a process per job. Defaults to $QTOOLS_FAKEQ_RUN_JOBS, or
+        True.
+    """
+
+    def __init__(self, state_dir=None, slots=None, submit_latency=None,
+                 start_latency=None, run_jobs=None):
+        environ = os.environ
+        if state_dir is None:
+            state_dir = environ.get('QTOOLS_FAKEQ_DIR', os.path.join(
+                '/tmp', 'qtools-fakeq-{}'.format(getpass.getuser())))
+        self.state_dir = os.path.abspath(state_dir)
+        self.slots = int(slots if slots is not None else
+                         environ.get('QTOOLS_FAKEQ_SLOTS', 4))
+        self.submit_latency = float(
+            submit_latency if submit_latency is not None else
+            environ.get('QTOOLS_FAKEQ_SUBMIT_LATENCY', 0))
+        self.start_latency = float(
+            start_latency if start_latency is not None else
+            environ.get('QTOOLS_FAKEQ_START_LATENCY', 0))
+        self.run_jobs = bool(int(
+            run_jobs if run_jobs is not None else
+            environ.get('QTOOLS_FAKEQ_RUN_JOBS', 1)))
+
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        self.db_filename = os.path.join(self.state_dir, 'state.db')
+        with self.connect() as connection:
+            connection.executescript(SCHEMA)
+
+    @property
+    def environment(self):
+        """Environment variables passing this configuration on to the
+        commands and runners"""
+        return {'QTOOLS_FAKEQ_DIR': self.state_dir,
+                'QTOOLS_FAKEQ_SLOTS': str(self.slots),
+                'QTOOLS_FAKEQ_SUBMIT_LATENCY': str(self.submit_latency),
+                'QTOOLS_FAKEQ_START_LATENCY': str(self.start_latency),
+                'QTOOLS_FAKEQ_RUN_JOBS': str(int(self.run_jobs))}
+
+    def connect(self, immediate=False):
+        """Connection to the state of the queue for a ``with`` block, in
+        one transaction taking the write lock at the start if immediate"""
+        connection = sqlite3.connect(self.db_filename, timeout=60,
+                                     isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return _Transaction(connection, immediate)
+
+    def format_job_id(self, job_id, array=False, task_id=None):
+        """Job ID as PBS prints it, e.g. "12.fakeq" or "12[3].fakeq" """
+        if task_id is not None:
+            return '{}[{}].{}'.format(job_id, task_id, SERVER)
+        if array:
+            return '{}[].{}'.format(job_id, SERVER)
+        return '{}.{}'.format(job_id, SERVER)
+
+    def submit(self, sh_filename):
+        """Queue a script and start its runner
+
+        Returns
+        -------
+        job_id : str
+            Job ID as printed by qsub, e.g. "12.fakeq"
+        """
+        options = parse_directives(sh_filename)
+        sh_filename = os.path.abspath(sh_filename)
+        name = options.get('-N', os.path.basename(sh_filename))
+        out = options.get('-o', '{}.o'.format(sh_filename))
+        err = options.get('-e', '{}.e'.format(sh_filename))
+        if '-t' in options:
+            tasks, max_running = parse_array_spec(options['-t'])
+        else:
+            tasks, max_running = [0], None
+        dependencies = parse_depend(options.get('-W', ''))
+
+        with self.connect(immediate=True) as connection:
+            cursor = connection.execute(
+                'INSERT INTO jobs (name, script, cwd, out, err, array, '
+                'max_running, submitted) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (name, sh_filename, os.getcwd(), out, err, '-t' in options,
+                 max_running, time.time()))
+            job_id = cursor.lastrowid
+            # Jobs waiting for others are held, like on Torque
+            connection.executemany(
+                "INSERT INTO tasks (job_id, task_id, state) VALUES (?, ?, ?)",
+                [(job_id, task, 'H' if dependencies else 'Q')
+                 for task in tasks])
+            connection.executemany(
+                'INSERT INTO dependencies (job_id, depends_on, type) '
+                'VALUES (?, ?, ?)', [(job_id, depends_on, type_)
+                                     for type_, depends_on in dependencies])
+
+        if not self.run_jobs:
+            return self.format_job_id(job_id, array='-t' in options)
+        env = dict(os.environ, **self.environment)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [PACKAGE_DIR] + env.get('PYTHONPATH', '').split(os.pathsep))
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen(
+                [sys.executable, '-m', 'qtools.fakeq', '_run', str(job_id)],
+                env=env, stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True, **NEW_SESSION)
+        return self.format_job_id(job_id, array='-t' in options)
+
+    def jobs(self, job_ids=None):
+        """Rows of the jobs, with the tasks of each one
+
+        Parameters
+        ----------
+        job_ids : list of str, optional
+            Only these jobs, in PBS format ("12.fakeq", "12[]", "12[3]"
+            or "12"). By default, all jobs.
+
+        Returns
+        -------
+        jobs : list of (dict, list of dict)
+            Each job, and its tasks ordered by index
+        """
+        with self.connect() as connection:
+            connection.row_factory = sqlite3.Row
+            if job_ids is None:
+                rows = connection.execute('SELECT * FROM jobs ORDER BY id')
+                jobs = [dict(row) for row in rows]
+            else:
+                jobs = []
+                for job_id in job_ids:
+                    row = connection.execute(
+                        'SELECT * FROM jobs WHERE id = ?',
+                        (_parse_job_id(job_id)[0],)).fetchone()
+                    if row is None:
+                        raise KeyError(job_id)
+                    jobs.append(dict(row))
+            return [(job, [dict(row) for row in connection.execute(
+                'SELECT * FROM tasks WHERE job_id = ? ORDER BY task_id',
+                (job['id'],))]) for job in jobs]
+
+    def delete(self, job_id):
+        """Kill a job or one task of an array job, like qdel"""
+        job_id, task_id = _parse_job_id(job_id)
+        with self.connect(immediate=True) as connection:
+            query = 'SELECT task_id, state, pid FROM tasks WHERE job_id = ?'
+            arguments = (job_id,)
+            if task_id is not None:
+                query += ' AND task_id = ?'
+                arguments += (task_id,)
+            tasks = connection.execute(query, arguments).fetchall()
+            if not tasks:
+                raise KeyError(job_id)
+            for task, state, pid in tasks:
+                if state == 'C':
+                    continue
+                if state == 'R' and pid:
+                    try:
+                        os.killpg(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                connection.execute(
+                    "UPDATE tasks SET state = 'C', exit_code = ?, finish = ? "
+                    "WHERE job_id = ? AND task_id = ?",
+                    (DELETED_EXIT_CODE, time.time(), job_id, task))
+
+    def run(self, job_id):
+        """Run the tasks of a job as slots free up, until all are done
+
+        This is what the detached runner of each job does.
+        """
+        job, _ = self.jobs([job_id])[0]
+        # Wait in the queue, unless the job is deleted in the meantime
+        while time.time() < job['submitted'] + self.start_latency:
+            if not self._remaining(job):
+                return
+            time.sleep(max(0, min(1, job['submitted'] + self.start_latency -
+                                  time.time())))
+        while not self._release(job):
+            time.sleep(POLL_INTERVAL)
+
+        threads = []
+        while True:
+            task_id = self._claim(job)
+            if task_id is None:
+                if not self._remaining(job):
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+            thread = threading.Thread(target=self._run_task,
+                                      args=(job, task_id))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def _claim(self, job):
+        """Mark the next queued task of the job as running, if a slot is
+        free, and return its index"""
+        with self.connect(immediate=True) as connection:
+            running = connection.execute(
+                "SELECT COUNT(*) FROM tasks WHERE state = 'R'").fetchone()[0]
+            if running >= self.slots:
+                return None
+            if job['max_running'] is not None:
+                running = connection.execute(
+                    "SELECT COUNT(*) FROM tasks WHERE state = 'R' AND "
+                    "job_id = ?", (job['id'],)).fetchone()[0]
+                if running >= job['max_running']:
+                    return None
+            row = connection.execute(
+                "SELECT task_id FROM tasks WHERE job_id = ? AND state = 'Q' "
+                "ORDER BY task_id LIMIT 1", (job['id'],)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE tasks SET state = 'R', start = ? WHERE job_id = ? "
+                "AND task_id = ?", (time.time(), job['id'], row[0]))
+            return row[0]
+
+    def _remaining(self, job):
+        with self.connect() as connection:
+            return connection.execute(
+                "SELECT COUNT(*) FROM tasks WHERE job_id = ? AND "
+                "state IN ('Q', 'H')", (job['id'],)).fetchone()[0]
+
+    def _release(self, job):
+        """Queue the held tasks of a job once the jobs it depends on have
+        finished, or delete the job, as Torque does, if one of those failed
+        or is gone
+
+        Returns
+        -------
+        released : bool
+            Whether the job is no longer held
+        """
+        with self.connect(immediate=True) as connection:
+            if not connection.execute(
+                    "SELECT COUNT(*) FROM tasks WHERE job_id = ? AND "
+                    "state = 'H'", (job['id'],)).fetchone()[0]:
+                return True
+            finished = True
+            for type_, depends_on in connection.execute(
+                    'SELECT type, depends_on FROM dependencies WHERE '
+                    'job_id = ?', (job['id'],)).fetchall():
+                tasks = connection.execute(
+                    'SELECT state, exit_code FROM tasks WHERE job_id = ?',
+                    (depends_on,)).fetchall()
+                failed = type_.startswith('afterok') and any(
+                    state == 'C' and exit_code for state, exit_code in tasks)
+                if not tasks or failed:
+                    for table, column in (('tasks', 'job_id'),
+                                          ('dependencies', 'job_id'),
+                                          ('jobs', 'id')):
+                        connection.execute(
+                            'DELETE FROM {} WHERE {} = ?'.format(
+                                table, column), (job['id'],))
+                    return True
+                if any(state != 'C' for state, _ in tasks):
+                    finished = False
+            if finished:
+                connection.execute(
+                    "UPDATE tasks SET state = 'Q' WHERE job_id = ? AND "
+                    "state = 'H'", (job['id'],))
+            return finished
+
+    def _run_task(self, job, task_id):
+        env = dict(os.environ, PBS_JOBID=self.format_job_id(
+            job['id'], job['array']), PBS_JOBNAME=job['name'],
+            PBS_O_WORKDIR=job['cwd'])
+        out, err = job['out'], job['err']
+        if job['array']:
+            env['PBS_ARRAYID'] = str(task_id)
+            out = '{}-{}'.format(out, task_id)
+            err = '{}-{}'.format(err, task_id)
+
+        with open(os.path.join(job['cwd'], out), 'w') as stdout, \
+                open(os.path.join(job['cwd'], err), 'w') as stderr:
+            process = subprocess.Popen(['bash', job['script']],
+                                       cwd=job['cwd'], env=env, stdout=stdout,
+                                       stderr=stderr, **NEW_SESSION)
+            with self.connect() as connection:
+                updated = connection.execute(
+                    "UPDATE tasks SET pid = ? WHERE job_id = ? AND "
+                    "task_id = ? AND state = 'R'",
+                    (process.pid, job['id'], task_id)).rowcount
+            if not updated:
+                # Deleted between being claimed and being started
+                os.killpg(process.pid, signal.SIGKILL)
+            exit_code = process.wait()
+
+        with self.connect() as connection:
+            # Tasks deleted while running keep the exit code of qdel
+            connection.execute(
+                "UPDATE tasks SET state = 'C', exit_code = ?, finish = ? "
+                "WHERE job_id = ? AND task_id = ? AND state = 'R'",
+                (exit_code, time.time(), job['id'], task_id))
+
+
+class _Transaction(object):
+    """Use a sqlite connection in a ``with`` block, in a transaction if
+    immediate, which is committed (or rolled back on errors) at the end
+    before the connection is closed"""
+
+    def __init__(self, connection, immediate=False):
+        self.connection = connection
+        self.immediate = immediate
+
+    def __enter__(self):
+        if self.immediate:
+            self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.immediate:
+                if exc_type is None:
+                    self.connection.execute('COMMIT')
+                else:
+                    self.connection.execute('ROLLBACK')
+        finally:
+            self.connection.close()
+
+
+def _parse_job_id(job_id):
+    """Split "12[3].fakeq" into (12, 3), and "12[].fakeq" or "12" into
+    (12, None)"""
+    job_id = str(job_id).split('.')[0]
+    job_id, _, task_id = job_id.partition('[')
+    task_id = task_id.rstrip(']')
+    return int(job_id), int(task_id) if task_id else None
+
+
+def _job_state(tasks):
+    """PBS state letter of a job from the states of its tasks"""
+    states = set(task['state'] for task in tasks)
+    if 'R' in states:
+        return 'R'
+    if 'Q' in states:
+        return 'Q'
+    if 'H' in states:
+        return 'H'
+    return 'C'
+
+
+def _exit_status(tasks):
+    """Exit status of a finished job: the first non-zero one of its tasks"""
+    exit_codes = [task['exit_code'] for task in tasks]
+    return next((code for code in exit_codes if code), 0)
+
+
+def _check_job_id(scheduler, job_id):
+    """Raise KeyError unless the job ID names a known job the way Torque
+    needs it, which only knows whole array jobs as "12[]" """
+    job, _ = scheduler.jobs([job_id])[0]
+    if job['array'] and '[' not in str(job_id):
+        raise KeyError(job_id)
+
+
+def _qstat_rows(scheduler, job_ids, expand_arrays):
+    """The job ID, name, state and exit status of each job (or task)"""
+    for job, tasks in scheduler.jobs(job_ids):
+        if job['array'] and expand_arrays:
+            for task in tasks:
+                yield (scheduler.format_job_id(job['id'],
+                                               task_id=task['task_id']),
+                       '{}-{}'.format(job['name'], task['task_id']),
+                       task['state'], task['exit_code'])
+        else:
+            state = _job_state(tasks)
+            yield (scheduler.format_job_id(job['id'], job['array']),
+                   job['name'], state,
+                   _exit_status(tasks) if state == 'C' else None)
+
+
+def qsub(scheduler, arguments):
+    sh_filename = arguments[-1]
+    sys.stdout.write(scheduler.submit(sh_filename) + '\n')
+    return 0
+
+
+def qstat(scheduler, arguments):
+    parser = argparse.ArgumentParser(prog='qstat')
+    parser.add_argument('-x', action='store_true', help='XML output')
+    parser.add_argument('-t', action='store_true',
+                        help='Show the tasks of array jobs')
+    parser.add_argument('job_ids', nargs='*')
+    args = parser.parse_args(arguments)
+
+    # Like Torque, report the jobs that are known even if some aren't
+    exit_code = 0
+    if args.job_ids:
+        rows = []
+        for job_id in args.job_ids:
+            try:
+                _check_job_id(scheduler, job_id)
+                rows.extend(_qstat_rows(scheduler, [job_id], args.t))
+            except KeyError:
+                sys.stderr.write('qstat: Unknown Job Id {}\n'.format(job_id))
+                exit_code = 153
+    else:
+        rows = list(_qstat_rows(scheduler, None, args.t))
+
+    user = getpass.getuser()
+    if args.x:
+        sys.stdout.write('<Data>')
+        for job_id, name, state, exit_status in rows:
+            sys.stdout.write(
+                '<Job><Job_Id>{}</Job_Id><Job_Name>{}</Job_Name>'
+                '<Job_Owner>{}@{}</Job_Owner><job_state>{}</job_state>'
+                '<queue>batch</queue>'.format(escape(job_id), escape(name),
+                                              escape(user), SERVER, state))
+            if exit_status is not None:
+                sys.stdout.write(
+                    '<exit_status>{}</exit_status>'.format(exit_status))
+            sys.stdout.write('</Job>')
+        sys.stdout.write('</Data>\n')
+    elif rows:
+        sys.stdout.write('{:<25} {:<16} {:<15} {:<8} S {:<5}\n'.format(
+            'Job ID', 'Name', 'User', 'Time Use', 'Queue'))
+        sys.stdout.write('{} {} {} {} - {}\n'.format(
+            '-' * 25, '-' * 16, '-' * 15, '-' * 8, '-' * 5))
+        for job_id, name, state, _ in rows:
+            sys.stdout.write('{:<25} {:<16} {:<15} {:<8} {} {:<5}\n'.format(
+                job_id, name[:16], user[:15], '0', state, 'batch'))
+    return exit_code
+
+
+def qdel(scheduler, arguments):
+    exit_code = 0
+    for job_id in arguments:
+        try:
+            _check_job_id(scheduler, job_id)
+            scheduler.delete(job_id)
+        except KeyError:
+            sys.stderr.write('qdel: Unknown Job Id {}\n'.format(job_id))
+            exit_code = 153
+    return exit_code
+
+
+def install(bin_dir, state_dir=None, slots=4, submit_latency=0,
+            start_latency=0, run_jobs=True):
+    """Write qsub, qstat and qdel executables of a fake scheduler
+
+    Parameters
+    ----------
+    bin_dir : str
+        Folder to write the executables to. Put it first on the PATH to use
+        the fake scheduler.
+    state_dir : str, optional
+        Folder of the scheduler's database. By default, bin_dir/state
+    slots, submit_latency, start_latency, run_jobs
+        Configuration of the scheduler, see FakeScheduler
+
+    Returns
+    -------
+    bin_dir : str
+        Absolute path of the folder of the executables
+    """
+    bin_dir = os.path.abspath(bin_dir)
+    if state_dir is None:
+        state_dir = os.path.join(bin_dir, 'state')
+    scheduler = FakeScheduler(state_dir, slots=slots,
+                              submit_latency=submit_latency,
+                              start_latency=start_latency,
+                              run_jobs=run_jobs)
+    environment = dict(scheduler.environment, PYTHONPATH='{}{}'.format(
+        PACKAGE_DIR, '${PYTHONPATH:+:$PYTHONPATH}'))
+
+    for command in COMMANDS:
+        filename = os.path.join(bin_dir, command)
+        with open(filename, 'w') as f:
+            f.write('#!/bin/sh\n')
+            for variable, value in sorted(environment.items()):
+                f.write('{0}="{1}"\nexport {0}\n'.format(variable, value))
+            f.write('exec "{}" -m qtools.fakeq {} "$@"\n'.format(
+                sys.executable, command))
+        os.chmod(filename, 0o755)
+    return bin_dir
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        sys.stderr.write('usage: python -m qtools.fakeq {qsub,qstat,qdel} '
+                         '[arguments]\n')
+        return 2
+    command, arguments = argv[0], argv[1:]
+    scheduler = FakeScheduler()
+
+    if command == '_run':
+        scheduler.run(arguments[0])
+        return 0
+
+    time.sleep(scheduler.submit_latency)
+    return {'qsub': qsub, 'qstat': qstat, 'qdel': qdel}[command](
+        scheduler, arguments)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Skip commands whose declared outputs are already up to date
+
+Like ``make``, a command whose output files all exist and are newer than
+all of its input files doesn't need to run again. Checking a hundred
+thousand outputs one ``stat`` at a time hammers a shared filesystem, so the
+folders of the outputs are each listed once with ``os.scandir`` instead,
+and modification times are only read for the files whose command has
+inputs.
+"""
+
+import itertools
+import os
+
+import six
+
+__author__ = 'Olga Botvinnik'
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+
+class _Entry(object):
+    """Stand-in for os.DirEntry where os.scandir is missing"""
+
+    def __init__(self, folder, name):
+        self.path = os.path.join(folder, name)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+class DirectoryListings(object):
+    """Files of folders, each listed once when first asked about
+
+    Listings are never refreshed, so only use one while the files aren't
+    changing, e.g. while choosing which commands to submit.
+    """
+
+    def __init__(self):
+        self._listings = {}
+
+    def listing(self, folder):
+        """Directory entry of each file of a folder, by name"""
+        if folder not in self._listings:
+            try:
+                if scandir is not None:
+                    listing = dict((entry.name, entry)
+                                   for entry in scandir(folder))
+                else:
+                    listing = dict((name, _Entry(folder, name))
+                                   for name in os.listdir(folder))
+            except OSError:
+                # Missing folders hold no files
+                listing = {}
+            self._listings[folder] = listing
+        return self._listings[folder]
+
+    def entry(self, path):
+        """Directory entry of a path, or None if it doesn't exist"""
+        folder, name = os.path.split(os.path.abspath(path))
+        return self.listing(folder).get(name)
+
+    def exists(self, path):
+        return self.entry(path) is not None
+
+    def up_to_date(self, outputs, inputs=()):
+        """Whether all of the outputs exist and are newer than the inputs
+
+        Commands without outputs are never up to date, and inputs which
+        don't exist are ignored.
+        """
+        if not outputs:
+            return False
+        entries = [self.entry(path) for path in outputs]
+        if any(entry is None for entry in entries):
+            return False
+        input_times = [entry.stat().st_mtime for entry in
+                       (self.entry(path) for path in inputs)
+                       if entry is not None]
+        if not input_times:
+            return True
+        return min(entry.stat().st_mtime for entry in entries) >= \
+            max(input_times)
+
+
+def _paths(paths):
+    """List of the paths of a command, which may be one path or None"""
+    if paths is None:
+        return []
+    if isinstance(paths, six.string_types):
+        return [paths]
+    return list(paths)
+
+
+class StaleCommands(object):
+    """The commands whose declared outputs are missing or out of date
+
+    Parameters
+    ----------
+    commands : iterable of str
+        Commands, read one at a time
+    outputs : iterable of str or list of str
+        Output file(s) of each command, in the same order
+    inputs : iterable of str or list of str, optional
+        Input file(s) of each command, in the same order
+
+    Attributes
+    ----------
+    n_skipped : int
+        Number of up to date commands skipped so far
+    indices : list of int
+        Index of each command kept so far among all the commands
+
+    Raises
+    ------
+    ValueError : while iterating, if there are more or fewer outputs or
+        inputs than commands
+    """
+
+    def __init__(self, commands, outputs, inputs=None):
+        self.commands = commands
+        self.outputs = outputs
+        self.inputs = inputs
+        self.n_skipped = 0
+        self.indices = []
+
+    def __iter__(self):
+        listings = DirectoryListings()
+        missing = object()
+        inputs = iter(itertools.repeat(None) if self.inputs is None
+                      else self.inputs)
+        for i, (command, outputs) in enumerate(six.moves.zip_longest(
+                self.commands, self.outputs, fillvalue=missing)):
+            command_inputs = next(inputs, missing)
+            if command is missing or outputs is missing or \
+                    command_inputs is missing:
+                raise ValueError('Got a different number of commands and '
+                                 'of their outputs or inputs')
+            if listings.up_to_date(_paths(outputs), _paths(command_inputs)):
+                self.n_skipped += 1
+                continue
+            self.indices.append(i)
+            yield command
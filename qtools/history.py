@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""Runtimes of past commands, to size the walltime and chunks of new jobs
+
+When a ``qtools.Submitter`` is given a ``history``, every command of the job
+is run through ``python -m qtools.history``, which records its runtime,
+exit code and peak memory in a sqlite database. Commands are grouped by a
+template, which replaces numbers and file paths with placeholders, so that
+``bedtools intersect -a sample_1.bed`` and ``bedtools intersect -a
+sample_2.bed`` share their history. New jobs can then ask for a walltime
+that fits their commands, pack them into chunks by their expected runtime,
+and choose between an array job and chunks of serial commands.
+"""
+
+import argparse
+import math
+import os
+import re
+import resource
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+import six
+
+from .database import connect
+from .planner import format_walltime, parse_walltime
+
+__author__ = 'Olga Botvinnik'
+
+# Database used when none is given
+DEFAULT_HISTORY = os.environ.get(
+    'QTOOLS_HISTORY', os.path.join(os.path.expanduser('~'), '.qtools',
+                                   'history.db'))
+
+# Walltime of commands nothing is known about
+DEFAULT_WALLTIME = '0:30:00'
+
+# How much longer than the expected runtime to ask for
+WALLTIME_MARGIN = 1.5
+
+# Shortest walltime to ask for, in seconds
+MIN_WALLTIME = 60
+
+# Commands typically shorter than this, in seconds, are better run in
+# chunks than each in its own array task
+SHORT_COMMAND_SECONDS = 300
+
+# Quantile of the past runtimes of a template used as its expected runtime
+RUNTIME_QUANTILE = 0.9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    template TEXT,
+    command TEXT,
+    job_name TEXT,
+    job_id TEXT,
+    host TEXT,
+    start REAL,
+    runtime REAL,
+    exit_code INTEGER,
+    max_rss_kb INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_template ON runs (template);
+CREATE INDEX IF NOT EXISTS runs_job_id ON runs (job_id);
+"""
+
+_NUMBER = re.compile(r'\d+')
+_PATH = re.compile(r'^[^\s]*(/|\.[A-Za-z][A-Za-z0-9]*$)[^\s]*$')
+_EXTENSION = re.compile(r'((\.[A-Za-z][A-Za-z0-9]*)+)$')
+
+
+def command_template(command):
+    """Normalised form of a command shared by runs on different inputs
+
+    Every file path becomes a placeholder of its extension and every other
+    number becomes "#", e.g. "samtools view -q 10 /data/s1.bam" becomes
+    "samtools view -q # <.bam>".
+    """
+    words = []
+    for word in str(command).split():
+        if _PATH.match(word):
+            extension = _EXTENSION.search(os.path.basename(word))
+            word = '<{}>'.format(extension.group(1) if extension else '')
+        else:
+            word = _NUMBER.sub('#', word)
+        words.append(word)
+    return ' '.join(words)
+
+
+class RuntimeHistory(object):
+    """Runtimes, exit codes and peak memory of past commands
+
+    Parameters
+    ----------
+    filename : str, optional
+        sqlite database of the history. Defaults to $QTOOLS_HISTORY, or
+        ~/.qtools/history.db
+    """
+
+    def __init__(self, filename=None):
+        self.filename = os.path.abspath(filename or DEFAULT_HISTORY)
+        folder = os.path.dirname(self.filename)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+        self._estimates = {}
+
+    def _connect(self):
+        return connect(self.filename)
+
+    def record(self, command, runtime, exit_code, max_rss_kb=None,
+               job_name=None, job_id=None, start=None):
+        """Add a run of a command to the history"""
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (command_template(command), command, job_name, job_id,
+                 socket.gethostname(), start, runtime, exit_code,
+                 max_rss_kb))
+
+    def runtimes(self, command, successful=True):
+        """Past runtimes of commands with the same template, in seconds"""
+        query = 'SELECT runtime FROM runs WHERE template = ?'
+        if successful:
+            query += ' AND exit_code = 0'
+        with self._connect() as connection:
+            return [row[0] for row in connection.execute(
+                query, (command_template(command),))]
+
+    def estimate(self, command):
+        """Expected runtime of a command, in seconds
+
+        Returns
+        -------
+        seconds : float or None
+            The 90th percentile of the successful past runtimes of the
+            command's template, or None if it has never been run
+        """
+        template = command_template(command)
+        if template not in self._estimates:
+            runtimes = sorted(self.runtimes(command))
+            if runtimes:
+                i = int(math.ceil(RUNTIME_QUANTILE * len(runtimes))) - 1
+                self._estimates[template] = runtimes[max(i, 0)]
+            else:
+                self._estimates[template] = None
+        return self._estimates[template]
+
+    def costs(self, commands):
+        """Expected runtime of each command, in seconds
+
+        Commands that have never been run are expected to take as long as
+        the median of the others, or DEFAULT_WALLTIME if none has been run.
+        """
+        estimates = [self.estimate(command) for command in commands]
+        known = sorted(e for e in estimates if e is not None)
+        if known:
+            default = known[len(known) // 2]
+        else:
+            default = parse_walltime(DEFAULT_WALLTIME)
+        return [default if e is None else e for e in estimates]
+
+    def suggest_walltime(self, commands, parallel=1):
+        """Walltime fitting the expected runtime of a job's commands
+
+        Parameters
+        ----------
+        commands : list of str
+            Commands of the job
+        parallel : int, optional
+            Number of the commands running at once, e.g. the number of
+            tasks of an array job, or ppn for a packed job
+
+        Returns
+        -------
+        walltime : str
+            WALLTIME_MARGIN times the expected runtime of the job, or
+            DEFAULT_WALLTIME if none of the commands has been run before
+        """
+        estimates = [self.estimate(command) for command in commands]
+        if not any(e is not None for e in estimates):
+            return DEFAULT_WALLTIME
+        costs = self.costs(commands)
+        seconds = max(max(costs), sum(costs) / float(max(parallel, 1)))
+        return format_walltime(max(MIN_WALLTIME, seconds * WALLTIME_MARGIN))
+
+    def is_short(self, commands):
+        """Whether the commands typically take less than
+        SHORT_COMMAND_SECONDS, so are better run in chunks than as an array
+        """
+        costs = sorted(self.costs(commands))
+        return bool(costs) and costs[len(costs) // 2] < SHORT_COMMAND_SECONDS
+
+    def job_summary(self, job_id):
+        """Runtime of a whole job, from the runs of its commands
+
+        Returns
+        -------
+        summary : dict
+            Number of 'commands' and how many 'failed', the 'runtime' from
+            the start of the first command to the end of the last, and the
+            largest 'max_rss_kb' of the commands
+        """
+        with self._connect() as connection:
+            n, failed, start, finish, max_rss = connection.execute(
+                'SELECT COUNT(*), SUM(exit_code != 0), MIN(start), '
+                'MAX(start + runtime), MAX(max_rss_kb) FROM runs '
+                # Also match the tasks of array jobs, e.g. 123[1].tscc-mgr
+                "WHERE job_id = ? OR job_id LIKE ? || '.%' "
+                "OR job_id LIKE ? || '[%'", (str(job_id),) * 3).fetchone()
+        return dict(commands=n, failed=failed or 0,
+                    runtime=finish - start if n else None,
+                    max_rss_kb=max_rss)
+
+
+def wrap_command(command, filename):
+    """Command line running a command and recording it in a history"""
+    return '{} -m qtools.history {} {}'.format(
+        sys.executable, six.moves.shlex_quote(filename),
+        six.moves.shlex_quote(str(command)))
+
+
+def run(command, filename=None):
+    """Run a shell command and record its runtime in a history
+
+    Returns
+    -------
+    exit_code : int
+        Exit code of the command
+    """
+    start = time.time()
+    exit_code = subprocess.call(command, shell=True, executable='/bin/bash')
+    runtime = time.time() - start
+    # Linux reports the peak resident memory in kilobytes
+    max_rss_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    job_id = os.environ.get('PBS_JOBID', os.environ.get(
+        'JOB_ID', os.environ.get('SLURM_JOB_ID')))
+    job_name = os.environ.get('PBS_JOBNAME', os.environ.get(
+        'JOB_NAME', os.environ.get('SLURM_JOB_NAME')))
+    try:
+        RuntimeHistory(filename).record(command, runtime, exit_code,
+                                        max_rss_kb, job_name=job_name,
+                                        job_id=job_id, start=start)
+    except sqlite3.Error as e:
+        # Losing a record is better than failing the command
+        sys.stderr.write('qtools could not record the runtime of {!r}: '
+                         '{}\n'.format(command, e))
+    return exit_code
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a shell command and record its runtime, exit code '
+                    'and peak memory in a qtools history')
+    parser.add_argument('history', help='sqlite database of the history')
+    parser.add_argument('command', help='Shell command to run')
+    args = parser.parse_args(argv)
+    return run(args.command, args.history)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
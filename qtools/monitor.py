@@ -0,0 +1,531 @@
+# -*- coding: utf-8 -*-
+"""Keep track of submitted jobs, and wait for them to finish
+
+Jobs can be followed in two ways. A ``JobMonitor`` asks the scheduler about
+all the jobs it tracks with one status query per poll. Scripts written with
+``qtools.Submitter(..., sentinels=True)`` instead leave a sentinel file with
+the exit code of every job or array task when it finishes, so waiting for
+them only lists a folder on the shared filesystem and never asks the
+scheduler at all.
+"""
+
+from collections import namedtuple
+from concurrent.futures import TimeoutError
+import os
+import threading
+import time
+
+import six
+
+from .backends import COMPLETED, HELD, QUEUED, RUNNING, QueryError, \
+    get_backend
+
+__author__ = 'Olga Botvinnik'
+
+# Seconds between checks of whether jobs have finished. Checks start often,
+# so short jobs are noticed quickly, and back off by BACKOFF each time up to
+# MAX_POLL_INTERVAL for long ones.
+MIN_POLL_INTERVAL = 0.1
+MAX_POLL_INTERVAL = 30
+BACKOFF = 1.5
+
+# Seconds for which the monitor shared by all waiters reuses the states of
+# the jobs, so many waiters make one status query between them
+SHARED_POLL_INTERVAL = 5
+
+# Suffix of the sentinel files left by finished tasks
+SENTINEL_SUFFIX = '.done'
+
+# Suffix of the files whose modification time is when a task started
+START_SUFFIX = '.start'
+
+# A task of a script which has finished, and its exit code
+FinishedTask = namedtuple('FinishedTask', ['sh_filename', 'task',
+                                           'exit_status'])
+
+
+class JobMonitor(object):
+    """Track the state of many jobs with one batched status call per poll
+
+    Asking the scheduler about every job separately hammers the head node.
+    The monitor instead asks once about all the jobs it tracks which haven't
+    finished (``qstat -x -t`` on PBS, ``qstat -xml`` on SGE, ``squeue`` on
+    SLURM), parses the output as it streams in, and answers every question
+    from that answer until it is ``poll_interval`` seconds old. Jobs which
+    have left the queue are taken to have completed. If the status command
+    fails, e.g. because the server is down, only the jobs it reported or
+    said it doesn't know are updated, and the rest keep their last state.
+
+    Parameters
+    ----------
+    queue_type : str, optional
+        Type of the queue of the jobs, as for qtools.Submitter. Defaults to
+        the queue type of the first Submitter tracked, or "PBS".
+    poll_interval : float, optional
+        Seconds for which the states of the jobs are reused
+
+    Example
+    -------
+    >>> monitor = JobMonitor(poll_interval=60)
+    >>> sub = qtools.Submitter(commands, 'job', array=True, monitor=monitor)
+    >>> monitor.state(sub.job_ids[0])
+    'running'
+    """
+
+    def __init__(self, queue_type=None, poll_interval=30):
+        self.queue_type = queue_type
+        self.poll_interval = poll_interval
+        self.last_poll = None
+        self.n_polls = 0
+
+        # State and exit status of each tracked job, and of each of its
+        # tasks, by job ID
+        self._states = {}
+        self._exit_statuses = {}
+        self._task_states = {}
+        # IDs of the tracked array jobs, which some schedulers name
+        # differently
+        self._arrays = set()
+        self._lock = threading.RLock()
+
+    @property
+    def backend(self):
+        return get_backend(self.queue_type or 'PBS')
+
+    def track(self, jobs):
+        """Start tracking jobs
+
+        Parameters
+        ----------
+        jobs : qtools.Submitter, str, (str, bool) or list of them
+            Job IDs, job IDs and whether each is an array job, or a
+            Submitter whose job IDs to track
+        """
+        if hasattr(jobs, 'job_ids'):
+            if self.queue_type is None:
+                self.queue_type = jobs.queue_type
+            jobs = jobs._submitted_jobs()
+        elif isinstance(jobs, six.string_types + six.integer_types +
+                        (tuple,)):
+            jobs = [jobs]
+        with self._lock:
+            for job in jobs:
+                job_id, array = job if isinstance(job, tuple) else (job,
+                                                                    False)
+                job_id = str(job_id)
+                if array:
+                    self._arrays.add(job_id)
+                if job_id not in self._states:
+                    self._states[job_id] = QUEUED
+                    self._task_states[job_id] = {}
+                    # Ask about the new jobs at the next query
+                    self.last_poll = None
+
+    def untrack(self, job_ids):
+        """Stop tracking jobs"""
+        with self._lock:
+            for job_id in job_ids:
+                for states in (self._states, self._exit_statuses,
+                               self._task_states):
+                    states.pop(str(job_id), None)
+                self._arrays.discard(str(job_id))
+
+    @property
+    def job_ids(self):
+        """IDs of all the tracked jobs"""
+        return list(self._states)
+
+    def unfinished(self):
+        """IDs of the tracked jobs which haven't completed"""
+        self.poll()
+        return [job_id for job_id, state in self._states.items()
+                if state != COMPLETED]
+
+    def poll(self, force=False):
+        """Ask the scheduler about the unfinished jobs, unless it was asked
+        less than poll_interval seconds ago
+
+        Parameters
+        ----------
+        force : bool, optional
+            Ask the scheduler even if the last answer is recent
+        """
+        with self._lock:
+            if not force and self.last_poll is not None and \
+                    time.time() - self.last_poll < self.poll_interval:
+                return
+            job_ids = [job_id for job_id, state in self._states.items()
+                       if state != COMPLETED]
+            self.last_poll = time.time()
+            if not job_ids:
+                return
+            self.n_polls += 1
+
+            arrays = [job_id for job_id in job_ids if job_id in self._arrays]
+            try:
+                statuses = self.backend.query(job_ids, arrays)
+                answered = set(job_ids)
+            except QueryError as e:
+                # Jobs left out of a failed query may still be queued
+                statuses = e.statuses
+                answered = set(e.unknown) | set(
+                    status.job_id for status in statuses)
+
+            tasks = dict((job_id, {}) for job_id in job_ids
+                         if job_id in answered)
+            exit_statuses = {}
+            for status in statuses:
+                if status.job_id not in tasks:
+                    continue
+                tasks[status.job_id][status.task_id] = status.state
+                if status.exit_status is not None and \
+                        not exit_statuses.get(status.job_id):
+                    # Keep the first failure of the job's tasks
+                    exit_statuses[status.job_id] = status.exit_status
+
+            for job_id, task_states in tasks.items():
+                self._task_states[job_id] = task_states
+                self._states[job_id] = _job_state(task_states.values())
+                if job_id in exit_statuses:
+                    self._exit_statuses[job_id] = exit_statuses[job_id]
+
+    def state(self, job_id):
+        """State of a job: 'queued', 'held', 'running' or 'completed'"""
+        self.poll()
+        return self._states[str(job_id)]
+
+    def states(self):
+        """State of every tracked job, by job ID"""
+        self.poll()
+        return dict(self._states)
+
+    def task_states(self, job_id):
+        """States of the tasks of a job, by task index (None for the whole
+        job), as last reported by the scheduler"""
+        self.poll()
+        return dict(self._task_states[str(job_id)])
+
+    def exit_status(self, job_id):
+        """Exit status of a completed job, the first non-zero one of its
+        tasks, or None if the scheduler didn't report it"""
+        self.poll()
+        return self._exit_statuses.get(str(job_id))
+
+    def is_done(self, job_id):
+        """Whether a job has completed"""
+        return self.state(job_id) == COMPLETED
+
+
+def _job_state(task_states):
+    """State of a job from the states of its tasks. Jobs without any tasks
+    in the queue have completed."""
+    task_states = set(task_states)
+    for state in (RUNNING, QUEUED, HELD):
+        if state in task_states:
+            return state
+    return COMPLETED
+
+
+_shared_monitors = {}
+_shared_monitors_lock = threading.Lock()
+
+
+def shared_monitor(queue_type):
+    """The JobMonitor of a queue type shared by everything waiting on jobs
+    in this process"""
+    key = queue_type.lower()
+    with _shared_monitors_lock:
+        if key not in _shared_monitors:
+            _shared_monitors[key] = JobMonitor(
+                queue_type, poll_interval=SHARED_POLL_INTERVAL)
+        return _shared_monitors[key]
+
+
+def job_exit_statuses(jobs, queue_type):
+    """Exit status of each job if all of them have finished, or None
+
+    The jobs are job IDs, or (job ID, whether it's an array job), and are
+    asked about through the monitor shared by all waiters, so they share
+    one status query per SHARED_POLL_INTERVAL.
+    """
+    monitor = shared_monitor(queue_type)
+    monitor.track(jobs)
+    job_ids = [job[0] if isinstance(job, tuple) else job for job in jobs]
+    if any(not monitor.is_done(job_id) for job_id in job_ids):
+        return None
+    return [monitor.exit_status(job_id) for job_id in job_ids]
+
+
+def read_sentinels(status_dir, n_tasks):
+    """Exit status of a job from the sentinel files its tasks left
+
+    Parameters
+    ----------
+    status_dir : str
+        Folder the tasks of the job write their sentinels to
+    n_tasks : int
+        Number of tasks of the job, 1 unless it's an array job
+
+    Returns
+    -------
+    exit_status : int or None
+        The first non-zero exit code of the tasks, 0 if all of them
+        succeeded, or None if some haven't finished
+    """
+    try:
+        names = [name for name in os.listdir(status_dir)
+                 if name.endswith(SENTINEL_SUFFIX)]
+    except OSError:
+        return None
+    if len(names) < n_tasks:
+        return None
+    exit_status = 0
+    for name in sorted(names, key=lambda name: int(
+            name[:-len(SENTINEL_SUFFIX)])):
+        with open(os.path.join(status_dir, name)) as f:
+            exit_code = int(f.read().strip() or 0)
+        if exit_code and not exit_status:
+            exit_status = exit_code
+    return exit_status
+
+
+def _intervals(max_interval):
+    """Seconds to sleep between checks, backing off up to max_interval"""
+    interval = MIN_POLL_INTERVAL
+    while True:
+        yield interval
+        interval = min(interval * BACKOFF, max_interval)
+
+
+def wait_for(check, timeout=None, max_interval=MAX_POLL_INTERVAL):
+    """Call check, backing off between calls, until it returns something
+
+    Parameters
+    ----------
+    check : callable
+        Returns None until whatever is waited for has happened
+    timeout : float, optional
+        Give up after this many seconds. By default, wait forever.
+    max_interval : float, optional
+        Most seconds between calls
+
+    Returns
+    -------
+    result
+        The first result of check which isn't None
+
+    Raises
+    ------
+    concurrent.futures.TimeoutError : if the timeout is up first
+    """
+    start = time.time()
+    for interval in _intervals(max_interval):
+        result = check()
+        if result is not None:
+            return result
+        if timeout is not None:
+            remaining = timeout - (time.time() - start)
+            if remaining <= 0:
+                raise TimeoutError('Jobs did not finish within {} '
+                                   'seconds'.format(timeout))
+            interval = min(interval, remaining)
+        time.sleep(interval)
+
+
+def wait_for_async(check, timeout=None, max_interval=MAX_POLL_INTERVAL,
+                   loop=None, blocking=False):
+    """Like wait_for, but return an asyncio future of the result
+
+    The checks are scheduled on the event loop, without a thread each, so
+    one process can wait on many groups of jobs at once.
+
+    Parameters
+    ----------
+    blocking : bool, optional
+        Whether check blocks, e.g. on a status query of the scheduler, in
+        which case each check runs in the default executor of the loop so
+        the other coroutines carry on meanwhile. Checks which only list
+        folders run on the loop itself.
+
+    Raises
+    ------
+    asyncio.TimeoutError : from the future, if the timeout is up first
+    """
+    import asyncio
+    if loop is None:
+        loop = _event_loop(asyncio)
+    if hasattr(loop, 'create_future'):
+        future = loop.create_future()
+    else:
+        # Python 3.4
+        future = asyncio.Future(loop=loop)
+    intervals = _intervals(max_interval)
+    deadline = None if timeout is None else loop.time() + timeout
+
+    def poll():
+        if future.done():
+            # Cancelled
+            return
+        if blocking:
+            loop.run_in_executor(None, check).add_done_callback(checked)
+            return
+        try:
+            result = check()
+        except Exception as e:
+            future.set_exception(e)
+            return
+        schedule(result)
+
+    def checked(pending):
+        if future.done():
+            return
+        if pending.cancelled():
+            future.cancel()
+        elif pending.exception() is not None:
+            future.set_exception(pending.exception())
+        else:
+            schedule(pending.result())
+
+    def schedule(result):
+        if result is not None:
+            future.set_result(result)
+            return
+        interval = next(intervals)
+        if deadline is not None:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                future.set_exception(asyncio.TimeoutError(
+                    'Jobs did not finish within {} seconds'.format(timeout)))
+                return
+            interval = min(interval, remaining)
+        loop.call_later(interval, poll)
+
+    loop.call_soon(poll)
+    return future
+
+
+def _event_loop(asyncio):
+    """The running event loop, or else the current one"""
+    try:
+        return asyncio.get_running_loop()
+    except (AttributeError, RuntimeError):
+        # Python < 3.7, or called outside of a coroutine
+        return asyncio.get_event_loop()
+
+
+def wait_all(jobs, timeout=None, queue_type=None):
+    """Block until all of these jobs, and every task of them, have finished
+
+    Parameters
+    ----------
+    jobs : list of qtools.Submitter, str or (str, bool)
+        Submitters, whose scripts are waited on through their sentinel files
+        if they were written with sentinels=True, or job IDs, or job IDs
+        and whether each is an array job, which are waited on with one
+        status query for all of them per poll
+    timeout : float, optional
+        Give up after this many seconds. By default, wait forever.
+    queue_type : str, optional
+        Queue type of the job IDs. By default, auto-detected from the
+        cluster we're on.
+
+    Returns
+    -------
+    exit_statuses : list
+        For each Submitter, the list of the exit statuses of its jobs, and
+        for each job ID, its exit status. Exit statuses are the first
+        non-zero exit code of the job's tasks, and None if the scheduler
+        didn't report it.
+
+    Raises
+    ------
+    concurrent.futures.TimeoutError : if the timeout is up first
+    """
+    if queue_type is None:
+        from .submitter import cluster_profile
+        queue_type = cluster_profile().queue_type or 'PBS'
+    jobs = list(jobs)
+    job_ids = [job if isinstance(job, tuple) else str(job)
+               for job in jobs if not hasattr(job, 'poll')]
+
+    def check():
+        results = {}
+        if job_ids:
+            statuses = job_exit_statuses(job_ids, queue_type)
+            if statuses is None:
+                return None
+            results.update(zip(job_ids, statuses))
+        exit_statuses = []
+        for job in jobs:
+            if hasattr(job, 'poll'):
+                statuses = job.poll()
+                if statuses is None:
+                    return None
+                exit_statuses.append(statuses)
+            else:
+                exit_statuses.append(results[
+                    job if isinstance(job, tuple) else str(job)])
+        return exit_statuses
+
+    return wait_for(check, timeout)
+
+
+def as_completed(jobs, timeout=None):
+    """Iterate over the tasks of jobs as they finish
+
+    The sentinel folders of the jobs are watched with
+    qtools.watch.DirectoryWatcher, so each task is reported as soon as its
+    sentinel file appears, while the rest of the array is still running,
+    without asking the scheduler.
+
+    Parameters
+    ----------
+    jobs : list of qtools.Submitter
+        Submitters written with sentinels=True
+    timeout : float, optional
+        Give up after this many seconds. By default, wait forever.
+
+    Yields
+    ------
+    finished : FinishedTask
+        Script, array task index (1 for jobs which aren't arrays) and exit
+        code of each task, in the order they finish
+
+    Raises
+    ------
+    ValueError : if a Submitter was written without sentinels
+    concurrent.futures.TimeoutError : if the timeout is up before all the
+        tasks have finished
+    """
+    from .watch import DirectoryWatcher
+
+    # Script and number of unreported tasks of each sentinel folder
+    scripts = {}
+    for job in jobs:
+        if not job.sentinels:
+            raise ValueError('{!r} was written without sentinels=True, so '
+                             'its tasks leave no trace when they '
+                             'finish'.format(job.job_name))
+        for sh_filename in job.sh_filenames:
+            status_dir = job._status_dir(sh_filename)
+            scripts[status_dir] = [sh_filename, job.n_tasks[sh_filename]]
+
+    start = time.time()
+    with DirectoryWatcher(scripts) as watcher:
+        while any(remaining for _, remaining in scripts.values()):
+            remaining = None
+            if timeout is not None:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise TimeoutError('Jobs did not finish within {} '
+                                       'seconds'.format(timeout))
+            for status_dir, names in sorted(watcher.wait(remaining).items()):
+                script = scripts[status_dir]
+                for name in names:
+                    if not name.endswith(SENTINEL_SUFFIX):
+                        continue
+                    with open(os.path.join(status_dir, name)) as f:
+                        exit_code = int(f.read().strip() or 0)
+                    script[1] -= 1
+                    yield FinishedTask(script[0], int(
+                        name[:-len(SENTINEL_SUFFIX)]), exit_code)
@@ -1,12 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Read the commands back out of scripts written by qtools.Submitter
 
+``commands_from_sh`` indexes the commands of one script. A ``ScriptIndex``
+keeps an index of every command of a folder of scripts in a sqlite
+database, so finding which script and array task ran a command is one
+query instead of a grep through tens of thousands of scripts. Scripts are
+parsed in a pool of processes, and only the scripts that changed since the
+last refresh are parsed again.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import fnmatch
+import os
 import re
+import shlex
+
+import six
+
+from .backends import BACKENDS, script_backend
+from .database import connect
+from .freshness import DirectoryListings
+from .submitter import MANIFEST_INDEX_WIDTH
+
+__author__ = 'Olga Botvinnik'
+
+# Lines of the scripts written by qtools.Submitter holding a command, which
+# are matched on bytes so that the script is read without decoding it
+ARRAY_COMMAND = re.compile(br'cmd\[(\d+)\]="(.*)"\s*$', re.DOTALL)
+PACKED_COMMAND = re.compile(br'run_command (\d+) (.*?)\s*$', re.DOTALL)
+MANIFEST_PATH = re.compile(br'(manifest|index)=(.*?)\s*$', re.DOTALL)
+MANIFEST_TASK = re.compile(br'task=\$\(\(\S+ \+ (\d+)\)\)')
+
+try:
+    OFFSET_TYPECODE = array('Q').typecode
+except ValueError:
+    # Python 2 has no unsigned long long arrays
+    OFFSET_TYPECODE = 'L'
+
+
+class CommandIndex(object):
+    """Commands of an array job script, read from disk when asked for
+
+    Only the task index and the byte offset of each command are held in
+    memory, as two arrays of integers, so indexing a script of hundreds of
+    thousands of commands takes a few megabytes.
+
+    Parameters
+    ----------
+    filename : str
+        File holding the commands: the script, or its manifest
+    offsets : array
+        Byte offset in the file of the line of each command
+    tasks : array or None
+        Task index of each command, in increasing order, or None if the
+        tasks are 1 to len(offsets)
+    kind : 'array', 'packed' or 'manifest'
+        Format of the lines of the commands
+    directives : list of str, optional
+        Comment lines of the script, including its scheduler directives
+
+    Example
+    -------
+    >>> commands = commands_from_sh('job.sh')
+    >>> commands[3]
+    'echo 3 > out3.txt'
+    """
+
+    def __init__(self, filename, offsets, tasks=None, kind='array',
+                 directives=()):
+        self.filename = filename
+        self.offsets = offsets
+        self.tasks = tasks
+        self.kind = kind
+        self.directives = list(directives)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, task):
+        return self._position(task) is not None
+
+    def __getitem__(self, task):
+        """Command of the array task of this index"""
+        position = self._position(task)
+        if position is None:
+            raise KeyError(task)
+        with open(self.filename, 'rb') as f:
+            return self._read(f, self.offsets[position])
+
+    def __iter__(self):
+        """Commands in the order of their tasks, read in one pass"""
+        with open(self.filename, 'rb') as f:
+            for offset in self.offsets:
+                yield self._read(f, offset)
+
+    def __repr__(self):
+        return '<CommandIndex of {} commands in {}>'.format(
+            len(self), self.filename)
+
+    def task_ids(self):
+        """Index of the array task of each command, in increasing order"""
+        if self.tasks is None:
+            return list(range(1, len(self.offsets) + 1))
+        return list(self.tasks)
+
+    def items(self):
+        """Array task index and command of each command"""
+        return zip(self.task_ids(), self)
+
+    def _position(self, task):
+        if not isinstance(task, six.integer_types):
+            return None
+        if self.tasks is None:
+            return task - 1 if 1 <= task <= len(self.offsets) else None
+        position = bisect_left(self.tasks, task)
+        if position < len(self.tasks) and self.tasks[position] == task:
+            return position
+        return None
+
+    def _read(self, f, offset):
+        f.seek(offset)
+        line = f.readline()
+        if self.kind == 'manifest':
+            return line.rstrip(b'\n').decode('utf-8')
+        if self.kind == 'packed':
+            quoted = PACKED_COMMAND.match(line).group(2).decode('utf-8')
+            return shlex.split(quoted)[0]
+        return ARRAY_COMMAND.match(line).group(2).decode('utf-8')
 
 
 def commands_from_sh(filename):
     """Parses an array job script for the individual per-processor commands
 
-    The index of the commands in the returned list is exactly the same as
-    the elements in the PBS submitter file
+    The script is streamed once, so it can hold any number of commands.
+    Scripts of array jobs (``cmd[i]="..."`` lines), of packed jobs
+    (``run_command i '...'`` lines) and of array jobs reading their commands
+    from a manifest are all understood.
 
     Parameters
     ----------
@@ -15,28 +147,307 @@ def commands_from_sh(filename):
 
     Returns
     -------
-    commands : list
-        A 501-element list of all commands, in order of the commands from the
-        file. For simplicity, the first element is 0 because BASH numbering
-        starts at 1, so every item is accessible for each command using the
-        same index as originally in the file.
+    commands : CommandIndex
+        The commands, by the same task index as in the file, so
+        ``commands[i]`` is the command of task i. The commands themselves
+        are only read from the file when asked for.
     """
+    tasks = array('l')
+    offsets = array(OFFSET_TYPECODE)
+    kind = 'array'
+    paths = {}
+    start = None
+    directives = []
 
-    # Up to 500 commands per submitted file for PBS
-    commands = list(range(501))
-
-    with open(filename) as f:
+    offset = 0
+    with open(filename, 'rb') as f:
         for line in f:
-            if line.startswith('cmd'):
-                left, right = line.split('=')
+            if line.startswith(b'cmd['):
+                matched = ARRAY_COMMAND.match(line)
+            elif line.startswith(b'run_command '):
+                matched = PACKED_COMMAND.match(line)
+                kind = 'packed'
+            else:
+                matched = None
+                if line.startswith(b'#'):
+                    # Comments of scripts from elsewhere may be in any
+                    # encoding
+                    directives.append(line.decode(
+                        'utf-8', 'replace').rstrip('\n'))
+                elif line.startswith((b'manifest=', b'index=')):
+                    name, path = MANIFEST_PATH.match(line).groups()
+                    paths[name] = path.decode('utf-8')
+                elif line.startswith(b'task='):
+                    # Only qtools's own manifest scripts set task= this way
+                    manifest_task = MANIFEST_TASK.match(line)
+                    if manifest_task is not None:
+                        start = int(manifest_task.group(1))
+            if matched is not None:
+                tasks.append(int(matched.group(1)))
+                offsets.append(offset)
+            offset += len(line)
+
+    if start is not None and b'manifest' in paths:
+        return _manifest_index(filename, directives, paths[b'manifest'],
+                               paths[b'index'], start)
+    return _index(filename, tasks, offsets, kind, directives)
+
+
+def _index(filename, tasks, offsets, kind, directives):
+    """CommandIndex of commands found in any task order"""
+    if any(tasks[i] >= tasks[i + 1] for i in range(len(tasks) - 1)):
+        pairs = sorted(dict(zip(tasks, offsets)).items())
+        tasks = array('l', (task for task, _ in pairs))
+        offsets = array(OFFSET_TYPECODE, (offset for _, offset in pairs))
+    if all(task == i + 1 for i, task in enumerate(tasks)):
+        # The usual tasks 1 to n need no array of their own
+        tasks = None
+    return CommandIndex(filename, offsets, tasks, kind, directives)
+
+
+def _manifest_index(filename, directives, manifest, index, start):
+    """CommandIndex of the commands of a script reading a manifest
+
+    Task i of the script runs the (start + i)-th line of the manifest,
+    whose byte offset is the (start + i)-th record of the manifest's index.
+    """
+    backend = script_backend(filename)
+    prefix = backend.directive_prefix + ' '
+    options = [line[len(prefix):] for line in directives
+               if line.startswith(prefix)]
+    tasks, _ = backend.read_array_options(
+        [option for option in options
+         if option.startswith(backend.array_option_prefixes)])
+
+    offsets = array(OFFSET_TYPECODE)
+    if tasks:
+        first = start + min(tasks) - 1
+        with open(index, 'rb') as f:
+            f.seek(first * MANIFEST_INDEX_WIDTH)
+            records = f.read((start + max(tasks) - first) *
+                             MANIFEST_INDEX_WIDTH)
+        for task in tasks:
+            position = (start + task - 1 - first) * MANIFEST_INDEX_WIDTH
+            offsets.append(int(records[position:position +
+                                       MANIFEST_INDEX_WIDTH]))
+    return _index(manifest, array('l', tasks), offsets, 'manifest',
+                  directives)
+
+
+# Where a command was found by a ScriptIndex: the absolute path of the
+# script, the array task running it, and the job name and other directive
+# options of the script
+ScriptCommand = namedtuple('ScriptCommand', ['sh_filename', 'task',
+                                             'job_name', 'resources'])
+
+# Scripts parsed by each process of the pool at a time
+PARSE_CHUNKSIZE = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scripts (
+    filename TEXT PRIMARY KEY,
+    mtime REAL,
+    job_name TEXT,
+    resources TEXT
+);
+CREATE TABLE IF NOT EXISTS commands (
+    command TEXT,
+    filename TEXT,
+    task INTEGER
+);
+CREATE INDEX IF NOT EXISTS commands_command ON commands (command);
+CREATE INDEX IF NOT EXISTS commands_filename ON commands (filename);
+"""
+
+
+def parse_script(sh_filename):
+    """Everything a ScriptIndex keeps about a script
+
+    Returns
+    -------
+    sh_filename : str
+    job_name : str or None
+        Name of the job, or None if the script has no directives of a
+        known queue type
+    resources : list of str
+        Directive options of the script other than its name and its array
+        range, e.g. "-l walltime=0:30:00"
+    commands : list of (int, str)
+        Array task index and command of each command
+    """
+    commands = commands_from_sh(sh_filename)
+    job_name = None
+    resources = []
+    for backend in BACKENDS.values():
+        prefix = backend.directive_prefix + ' '
+        options = [line[len(prefix):] for line in commands.directives
+                   if line.startswith(prefix)]
+        if not options:
+            continue
+        for option in options:
+            if option.startswith(backend.job_name_option_prefix):
+                job_name = option[len(backend.job_name_option_prefix):]
+            elif not option.startswith(backend.array_option_prefixes):
+                resources.append(option)
+        break
+    return sh_filename, job_name, resources, list(commands.items())
+
+
+def parse_scripts(sh_filenames, processes=None):
+    """Parse many scripts in a pool of processes
+
+    Parameters
+    ----------
+    sh_filenames : list of str
+    processes : int, optional
+        Number of processes. By default, one per processor. With 1, the
+        scripts are parsed in this process.
+
+    Returns
+    -------
+    parsed : iterator
+        The result of parse_script for each script, in the same order, or
+        None for the scripts which couldn't be parsed
+    """
+    if processes == 1:
+        return six.moves.map(_parse_script_or_none, sh_filenames)
+    return _pool_map(_parse_script_or_none, sh_filenames, processes)
+
+
+def _parse_script_or_none(sh_filename):
+    """parse_script, or None if it failed, e.g. on a script whose manifest
+    was removed, so one script can't stop a folder from being indexed"""
+    try:
+        return parse_script(sh_filename)
+    except Exception:
+        return None
+
+
+def _pool_map(function, items, processes):
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for result in executor.map(function, items,
+                                   chunksize=PARSE_CHUNKSIZE):
+            yield result
+
+
+class ScriptIndex(object):
+    """Persistent index of the commands of folders of scripts
+
+    Parameters
+    ----------
+    filename : str
+        sqlite database of the index, created if it doesn't exist
+
+    Example
+    -------
+    >>> index = ScriptIndex('scripts.db')
+    >>> index.refresh('jobs/')
+    >>> index.lookup('samtools index s1.bam')
+    [ScriptCommand(sh_filename='/home/me/jobs/index3.sh', task=17,
+                   job_name='index', resources=[...])]
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self):
+        return connect(self.filename)
+
+    def refresh(self, folder, pattern='*.sh', processes=None):
+        """Index the scripts of a folder which changed since the last
+        refresh, and forget those which were removed
+
+        Parameters
+        ----------
+        folder : str
+            Folder of the scripts
+        pattern : str, optional
+            Shell pattern of the names of the scripts
+        processes : int, optional
+            Number of processes parsing the scripts, see parse_scripts
+
+        Scripts which can't be parsed are left out of the index, and
+        tried again at the next refresh.
+
+        Returns
+        -------
+        n_parsed : int
+            Number of new or modified scripts parsed
+        n_removed : int
+            Number of scripts forgotten because they no longer exist
+        """
+        folder = os.path.abspath(folder)
+        mtimes = {}
+        for name, entry in DirectoryListings().listing(folder).items():
+            if fnmatch.fnmatch(name, pattern):
+                mtimes[os.path.join(folder, name)] = entry.stat().st_mtime
+
+        with self._connect() as connection:
+            indexed = dict(
+                (filename, mtime) for filename, mtime in connection.execute(
+                    'SELECT filename, mtime FROM scripts')
+                if os.path.dirname(filename) == folder)
+            removed = [filename for filename in indexed
+                       if filename not in mtimes]
+            changed = sorted(filename for filename, mtime in mtimes.items()
+                             if indexed.get(filename) != mtime)
+
+            n_parsed = len(changed)
+            connection.execute('BEGIN')
+            try:
+                for filename in removed:
+                    self._forget(connection, filename)
+                for filename, parsed in six.moves.zip(
+                        changed, parse_scripts(changed, processes)):
+                    self._forget(connection, filename)
+                    if parsed is None:
+                        n_parsed -= 1
+                        continue
+                    _, job_name, resources, commands = parsed
+                    connection.execute(
+                        'INSERT INTO scripts VALUES (?, ?, ?, ?)',
+                        (filename, mtimes[filename], job_name,
+                         '\n'.join(resources)))
+                    connection.executemany(
+                        'INSERT INTO commands VALUES (?, ?, ?)',
+                        ((command, filename, task)
+                         for task, command in commands))
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        return n_parsed, len(removed)
 
-                # Find the numbered index of the command
-                matched = re.search('\[(\d+)\]', left)
+    @staticmethod
+    def _forget(connection, filename):
+        connection.execute('DELETE FROM commands WHERE filename = ?',
+                           (filename,))
+        connection.execute('DELETE FROM scripts WHERE filename = ?',
+                           (filename,))
 
-                # Get the first item searched and turn it into an int
-                index = int(matched.groups()[0])
+    def lookup(self, command):
+        """Where a command was written
 
-                command = right.strip('""\n')
+        Returns
+        -------
+        found : list of ScriptCommand
+            Script and array task of every occurrence of the command
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                'SELECT commands.filename, task, job_name, resources '
+                'FROM commands JOIN scripts '
+                'ON commands.filename = scripts.filename '
+                'WHERE command = ? ORDER BY commands.filename, task',
+                (command,)).fetchall()
+        return [ScriptCommand(filename, task, job_name,
+                              resources.split('\n') if resources else [])
+                for filename, task, job_name, resources in rows]
 
-                commands[index] = command
-    return commands
+    def __len__(self):
+        """Number of commands in the index"""
+        with self._connect() as connection:
+            return connection.execute(
+                'SELECT COUNT(*) FROM commands').fetchone()[0]
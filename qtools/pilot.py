@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""Pilot jobs: long-lived workers pulling commands from a shared queue
+
+Instead of one array task or one chunk per command, a pilot submission
+writes all the commands to a sqlite work queue on the shared filesystem
+and submits a few worker jobs. Each worker claims the next pending command,
+runs it, records its exit code and claims another, until the queue is
+drained. Faster workers simply run more commands, and the scheduler only
+sees the workers.
+
+Each worker is started as::
+
+    python -m qtools.pilot queue.db --worker 3 --processes 16
+"""
+
+import argparse
+import itertools
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from .database import connect
+
+__author__ = 'Olga Botvinnik'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS commands (
+    id INTEGER PRIMARY KEY,
+    command TEXT,
+    state TEXT DEFAULT 'pending',
+    worker TEXT,
+    exit_code INTEGER,
+    start REAL,
+    finish REAL
+);
+CREATE INDEX IF NOT EXISTS commands_state ON commands (state, id);
+"""
+
+# Number of commands added to the queue per transaction
+FILL_BATCH_SIZE = 10000
+
+
+class WorkQueue(object):
+    """A queue of shell commands in a sqlite database
+
+    Claiming a command takes a write lock on the database, so each command
+    is run by exactly one worker. sqlite relies on the locks of the
+    filesystem, which must work across the nodes of the cluster.
+
+    Parameters
+    ----------
+    filename : str
+        Database of the queue, created if it doesn't exist
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self):
+        return connect(self.filename)
+
+    def fill(self, commands):
+        """Add commands to the end of the queue
+
+        Parameters
+        ----------
+        commands : iterable of str
+            Commands to add, read one batch at a time
+
+        Returns
+        -------
+        n_commands : int
+            Number of commands added
+        """
+        n_commands = 0
+        iterator = iter(commands)
+        with self._connect() as connection:
+            while True:
+                batch = [(str(command),) for command in
+                         itertools.islice(iterator, FILL_BATCH_SIZE)]
+                if not batch:
+                    return n_commands
+                connection.execute('BEGIN IMMEDIATE')
+                connection.executemany(
+                    'INSERT INTO commands (command) VALUES (?)', batch)
+                connection.execute('COMMIT')
+                n_commands += len(batch)
+
+    def claim(self, worker):
+        """Mark the next pending command as running by this worker
+
+        Returns
+        -------
+        command : (int, str) or None
+            Identifier and text of the command, or None if no commands are
+            pending
+        """
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute(
+                "SELECT id, command FROM commands WHERE state = 'pending' "
+                "ORDER BY id LIMIT 1").fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE commands SET state = 'running', worker = ?, "
+                    "start = ? WHERE id = ?", (worker, time.time(), row[0]))
+            connection.execute('COMMIT')
+            return row
+
+    def finish(self, command_id, exit_code):
+        """Record the exit code of a command run by a worker"""
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE commands SET state = 'done', exit_code = ?, "
+                "finish = ? WHERE id = ?",
+                (exit_code, time.time(), command_id))
+
+    def requeue_running(self):
+        """Put back commands claimed by workers that died before finishing
+
+        Only call this when no workers are running.
+
+        Returns
+        -------
+        n_commands : int
+            Number of commands put back in the queue
+        """
+        with self._connect() as connection:
+            return connection.execute(
+                "UPDATE commands SET state = 'pending', worker = NULL, "
+                "start = NULL WHERE state = 'running'").rowcount
+
+    def counts(self):
+        """Number of commands in each state
+
+        Returns
+        -------
+        counts : dict
+            Number of 'pending', 'running' and 'done' commands, and the number
+            of done commands which 'failed'
+        """
+        counts = dict(pending=0, running=0, done=0)
+        with self._connect() as connection:
+            for state, count in connection.execute(
+                    'SELECT state, COUNT(*) FROM commands GROUP BY state'):
+                counts[state] = count
+            counts['failed'] = connection.execute(
+                "SELECT COUNT(*) FROM commands WHERE state = 'done' AND "
+                "exit_code != 0").fetchone()[0]
+        return counts
+
+
+def work(filename, worker=None, processes=1):
+    """Run commands from the queue until it is drained
+
+    Parameters
+    ----------
+    filename : str
+        Database of the work queue
+    worker : str, optional
+        Name of this worker in the queue. Defaults to the hostname and
+        process ID.
+    processes : int, optional
+        Number of commands to run at once
+
+    Returns
+    -------
+    n_failed : int
+        Number of commands run by this worker which failed
+    """
+    if worker is None:
+        worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    queue = WorkQueue(filename)
+    failed = []
+
+    def run():
+        while True:
+            claimed = queue.claim(worker)
+            if claimed is None:
+                return
+            command_id, command = claimed
+            exit_code = subprocess.call(command, shell=True,
+                                        executable='/bin/bash')
+            queue.finish(command_id, exit_code)
+            if exit_code != 0:
+                failed.append(command_id)
+
+    threads = [threading.Thread(target=run) for _ in range(processes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(failed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run commands from a qtools work queue until it is '
+                    'drained')
+    parser.add_argument('queue', help='sqlite database of the work queue')
+    parser.add_argument('--worker', help='Name of this worker')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of commands to run at once')
+    args = parser.parse_args(argv)
+    n_failed = work(args.queue, args.worker, args.processes)
+    return 1 if n_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
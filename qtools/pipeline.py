@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Pipelines of jobs that depend on each other, submitted in one go
+
+Each job of a pipeline is a ``qtools.Submitter`` waiting for the jobs it
+depends on. The scheduler holds every job until the jobs before it have
+succeeded (``-W depend=afterok`` on PBS, ``-hold_jid`` on SGE,
+``--dependency=afterok`` on SLURM), so the whole pipeline is submitted at
+once instead of stage by stage. Jobs are submitted as soon as the jobs they
+depend on have their job IDs, so independent branches are submitted at the
+same time. Array jobs can also wait for other arrays task by task, so a
+task of the next stage starts as soon as the same task of this stage is done.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .monitor import wait_all
+from .submitter import Submitter
+
+__author__ = 'Olga Botvinnik'
+
+
+class Pipeline(object):
+    """Jobs that depend on each other
+
+    Parameters
+    ----------
+    dispatch_threads : int, optional
+        Maximum number of jobs submitted at once
+    **defaults
+        Keyword arguments of qtools.Submitter shared by all the jobs, e.g.
+        queue_type or walltime
+
+    Example
+    -------
+    >>> pipeline = Pipeline(walltime='2:00:00')
+    >>> pipeline.add('align', align_commands, array=True)
+    >>> pipeline.add('count', count_commands, after=['align'])
+    >>> pipeline.add('qc', qc_commands, after=['align'])
+    >>> pipeline.add('report', ['make_report'], after=['count', 'qc'])
+    >>> submitters = pipeline.submit()
+    """
+
+    def __init__(self, dispatch_threads=4, **defaults):
+        self.dispatch_threads = dispatch_threads
+        self.defaults = defaults
+        # Commands, dependencies and Submitter arguments of each job, by name
+        self.jobs = OrderedDict()
+        self.submitters = OrderedDict()
+
+    def add(self, name, commands, after=(), after_each=(), **kwargs):
+        """Add a job to the pipeline
+
+        Parameters
+        ----------
+        name : str
+            Name of the job, also its job name in the queue
+        commands : iterable of str
+            Commands of the job, as for qtools.Submitter
+        after : list of str, optional
+            Names of the jobs which must succeed before this one starts
+        after_each : list of str, optional
+            Names of array jobs of the same number of tasks, each task of
+            which must succeed before the same task of this array job starts,
+            see the wait_for_each of qtools.Submitter
+        **kwargs
+            Keyword arguments of qtools.Submitter for this job only
+
+        Returns
+        -------
+        name : str
+            Name of the job, to use in the ``after`` of later jobs
+
+        Raises
+        ------
+        ValueError : if there already is a job of this name
+        """
+        if name in self.jobs:
+            raise ValueError('There already is a job named {!r} in the '
+                             'pipeline'.format(name))
+        self.jobs[name] = dict(commands=commands, after=list(after),
+                               after_each=list(after_each), kwargs=kwargs)
+        return name
+
+    def order(self):
+        """Names of the jobs, each after all the jobs it depends on
+
+        Raises
+        ------
+        ValueError : if a job depends on an unknown job, or the jobs depend
+            on each other in a cycle
+        """
+        waiting = OrderedDict()
+        for name, job in self.jobs.items():
+            for dependency in job['after'] + job['after_each']:
+                if dependency not in self.jobs:
+                    raise ValueError('Job {!r} depends on unknown job '
+                                     '{!r}'.format(name, dependency))
+            waiting[name] = set(job['after'] + job['after_each'])
+
+        order = []
+        while waiting:
+            ready = [name for name, after in waiting.items() if not after]
+            if not ready:
+                raise ValueError('Jobs {} depend on each other in a '
+                                 'cycle'.format(', '.join(waiting)))
+            for name in ready:
+                del waiting[name]
+                order.append(name)
+            for after in waiting.values():
+                after.difference_update(ready)
+        return order
+
+    def submit(self):
+        """Submit all the jobs, each waiting for the jobs it depends on
+
+        Returns
+        -------
+        submitters : OrderedDict
+            qtools.Submitter of each job, by name, in the order the jobs
+            were added
+        """
+        order = self.order()
+        waiting = dict((name, set(self.jobs[name]['after'] +
+                                  self.jobs[name]['after_each']))
+                       for name in order)
+        submitters = {}
+
+        with ThreadPoolExecutor(max_workers=self.dispatch_threads) as \
+                executor:
+            submitting = {}
+            while waiting or submitting:
+                for name in order:
+                    if name in waiting and not waiting[name]:
+                        del waiting[name]
+                        future = executor.submit(self._submit_job, name,
+                                                 submitters)
+                        submitting[future] = name
+                done, _ = wait(submitting, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = submitting.pop(future)
+                    submitters[name] = future.result()
+                    for after in waiting.values():
+                        after.discard(name)
+
+        self.submitters = OrderedDict((name, submitters[name])
+                                      for name in self.jobs)
+        return self.submitters
+
+    def _submit_job(self, name, submitters):
+        job = self.jobs[name]
+        kwargs = dict(self.defaults, **job['kwargs'])
+        return Submitter(job['commands'], name, wait_for=[
+            submitters[dependency] for dependency in job['after']],
+            wait_for_each=[submitters[dependency]
+                           for dependency in job['after_each']], **kwargs)
+
+    def wait(self, timeout=None):
+        """Block until every submitted job has finished
+
+        Returns
+        -------
+        exit_statuses : OrderedDict
+            Exit statuses of the jobs of each Submitter, by name, as from
+            qtools.Submitter.poll
+        """
+        return OrderedDict(zip(self.submitters, wait_all(
+            list(self.submitters.values()), timeout)))
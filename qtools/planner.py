@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Pack commands of uneven cost into jobs that finish at the same time
+
+Splitting commands into chunks of equal counts makes the slowest chunk set
+the time the whole batch takes. Given an estimate of the cost of each
+command (in seconds, or anything proportional to it, such as the size of
+its input files), these functions pack the commands into jobs of about the
+same total cost instead.
+"""
+
+import heapq
+import math
+import os
+
+import six
+
+__author__ = 'Olga Botvinnik'
+
+PACKING_METHODS = ('lpt', 'ffd')
+
+
+def parse_walltime(walltime):
+    """Number of seconds of a walltime
+
+    Parameters
+    ----------
+    walltime : str
+        String of the format hours:minutes:seconds, or
+        days:hours:minutes:seconds, e.g. '1:30:24'
+
+    Returns
+    -------
+    seconds : int
+    """
+    seconds = 0
+    for multiplier, part in zip((1, 60, 3600, 86400),
+                                reversed(str(walltime).split(':'))):
+        seconds += multiplier * int(part)
+    return seconds
+
+
+def format_walltime(seconds):
+    """Walltime string hours:minutes:seconds of a number of seconds,
+    rounded up to the next second"""
+    seconds = int(math.ceil(seconds))
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60,
+                                     seconds % 60)
+
+
+def costs_from_inputs(inputs, seconds_per_byte=1.0):
+    """Estimate the cost of commands from the size of their input files
+
+    Parameters
+    ----------
+    inputs : list of str or list of lists of str
+        Input file(s) of each command
+    seconds_per_byte : float, optional
+        How long a command takes per byte of input
+
+    Returns
+    -------
+    costs : list of float
+        Estimated cost of each command. Missing files count as empty.
+    """
+    costs = []
+    for paths in inputs:
+        if isinstance(paths, six.string_types):
+            paths = [paths]
+        size = 0
+        for path in paths:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        costs.append(size * seconds_per_byte)
+    return costs
+
+
+def pack(costs, target=None, n_bins=None, method='lpt'):
+    """Pack commands into bins of about the same total cost
+
+    Parameters
+    ----------
+    costs : list of float
+        Estimated cost of each command
+    target : float, optional
+        Maximum total cost of a bin, e.g. the walltime in seconds. Commands
+        which cost more than this on their own get a bin to themselves.
+    n_bins : int, optional
+        Number of bins, for method='lpt'. By default, the fewest bins that
+        could hold all the commands within the target.
+    method : 'lpt' or 'ffd', optional
+        'lpt' (longest processing time first) fills a fixed number of bins,
+        each time adding the next most costly command to the least loaded
+        bin, which balances the bins best. 'ffd' (first fit decreasing)
+        adds each command, most costly first, to the first bin with room
+        for it within the target, which uses the fewest bins.
+
+    Returns
+    -------
+    bins : list of lists of int
+        Indices of the commands in each bin, in their original order. Bins
+        are ordered by their first command.
+
+    Raises
+    ------
+    ValueError : if neither target nor n_bins is given, or the method is
+        unknown
+    """
+    if method not in PACKING_METHODS:
+        raise ValueError('Unknown packing method {!r}, must be one of '
+                         '{}'.format(method, ', '.join(PACKING_METHODS)))
+    if target is None and (n_bins is None or method == 'ffd'):
+        raise ValueError('A target cost per bin is needed to pack with '
+                         '{!r}'.format(method))
+    if not len(costs):
+        return []
+
+    order = sorted(range(len(costs)), key=lambda i: costs[i], reverse=True)
+
+    if method == 'lpt':
+        if n_bins is not None:
+            bins, _ = _lpt(costs, order, max(1, min(n_bins, len(costs))))
+        else:
+            # Add bins until none is over the target, or over the most
+            # costly command, which can't be split up
+            limit = max(target, costs[order[0]])
+            oversized = [cost for cost in costs if cost > target]
+            n_bins = len(oversized) + int(math.ceil(
+                (sum(costs) - sum(oversized)) / float(target)))
+            n_bins = max(1, n_bins)
+            while True:
+                bins, max_load = _lpt(costs, order, min(n_bins, len(costs)))
+                if max_load <= limit or n_bins >= len(costs):
+                    break
+                n_bins += 1
+    else:
+        bins = []
+        remaining = []
+        for i in order:
+            for b, room in enumerate(remaining):
+                if costs[i] <= room:
+                    bins[b].append(i)
+                    remaining[b] -= costs[i]
+                    break
+            else:
+                bins.append([i])
+                remaining.append(target - costs[i])
+
+    bins = [sorted(indices) for indices in bins if indices]
+    return sorted(bins)
+
+
+def _lpt(costs, order, n_bins):
+    """Pack the commands, most costly first, into the least loaded of
+    n_bins bins, returning the bins and the largest load"""
+    # Heap of (load, bin index), so the least loaded bin is on top
+    loads = [(0, b) for b in range(n_bins)]
+    bins = [[] for _ in range(n_bins)]
+    for i in order:
+        load, b = heapq.heappop(loads)
+        bins[b].append(i)
+        heapq.heappush(loads, (load + costs[i], b))
+    return bins, max(load for load, _ in loads)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""Run straggling array tasks again elsewhere, and keep the first to finish
+
+A few tasks of a large array often land on overloaded nodes and take many
+times longer than the rest. Scripts written with ``sentinels=True`` leave
+a start file when each task starts and a sentinel file when it finishes,
+so their modification times give the runtime of every task, on the clock
+of the shared filesystem. Once most of the array has finished, a
+``Speculator`` reruns the tasks that have been running much longer than
+the median, as a copy of the script holding only those tasks. Whichever
+copy of a task finishes first leaves the sentinel file, and the other is
+then deleted from the queue.
+"""
+
+from collections import namedtuple
+import os
+
+from .freshness import DirectoryListings
+from .monitor import MAX_POLL_INTERVAL, SENTINEL_SUFFIX, START_SUFFIX, \
+    wait_for
+from .submitter import rerun_tasks, script_backend
+
+__author__ = 'Olga Botvinnik'
+
+# Start and finish time of a task, in seconds since the epoch on the clock
+# of the filesystem, or None if it hasn't started or finished
+TaskTimes = namedtuple('TaskTimes', ['start', 'finish'])
+
+# File touched to read the time of the filesystem's clock
+CLOCK_FILENAME = '.clock'
+
+
+def task_times(status_dir):
+    """Start and finish time of each task of a script, by task index, from
+    one listing of its sentinel folder"""
+    starts = {}
+    finishes = {}
+    listing = DirectoryListings().listing(status_dir)
+    for name, entry in listing.items():
+        for suffix, times in ((START_SUFFIX, starts),
+                              (SENTINEL_SUFFIX, finishes)):
+            task = name[:-len(suffix)]
+            if name.endswith(suffix) and task.isdigit():
+                times[int(task)] = entry.stat().st_mtime
+    return dict((task, TaskTimes(starts.get(task), finishes.get(task)))
+                for task in set(starts) | set(finishes))
+
+
+def filesystem_time(folder):
+    """Current time on the clock of the filesystem of a folder, which the
+    times of the tasks are on"""
+    clock = os.path.join(folder, CLOCK_FILENAME)
+    with open(clock, 'a'):
+        os.utime(clock, None)
+    return os.stat(clock).st_mtime
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def stragglers(times, n_tasks, now, factor=3, fraction=0.75,
+               min_seconds=0):
+    """Tasks running for much longer than the tasks which have finished
+
+    Parameters
+    ----------
+    times : dict
+        TaskTimes of each task, by task index, as from task_times
+    n_tasks : int
+        Number of tasks of the array
+    now : float
+        Current time, on the same clock as the times
+    factor : float, optional
+        Tasks running for more than this many times the median runtime of
+        the finished tasks are stragglers
+    fraction : float, optional
+        Only look for stragglers once this fraction of the tasks has
+        finished
+    min_seconds : float, optional
+        Tasks running for less than this many seconds are never stragglers
+
+    Returns
+    -------
+    tasks : list of int
+        Indices of the straggling tasks
+    """
+    runtimes = [finish - start for start, finish in times.values()
+                if start is not None and finish is not None]
+    if not runtimes or len(runtimes) < fraction * n_tasks:
+        return []
+    limit = max(factor * _median(runtimes), min_seconds)
+    return sorted(task for task, (start, finish) in times.items()
+                  if finish is None and start is not None and
+                  now - start > limit)
+
+
+class Speculator(object):
+    """Rerun the straggling tasks of a Submitter's jobs
+
+    Parameters
+    ----------
+    submitter : qtools.Submitter
+        Submitted job written with sentinels=True
+    factor, fraction, min_seconds : float, optional
+        When tasks are stragglers, see ``stragglers``
+
+    Example
+    -------
+    >>> sub = qtools.Submitter(commands, 'job', array=True, sentinels=True)
+    >>> Speculator(sub, factor=5, min_seconds=600).wait()
+    [0]
+
+    Both copies of a task run the same command, so only rerun commands
+    which can run twice at once, e.g. ones writing their outputs to a
+    temporary file and renaming it at the end. Each task is rerun at most
+    once.
+    """
+
+    def __init__(self, submitter, factor=3, fraction=0.75, min_seconds=60):
+        if not submitter.sentinels:
+            raise ValueError('{!r} was written without sentinels=True, so '
+                             'the runtimes of its tasks are unknown'.format(
+                                 submitter.job_name))
+        self.submitter = submitter
+        self.factor = factor
+        self.fraction = fraction
+        self.min_seconds = min_seconds
+        # Resubmission rerunning the stragglers of each script
+        self.resubmissions = dict((sh_filename, [])
+                                  for sh_filename in submitter.sh_filenames)
+        # Original and copy of each task which is running twice, as
+        # (job ID, task) of each, by script and task index
+        self._copies = dict((sh_filename, {})
+                            for sh_filename in submitter.sh_filenames)
+
+    def check(self):
+        """Rerun the new stragglers, and delete the copies of tasks which
+        finished elsewhere
+
+        Returns
+        -------
+        resubmissions : list of qtools.submitter.Resubmission
+            Reruns of the stragglers found in this check
+        """
+        resubmissions = []
+        job_ids = self.submitter.job_ids or \
+            [None] * len(self.submitter.sh_filenames)
+        for sh_filename, job_id in zip(self.submitter.sh_filenames, job_ids):
+            status_dir = self.submitter._status_dir(sh_filename)
+            times = task_times(status_dir)
+            backend = script_backend(sh_filename)
+            copies = self._copies[sh_filename]
+
+            for task, running in list(copies.items()):
+                if times.get(task, TaskTimes(None, None)).finish is None:
+                    continue
+                # The first copy to finish won, so stop the other
+                for copy_job_id, copy_task in running:
+                    if copy_job_id is not None:
+                        backend.cancel(copy_job_id, copy_task)
+                del copies[task]
+
+            speculated = set(task for resubmission in
+                             self.resubmissions[sh_filename]
+                             for task in resubmission.tasks)
+            late = [task for task in stragglers(
+                times, self.submitter.n_tasks[sh_filename],
+                filesystem_time(status_dir), self.factor, self.fraction,
+                self.min_seconds) if task not in speculated]
+            if not late:
+                continue
+
+            array = sh_filename in self.submitter.array_sh_filenames
+            resubmission = rerun_tasks(
+                sh_filename, late, 'speculative{}'.format(
+                    len(self.resubmissions[sh_filename]) + 1),
+                submit=self.submitter.submit)
+            self.resubmissions[sh_filename].append(resubmission)
+            resubmissions.append(resubmission)
+            sparse = backend.sparse_array_options(late) is not None
+            for i, task in enumerate(late):
+                # Arrays which can't be sparse run task i of the copy as
+                # the i-th straggler
+                copy_task = (task if sparse else i + 1) if array else None
+                copies[task] = [(job_id, task if array else None),
+                                (resubmission.job_id, copy_task)]
+        return resubmissions
+
+    def poll(self):
+        """Check for stragglers, and return the exit status of each job if
+        all of them have finished, else None, as qtools.Submitter.poll"""
+        self.check()
+        return self.submitter.poll()
+
+    def wait(self, timeout=None):
+        """Block until every task has finished, rerunning the stragglers
+
+        Returns
+        -------
+        exit_statuses : list
+            Exit status of each job, as from qtools.Submitter.poll
+
+        Raises
+        ------
+        concurrent.futures.TimeoutError : if the timeout is up first
+        """
+        exit_statuses = wait_for(self.poll, timeout, MAX_POLL_INTERVAL)
+        # Delete the copies of the last tasks to finish
+        self.check()
+        return exit_statuses
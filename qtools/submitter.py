@@ -1,20 +1,104 @@
 #!/usr/bin/env python
 
-from collections import defaultdict
-import re
-import subprocess
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import os
+import socket
 import sys
+import threading
 
 import six
 
+from .backends import get_backend, script_backend
+from .freshness import StaleCommands
+from .history import DEFAULT_WALLTIME, RuntimeHistory, wrap_command
+from .monitor import (COMPLETED, MAX_POLL_INTERVAL, SENTINEL_SUFFIX,
+                      START_SUFFIX, as_completed, job_exit_statuses,
+                      read_sentinels, shared_monitor, wait_for,
+                      wait_for_async)
+from .pilot import WorkQueue
+from .planner import pack, parse_walltime
+
 __author__ = 'Patrick Liu, Olga Botvinnik, Michael Lovci'
 
-HOSTNAME = subprocess.Popen('hostname', stdout=subprocess.PIPE,
-                            universal_newlines=True).communicate()[0].strip()
+ClusterProfile = namedtuple('ClusterProfile',
+                            ['hostname', 'queue_type', 'array'])
+
+# Environment variables that only exist on hosts of a given scheduler
+SCHEDULER_ENVIRONMENT_MARKERS = (('SGE_ROOT', 'SGE'),
+                                 ('SGE_CLUSTER_NAME', 'SGE'),
+                                 ('PBS_SERVER', 'PBS'),
+                                 ('PBS_DEFAULT', 'PBS'),
+                                 ('PBS_O_HOST', 'PBS'),
+                                 ('SLURM_CONF', 'SLURM'),
+                                 ('SLURM_CLUSTER_NAME', 'SLURM'))
+
+# Name of this host, kept for compatibility. Use cluster_profile().hostname
+# instead. Unlike the rest of the detection, it costs no subprocess.
+HOSTNAME = socket.gethostname()
+
+# Profile of the cluster, detected once per process
+_cluster_profile = None
+_cluster_profile_pid = None
+
+
+def cluster_profile():
+    """Detect which cluster and scheduler we're on
+
+    The detection only happens the first time this is called in a process,
+    and reads the hostname and the environment without starting any
+    subprocesses.
+
+    Returns
+    -------
+    profile : ClusterProfile
+        The hostname, the queue type ("PBS" on tscc, "SGE" on oolite, None
+        if unknown) and whether jobs should be arrays by default
+    """
+    global _cluster_profile, _cluster_profile_pid
+    if _cluster_profile is not None and _cluster_profile_pid == os.getpid():
+        return _cluster_profile
+
+    hostname = socket.gethostname()
+    if ("oolite" in hostname) or ("compute" in hostname):
+        queue_type, array = 'SGE', True
+    elif 'tscc' in hostname:
+        queue_type, array = 'PBS', False
+    else:
+        queue_type, array = None, None
+        for variable, marker_queue_type in SCHEDULER_ENVIRONMENT_MARKERS:
+            if variable in os.environ:
+                queue_type = marker_queue_type
+                array = queue_type == 'SGE'
+                break
+
+    _cluster_profile = ClusterProfile(hostname, queue_type, array)
+    _cluster_profile_pid = os.getpid()
+    return _cluster_profile
+
 
 # Maximum number of jobs in an array job
 MAX_ARRAY_JOBS = 500
 
+# Width in bytes of each record of a manifest's index: a zero-padded byte
+# offset and a newline
+MANIFEST_INDEX_WIDTH = 16
+
+
+def _batches(iterable, size):
+    """Yield successive lists of up to ``size`` items from ``iterable``
+
+    Only one list is held in memory at a time, so this works on generators
+    that are too long to build in full.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
 
 class Submitter(object):
     """
@@ -25,22 +109,33 @@ class Submitter(object):
                  array=None, nodes=1, ppn=1,
                  walltime='0:30:00', queue='home', account='yeo-group',
                  out=None, err=None, max_running=None, submit=True,
-                 chunksize=None):
+                 chunksize=None, dispatch_threads=None, manifest=False,
+                 packed=False, pilot=None, costs=None, packing='lpt',
+                 history=None, monitor=None, sentinels=False,
+                 wait_for=None, wait_for_each=None, outputs=None,
+                 inputs=None, max_queued=None):
         """Submit a job to the compute cluster
 
         Parameters
         ----------
-        commands : list of strings
+        commands : iterable of strings
             List of commands, each one will be on a separate line. If
             array=True, then each of these lines will be executed in a
             separate part of the array. Note: if there are more than 500
             elements in the list and array=True, then this will be broken up
             into several jobs, because there is a maximum of 500-element
-            array jobs on TSCC.
+            array jobs on TSCC. Any iterable, such as a generator, works
+            too: the commands are read only once and written out as they
+            come, holding at most one chunk (or 500 array commands) in
+            memory at a time.
         job_name : str
             Name of the job for the queue list
         queue_type : str, optional
-            Type of the submission queue, either "PBS" (tscc) or "SGE" (oolite)
+            Type of the submission queue, "PBS" (tscc), "SGE" (oolite),
+            "SLURM", "local" to run the job on a pool of ppn processes on
+            this machine, or any other backend registered with
+            qtools.backends.register_backend. If None, auto-detected from the
+            cluster we're on.
         sh : str, optional
             File to write that will be submitted to the queue. By default,
             the job name + .sh
@@ -54,7 +149,9 @@ class Submitter(object):
             is 16.
         walltime : str, optional
             String of the format hours:minutes:seconds, e.g. '1:30:24' will
-            submit a job for 1 hour, 30 minutes, and 24 seconds.
+            submit a job for 1 hour, 30 minutes, and 24 seconds. 'auto'
+            picks a walltime from the past runtimes of the commands in the
+            history.
         queue : str, optional
             Name of the queue, e.g. "home" for home-yeo or "glean" for glean
         account : str, optional
@@ -77,7 +174,100 @@ class Submitter(object):
             individually don't take that long, so you don't want to submit
             individual 1-min jobs because that messes up the scheduler, but
             instead you can submit a few jobs that each have ~10 serial
-            commands that you can do in a row.
+            commands that you can do in a row. 'auto' runs the commands in
+            chunks packed by their past runtimes in the history if they
+            typically take less than 5 minutes, and as an array job
+            otherwise.
+        dispatch_threads : int, optional
+            When the commands are split into several scripts, either by
+            ``chunksize`` or because an array job has more than
+            MAX_ARRAY_JOBS commands, submit up to this many scripts to the
+            queue at once. By default, the scripts are submitted one after
+            another.
+        manifest : bool, optional
+            Only applicable when array=True. If True, write all the commands
+            once to a shared manifest file (sh_file.commands) with a
+            fixed-width index of byte offsets (sh_file.index), instead of
+            writing every command into the script. Each task then reads only
+            its own command, so the script and the start-up time of each
+            task stay the same size no matter how many commands there are.
+            Arrays of more than MAX_ARRAY_JOBS commands share the manifest.
+        packed : bool, optional
+            Only applicable when array=False. If True, run up to ppn of the
+            commands at once within the job, like ``xargs -P``, instead of
+            one after the other, and write the exit code of each command to
+            sh_file.exitcodes. The job fails if any of the commands fails.
+            Combined with chunksize, each chunk fills its processors.
+        pilot : int, optional
+            If specified, write the commands to a sqlite work queue
+            (sh_file.queue.db) and submit an array job of this many workers
+            instead. Each worker runs up to ppn commands at a time, pulling
+            the next command from the queue as soon as one finishes, until
+            the queue is drained. This suits many short commands of uneven
+            length: faster workers take more of the work, and the scheduler
+            only sees the workers. The queue must be on a filesystem whose
+            locks work across nodes.
+        costs : list of float or 'history', optional
+            Estimated seconds each command takes, e.g. from
+            qtools.planner.costs_from_inputs, or 'history' to use the past
+            runtimes of the commands in the history. If specified, the
+            commands are packed into as few chunks as fit within the
+            walltime (times ppn if packed=True) instead of into chunks of
+            chunksize commands, so that the chunks finish at about the same
+            time. The commands are then read into memory.
+        packing : 'lpt' or 'ffd', optional
+            How to pack the commands when costs are given, see
+            qtools.planner.pack. 'lpt' (default) balances the chunks best,
+            'ffd' uses the fewest chunks.
+        history : str or qtools.history.RuntimeHistory, optional
+            Runtime history database. If specified, every command records
+            its runtime, exit code and peak memory in it when it runs. The
+            history of 'auto' walltimes and chunksizes and of
+            costs='history' defaults to ~/.qtools/history.db.
+        monitor : qtools.monitor.JobMonitor, optional
+            If specified, the monitor tracks the submitted jobs, so their
+            states can be followed with one status query for all of them.
+        sentinels : bool, optional
+            If True, every job (and every task of an array job) writes its
+            exit code to a sentinel file in sh_file.status when it finishes,
+            so ``wait``, ``poll`` and ``completed`` only look at the
+            filesystem instead of asking the scheduler. Jobs that the
+            scheduler deletes because a job they depend on failed never
+            leave a sentinel.
+        wait_for : list of str or qtools.Submitter, optional
+            Jobs to wait for: the job is held in the queue until all of them
+            have succeeded (finished, on SGE), and never runs if one of them
+            fails. Submitters stand for all of their jobs. See also
+            ``add_wait`` and qtools.pipeline.Pipeline.
+        wait_for_each : list of qtools.Submitter or str, optional
+            Only applicable when array=True. Array jobs of the same number of
+            tasks to wait for task by task: task i of this job waits only
+            for task i of each of them, so the stages of a pipeline overlap
+            instead of waiting for the slowest task. SGE (-hold_jid_ad) and
+            SLURM (aftercorr) hold the tasks in the queue. Other schedulers,
+            such as PBS, have no such dependency, so each task starts right
+            away and waits for the sentinel files of the tasks it depends
+            on, which must be Submitters written with sentinels=True.
+        outputs : iterable of str or list of str, optional
+            Output file(s) of each command, in the same order as the
+            commands. If specified, commands whose outputs all exist and are
+            newer than their inputs are skipped, like ``make``, so rerunning
+            a half-finished batch only submits the remaining work. The
+            folders of the outputs are each listed once instead of checking
+            every file, see qtools.freshness. If all the commands are up to
+            date, nothing is written or submitted.
+        inputs : iterable of str or list of str, optional
+            Only applicable with outputs. Input file(s) of each command, in
+            the same order as the commands.
+        max_queued : int, optional
+            When the commands are split into several scripts, keep at most
+            this many of their tasks (each job without an array counts as
+            one) queued or running at once, for schedulers limiting how many
+            jobs a user may have queued. The scripts which don't fit yet are
+            submitted from a background thread as the earlier ones finish,
+            as told by their sentinel files with sentinels=True, and by the
+            scheduler otherwise, so ``job_ids`` grows until all of them are
+            in. The process stays alive until then.
 
         Returns
         -------
@@ -86,7 +276,9 @@ class Submitter(object):
 
         Raises
         ------
-        ValueError : if more than 16 processors per node provided
+        ValueError : if more processors per node are provided than the queue
+            allows (16 on PBS), the queue type is unknown, or a script has
+            more tasks than max_queued
 
         """
         self.additional_resources = defaultdict(list)
@@ -94,13 +286,13 @@ class Submitter(object):
         self._array = array
         self._queue_type = queue_type
 
-        if self.queue_type == 'SGE':
-            self.add_resource("-l", 'bigmem')
-            self.add_resource("-l", 'h_vmem=16G')
+        for kw, value in self.backend.default_resources:
+            self.add_resource(kw, value)
 
-        if self.queue_type == 'PBS' and ppn > 16:
-            raise ValueError('Cannot have more than 16 processors per node ('
-                             'ppn). Tried to provide {}'.format(ppn))
+        max_ppn = self.backend.max_ppn
+        if max_ppn is not None and ppn > max_ppn:
+            raise ValueError('Cannot have more than {} processors per node ('
+                             'ppn). Tried to provide {}'.format(max_ppn, ppn))
 
         self.sh_filename = job_name + '.sh' if sh is None \
             else sh
@@ -108,6 +300,8 @@ class Submitter(object):
         if isinstance(commands, six.string_types):
             commands = [commands]
         self.commands = commands
+        # Number of commands, known once they have all been written
+        self.n_commands = None
         self.job_name = job_name
         self.nodes = nodes
         self.ppn = ppn
@@ -121,28 +315,101 @@ class Submitter(object):
         self.max_running = max_running
         self.submit = submit
         self.chunksize = chunksize
+        self.dispatch_threads = dispatch_threads
+        self.manifest = manifest
+        self.packed = packed
+        self.pilot = pilot
+        self.costs = costs
+        self.packing = packing
+        if isinstance(history, six.string_types):
+            history = RuntimeHistory(history)
+        self.history = history
+        self.manifest_filename = self.sh_filename + '.commands'
+        self.index_filename = self.sh_filename + '.index'
+        self.exit_codes_filename = self.sh_filename + '.exitcodes'
+        self.queue_filename = self.sh_filename + '.queue.db'
 
-        if self.chunksize is None:
-            self.job()
-        else:
-            chunks = len(self.commands) / self.chunksize
-            if len(self.commands) % self.chunksize != 0:
-                chunks += 1
-            for chunk in range(chunks):
-                start = chunk * chunksize
-                stop = (chunk + 1) * chunksize
-                subset = commands[start:stop]
-                #     six.print_(start, stop, len(subset))
-                name = '{name}{chunk}'.format(name=self.job_name, chunk=chunk)
-                sh = self.sh_filename.replace('.sh', '-{}.sh'.format(chunk))
-                out = self.out_filename.replace('.sh', '-{}.sh'.format(chunk))
-                err = self.err_filename.replace('.sh', '-{}.sh'.format(chunk))
-                Submitter(subset, name, queue_type=self.queue_type, sh=sh,
-                          array=self.array, nodes=self.nodes, ppn=self.ppn,
-                          walltime=self.walltime, queue=self.queue,
-                          account=self.account, out=out, err=err,
-                          max_running=self.max_running, submit=self.submit,
-                          chunksize=None)
+        self._record_history = history is not None
+
+        # Job ID of each job to wait for, and whether it's an array job
+        self.wait_for = []
+        for job in wait_for or ():
+            self.add_wait(job)
+
+        # Job ID, sentinel folder and number of tasks of each script of
+        # each array job to wait for task by task
+        self.wait_for_each = [self._array_parts(job)
+                              for job in wait_for_each or ()]
+
+        self.sentinels = sentinels
+        # Number of tasks of each script
+        self.n_tasks = {}
+        # Scripts of array jobs, which some schedulers depend on differently
+        self.array_sh_filenames = set()
+        # Exit status of each script whose sentinels are all in
+        self._finished = {}
+
+        # Identifiers of every job submitted for these commands, in the same
+        # order as the commands
+        self.job_ids = []
+
+        # Scripts written for the commands
+        self.sh_filenames = []
+
+        self.max_queued = max_queued
+        self._monitor = monitor
+        # Scripts waiting for room in the queue, and why submitting them
+        # failed, if it did
+        self._pending = []
+        self._dispatch_error = None
+
+        # Drop the commands whose declared outputs are up to date
+        self._stale = None
+        if outputs is not None:
+            self._stale = StaleCommands(self.commands, outputs, inputs)
+            commands = iter(self._stale)
+            first = list(itertools.islice(commands, 1))
+            if not first:
+                self.sh_filenames = []
+                sys.stderr.write('All {} commands are up to date, nothing '
+                                 'to submit.\n'.format(self.n_skipped))
+                return
+            self.commands = itertools.chain(first, commands)
+            if self.costs is not None and not isinstance(
+                    self.costs, six.string_types):
+                self.commands = list(self.commands)
+                if len(self.costs) != len(self.commands) + self.n_skipped:
+                    raise ValueError('Got {} costs for {} commands'.format(
+                        len(self.costs),
+                        len(self.commands) + self.n_skipped))
+                self.costs = [self.costs[i] for i in self._stale.indices]
+
+        if self.chunksize == 'auto':
+            self.commands = list(self.commands)
+            self.chunksize = None
+            if self.runtime_history.is_short(self.commands):
+                self._array = False
+                self.costs = 'history'
+            else:
+                self._array = True
+        if isinstance(self.costs, six.string_types) \
+                and self.costs == 'history':
+            self.commands = list(self.commands)
+            self.costs = self.runtime_history.costs(self.commands)
+
+        self._write()
+
+        if self.n_skipped:
+            sys.stderr.write('Skipped {} commands whose outputs are up to '
+                             'date.\n'.format(self.n_skipped))
+        if monitor is not None and self.job_ids:
+            monitor.track(self)
+
+    @property
+    def n_skipped(self):
+        """Number of commands skipped because their outputs are up to
+        date"""
+        return 0 if self._stale is None else self._stale.n_skipped
 
     @property
     def array(self):
@@ -150,10 +417,7 @@ class Submitter(object):
         if self._array is not None:
             # self._array is the user-supplied whether or not to use the array
             return self._array
-        elif ("oolite" in HOSTNAME) or ("compute" in HOSTNAME):
-            return True
-        elif 'tscc' in HOSTNAME:
-            return False
+        return cluster_profile().array
 
     @property
     def queue_type(self):
@@ -163,42 +427,206 @@ class Submitter(object):
         if self._queue_type is not None:
             # self._queue_type is the user-supplied queue type
             return self._queue_type
-        elif ("oolite" in HOSTNAME) or ("compute" in HOSTNAME):
-            return 'SGE'
-        elif 'tscc' in HOSTNAME:
-            return 'PBS'
+        return cluster_profile().queue_type
 
     @property
     def number_jobs(self):
         """Get the number of jobs in the array"""
         if self.array:
+            if self.n_commands is not None:
+                return self.n_commands
             return len(self.commands)
         else:
             return 1
 
+    @property
+    def runtime_history(self):
+        """History of the runtimes of past commands"""
+        if self.history is None:
+            self.history = RuntimeHistory()
+            # Only read this default history, don't record in it
+            self._record_history = False
+        return self.history
+
+    @property
+    def backend(self):
+        """Scheduler backend writing and submitting scripts of this
+        queue type"""
+        return get_backend(self.queue_type)
+
     @property
     def queue_param_prefix(self):
-        if self.queue_type == 'PBS':
-            return '#PBS'
-        elif self.queue_type == 'SGE':
-            return '#$'
+        return self.backend.directive_prefix
 
     @property
     def array_job_identifier(self):
-        if self.queue_type == 'PBS':
-            return "$PBS_ARRAYID"
-        elif self.queue_type == 'SGE':
-            return "$SGE_TASK_ID"
+        return '$' + self.backend.array_task_id
+
+    @property
+    def array_parts(self):
+        """Job ID (None until submitted), sentinel folder (None without
+        sentinels) and number of tasks of each script, as array jobs
+        waiting for these ones task by task need them"""
+        if not self.dispatched:
+            raise ValueError('Cannot wait for {!r} before all of its scripts '
+                             'are submitted'.format(self.job_name))
+        job_ids = self.job_ids or [None] * len(self.sh_filenames)
+        return [(job_id, self._status_dir(sh_filename) if self.sentinels
+                 else None, self.n_tasks.get(sh_filename))
+                for job_id, sh_filename in zip(job_ids, self.sh_filenames)]
+
+    @staticmethod
+    def _array_parts(job):
+        """Parts of an array job to wait for task by task, from a
+        Submitter, a job ID, or parts already"""
+        if hasattr(job, 'array_parts'):
+            if not job.array:
+                raise ValueError('Can only wait for the tasks of array '
+                                 'jobs, but {!r} is not one'.format(
+                                     job.job_name))
+            return job.array_parts
+        if isinstance(job, list):
+            return job
+        return [(str(job), None, None)]
+
+    @property
+    def dispatched(self):
+        """Whether every script has been submitted, when some wait for room
+        in the queue because of max_queued
+
+        Raises
+        ------
+        Exception : whatever submitting the waiting scripts raised
+        """
+        if self._dispatch_error is not None:
+            raise self._dispatch_error
+        return not self._pending
+
+    @property
+    def dependencies(self):
+        """Job ID of each submitted job, and whether it's an array job, as
+        other jobs waiting for these ones need them"""
+        if not self.dispatched:
+            raise ValueError('Cannot wait for {!r} before all of its scripts '
+                             'are submitted'.format(self.job_name))
+        return self._submitted_jobs()
+
+    def _submitted_jobs(self):
+        """Job ID of each script submitted so far, and whether it's an
+        array job"""
+        return [(str(job_id), sh_filename in self.array_sh_filenames)
+                for job_id, sh_filename in zip(list(self.job_ids),
+                                               self.sh_filenames)]
 
     def add_wait(self, wait_ID):
         """
         Add passed job ID to list of jobs for this job submission to
-        wait for. Can be called multiple times.
+        wait for. Can be called multiple times. The jobs to wait for are
+        written into the script, so call ``job`` to (re)write and submit it
+        afterwards, e.g. after creating the Submitter with submit=False.
+
+        Parameters
+        ----------
+        wait_ID : str, (str, bool) or qtools.Submitter
+            Job ID, job ID and whether it is an array job, or a Submitter
+            whose jobs to all wait for
+        """
+        if hasattr(wait_ID, 'dependencies'):
+            self.wait_for.extend(wait_ID.dependencies)
+        elif isinstance(wait_ID, tuple):
+            job_id, array = wait_ID
+            self.wait_for.append((str(job_id), bool(array)))
+        else:
+            self.wait_for.append((str(wait_ID), False))
+
+    def poll(self):
+        """Exit status of each job if all of them have finished, else None
+
+        Like ``subprocess.Popen.poll``, this never blocks. With
+        sentinels=True, it counts the sentinel files of the scripts;
+        otherwise it asks the scheduler, sharing one status query with
+        everything else waiting in this process.
+
+        Returns
+        -------
+        exit_statuses : list or None
+            The first non-zero exit code of the tasks of each job (0 if all
+            succeeded, None if the scheduler didn't report it), in the
+            same order as ``sh_filenames``. None while scripts are still
+            waiting for room in the queue.
+        """
+        if not self.dispatched:
+            return None
+        if not self.sentinels:
+            return job_exit_statuses(self.dependencies, self.queue_type)
+        for sh_filename in self.sh_filenames:
+            if sh_filename in self._finished:
+                continue
+            exit_status = read_sentinels(self._status_dir(sh_filename),
+                                         self.n_tasks[sh_filename])
+            if exit_status is None:
+                return None
+            self._finished[sh_filename] = exit_status
+        return [self._finished[sh_filename]
+                for sh_filename in self.sh_filenames]
+
+    def wait(self, timeout=None):
+        """Block until every job, and every task of them, has finished
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Give up after this many seconds. By default, wait forever.
+
+        Returns
+        -------
+        exit_statuses : list
+            Exit status of each job, as from ``poll``
+
+        Raises
+        ------
+        concurrent.futures.TimeoutError : if the timeout is up first
         """
-        if 'wait_for' not in self.data:
-            self.data['wait_for'] = []
+        return wait_for(self.poll, timeout)
+
+    def completed(self, timeout=None, loop=None):
+        """asyncio future of the exit statuses of the jobs, done once every
+        job has finished, e.g. ``await submitter.completed()``
 
-        self.data['wait_for'].append(str(wait_ID))
+        Waiting runs on the event loop without a thread per Submitter, so
+        one process can wait on many Submitters at once, e.g. with
+        ``asyncio.gather``. Without sentinels, each status query of the
+        scheduler runs in the loop's default executor instead, so it
+        doesn't hold up the loop.
+        """
+        return wait_for_async(self.poll, timeout, loop=loop,
+                              blocking=not self.sentinels)
+
+    def as_completed(self, timeout=None):
+        """Iterate over the tasks of the jobs as they finish, see
+        qtools.monitor.as_completed
+
+        Only applicable with sentinels=True.
+        """
+        return as_completed([self], timeout)
+
+    def resubmit_failed(self, include_missing=False):
+        """Rerun only the failed tasks of every script of this job, with
+        the same resources, see ``qtools.submitter.resubmit_failed``
+
+        Returns
+        -------
+        resubmissions : list of Resubmission
+            The rerun of each script with failed tasks
+        """
+        resubmissions = []
+        for sh_filename in self.sh_filenames:
+            resubmission = resubmit_failed(sh_filename, include_missing,
+                                           submit=self.submit)
+            if resubmission is not None:
+                self._finished.pop(sh_filename, None)
+                resubmissions.append(resubmission)
+        return resubmissions
 
     def add_resource(self, kw, value):
         """
@@ -207,132 +635,739 @@ class Submitter(object):
         """
         self.additional_resources[kw].append(value)
 
-    def job(self):
+    def job(self, submit=None):
         """Writes the sh file and submits the job (if submit=True)
 
+        The scripts are written the same way as when the Submitter was
+        created, in chunks if it had chunksize or costs, so call this to
+        rewrite them after ``add_wait``.
+
         Parameters
         ----------
-        submit : bool
-            Whether or not to submit the job
+        submit : bool, optional
+            Whether or not to submit the job. Defaults to the ``submit``
+            the Submitter was created with.
 
         Returns
         -------
         job_id : int
-            Identifier of the job in the queue
+            Identifier of the job in the queue, or the job IDs of the
+            scripts if the commands were split into several
 
         Raises
         ------
+        ValueError : if the commands were read from an iterator, such as
+            a generator, which writing the scripts used up
 
         """
-        # PBS/TSCC does not allow array jobs with more than 500 commands
-        if len(self.commands) > MAX_ARRAY_JOBS and self.array:
-            commands = self.commands
-            name = self.job_name
-            chunks = six.moves.range(0, len(commands), MAX_ARRAY_JOBS)
-            commands_list = [commands[i:(i + MAX_ARRAY_JOBS)] for i in chunks]
-            for i, commands in enumerate(commands_list):
-                job_name = '{}{}'.format(name, i + 1)
-                sh_filename = '{}{}.sh'.format(self.sh_filename.rstrip('.sh'),
-                                               i + 1)
-                Submitter(commands=commands, job_name=job_name, sh=sh_filename,
-                          array=True, walltime=self.walltime, ppn=self.ppn,
-                          nodes=self.nodes, queue=self.queue,
-                          queue_type=self.queue_type, submit=self.submit)
-            return
+        if submit is not None:
+            self.submit = submit
+        if self.sh_filenames and not isinstance(self.commands,
+                                                (list, tuple)):
+            raise ValueError('The commands of {!r} were read from an '
+                             'iterator when its scripts were written, so '
+                             'they are gone. Pass a list of commands to '
+                             'rewrite the scripts.'.format(self.job_name))
+        self.job_ids = []
+        self._finished = {}
+        return self._write()
+
+    def _write(self):
+        """Write the scripts the way the options ask for, and submit them
+        if submit=True"""
+        if self.costs is not None:
+            return self._chunked_job(self._planned_chunks())
+        elif self.chunksize is None:
+            return self._job()
+        else:
+            return self._chunked_job(_batches(self.commands, self.chunksize))
+
+    def _job(self):
+        """Write the commands to one script (or one per MAX_ARRAY_JOBS
+        commands of an array) and submit it if submit=True"""
+        if self.walltime == 'auto':
+            self.commands = list(self.commands)
+            if self.pilot:
+                parallel = self.pilot * self.ppn
+            elif self.array:
+                parallel = len(self.commands)
+            elif self.packed:
+                parallel = self.ppn
+            else:
+                parallel = 1
+            self.walltime = self.runtime_history.suggest_walltime(
+                self.commands, parallel)
+
+        if self.pilot:
+            return self._pilot_job()
+
+        if self.array and self.manifest:
+            return self._manifest_job()
+
+        commands = iter(self.commands)
+        if self.array:
+            # PBS/TSCC does not allow array jobs with more than 500
+            # commands, so look one command past the limit to see whether
+            # the array needs to be split up
+            batch = list(itertools.islice(commands, MAX_ARRAY_JOBS + 1))
+            if len(batch) > MAX_ARRAY_JOBS:
+                return self._split_array_job(itertools.chain(batch,
+                                                             commands))
+            commands = batch
+            self.n_commands = len(batch)
 
         # sys.stderr.write(self.sh_filename)
         sh_file = open(self.sh_filename, 'w')
-        sh_file.write("#!/bin/bash\n")
-        sh_file.write("%s -N %s\n" % (self.queue_param_prefix, self.job_name))
-        sh_file.write("%s -o %s\n" % (self.queue_param_prefix,
-                                      self.out_filename))
-        sh_file.write("%s -e %s\n" % (self.queue_param_prefix,
-                                      self.err_filename))
-        sh_file.write("%s -V\n" % self.queue_param_prefix)
-
-        if self.queue_type == 'SGE':
-            self._write_sge(sh_file)
-
-        elif self.queue_type == 'PBS':
-            self._write_pbs(sh_file)
-            
-        
-        
+        self._write_header(sh_file, self.job_name, self.out_filename,
+                           self.err_filename, self.number_jobs)
+
         if self.array:
             sys.stderr.write("Writing %d tasks as an array-job.\n" % (len(
-                self.commands)))
-            for i, cmd in enumerate(self.commands):
-                sh_file.write("cmd[%d]=\"%s\"\n" % ((i + 1), cmd))
+                commands)))
+            for i, cmd in enumerate(commands):
+                sh_file.write("cmd[%d]=\"%s\"\n" % ((i + 1),
+                                                    self._command_line(cmd)))
             sh_file.write("eval ${cmd[%s]}\n" % (self.array_job_identifier))
         #    pass
+        elif self.packed:
+            self._write_packed(sh_file, commands)
         else:
-            for command in self.commands:
-                sh_file.write(str(command) + "\n")
+            self.n_commands = 0
+            for command in commands:
+                sh_file.write(self._command_line(command) + "\n")
+                self.n_commands += 1
 
         sh_file.write('\n')
         sh_file.close()
 
         sys.stderr.write('Wrote commands to {}.\n'.format(self.sh_filename))
+        self.sh_filenames = [self.sh_filename]
 
         if self.submit:
-            output = subprocess.check_output(["qsub", self.sh_filename],
-                                             universal_newlines=True)
-            job_id = re.findall(r'\d+', output)[0]
-            sys.stderr.write("Submitted script to queue {}.\n"
-                             " Job ID: {}\n".format(self.queue, job_id))
-
-            return job_id
+            self.job_ids = self._dispatch(self.sh_filenames)
+            return self.job_ids[0]
         else:
             return 0
 
-    def _write_pbs(self, sh_file):
-        """PBS-queue (TSCC) specific header formatting
+    def _command_line(self, command):
+        """Line of the script running a command, recording its runtime in
+        the history if there is one"""
+        if self._record_history:
+            return wrap_command(command, self.history.filename)
+        return str(command)
+
+    def _chunked_job(self, chunks):
+        """Write a script for each chunk of the commands and submit them
+
+        Parameters
+        ----------
+        chunks : iterable of lists of str
+            Commands of each chunk
         """
-        # queue_param_prefix = '#PBS'
-        #            queue_param_prefix = '#PBS'
-        sh_file.write("%s -l walltime=%s\n" % (self.queue_param_prefix,
-                                               self.walltime))
-        sh_file.write("%s -l nodes=%s:ppn=%s\n" % (self.queue_param_prefix,
-                                                   str(self.nodes),
-                                                   str(self.ppn)))
-        sh_file.write("%s -A %s\n" % (self.queue_param_prefix, self.account))
-        sh_file.write("%s -q %s\n" % (self.queue_param_prefix, self.queue))
-
-        # Workaround to submit to 'glean' queue and 'condo' queue (condo-group doesn't exist anymore)
-        # if (self.queue == "glean") or (self.queue == "condo"):
-        #     sh_file.write('%s -W group_list=condo-group\n' %
-        #                   self.queue_param_prefix)
-
-        self._write_additional_resources(sh_file)
+        sh_filenames = []
+        self.n_commands = 0
+        for chunk, subset in enumerate(chunks):
+            self.n_commands += len(subset)
+            name = '{name}{chunk}'.format(name=self.job_name, chunk=chunk)
+            sh = self.sh_filename.replace('.sh', '-{}.sh'.format(chunk))
+            out = self.out_filename.replace('.sh', '-{}.sh'.format(chunk))
+            err = self.err_filename.replace('.sh', '-{}.sh'.format(chunk))
+            child = self._child(subset, name, sh=sh, out=out, err=err,
+                                array=self.array, part=chunk)
+            sh_filenames.extend(child.sh_filenames)
+            self.n_tasks.update(child.n_tasks)
+            self.array_sh_filenames.update(child.array_sh_filenames)
+        self.sh_filenames = sh_filenames
+        if self.submit:
+            self.job_ids = self._dispatch(sh_filenames)
+        return self.job_ids
 
-        if self.array:
-            if self.max_running is not None:
-                sh_file.write("%s -t 1-%d%%%d\n" % (
-                    self.queue_param_prefix, self.number_jobs,
-                    self.max_running))
+    def _planned_chunks(self):
+        """Chunks of the commands packed by their costs within the walltime
+        """
+        commands = list(self.commands)
+        if len(commands) != len(self.costs):
+            raise ValueError('Got {} costs for {} commands'.format(
+                len(self.costs), len(commands)))
+        if self.walltime == 'auto':
+            target = parse_walltime(DEFAULT_WALLTIME)
+        else:
+            target = parse_walltime(self.walltime)
+        if self.packed:
+            target *= self.ppn
+        for indices in pack(self.costs, target=target, method=self.packing):
+            yield [commands[i] for i in indices]
+
+    def _split_array_job(self, commands):
+        """Write one array script per MAX_ARRAY_JOBS commands and submit them
+
+        Parameters
+        ----------
+        commands : iterator of str
+            All the commands of the array, consumed MAX_ARRAY_JOBS at a time
+        """
+        sh_filenames = []
+        self.n_commands = 0
+        for i, batch in enumerate(_batches(commands, MAX_ARRAY_JOBS)):
+            self.n_commands += len(batch)
+            job_name = '{}{}'.format(self.job_name, i + 1)
+            sh_filename = self._split_filename(i + 1)
+            child = self._child(batch, job_name, sh=sh_filename, array=True,
+                                part=i)
+            sh_filenames.extend(child.sh_filenames)
+            self.n_tasks.update(child.n_tasks)
+            self.array_sh_filenames.update(child.array_sh_filenames)
+        self.sh_filenames = sh_filenames
+        if self.submit:
+            self.job_ids = self._dispatch(sh_filenames)
+        return self.job_ids
+
+    def _manifest_job(self):
+        """Write the manifest of commands and the array scripts reading it
+
+        Arrays of more than MAX_ARRAY_JOBS commands get one script per
+        MAX_ARRAY_JOBS commands, each of which reads its commands from the
+        shared manifest starting at its own offset.
+        """
+        n_commands = self._write_manifest()
+        sys.stderr.write("Writing %d tasks as an array-job.\n" % n_commands)
+
+        starts = list(six.moves.range(0, n_commands, MAX_ARRAY_JOBS))
+        sh_filenames = []
+        for i, start in enumerate(starts):
+            if len(starts) > 1:
+                job_name = '{}{}'.format(self.job_name, i + 1)
+                sh_filename = self._split_filename(i + 1)
+                out_filename = sh_filename + '.out'
+                err_filename = sh_filename + '.err'
             else:
-                sh_file.write(
-                    "%s -t 1-%d\n" % (self.queue_param_prefix,
-                                      self.number_jobs))
+                job_name = self.job_name
+                sh_filename = self.sh_filename
+                out_filename = self.out_filename
+                err_filename = self.err_filename
+            n_tasks = min(MAX_ARRAY_JOBS, n_commands - start)
+
+            with open(sh_filename, 'w') as sh_file:
+                self._write_header(sh_file, job_name, out_filename,
+                                   err_filename, n_tasks, part=i)
+                self._write_manifest_reader(sh_file, start)
+                sh_file.write('\n')
+            sys.stderr.write('Wrote commands to {}.\n'.format(sh_filename))
+            sh_filenames.append(sh_filename)
 
-        sh_file.write('\n# Go to the directory from which the script was '
-                      'called\n')
-        sh_file.write("cd $PBS_O_WORKDIR\n")
-        # self.array_job_identifier = "$PBS_ARRAYID"
+        self.sh_filenames = sh_filenames
+        if self.submit:
+            self.job_ids = self._dispatch(sh_filenames)
+        if len(sh_filenames) > 1:
+            return self.job_ids
+        return self.job_ids[0] if self.job_ids else 0
+
+    def _pilot_job(self):
+        """Fill the work queue and write the array job of its workers"""
+        if os.path.exists(self.queue_filename):
+            os.remove(self.queue_filename)
+        self.n_commands = WorkQueue(self.queue_filename).fill(
+            six.moves.map(self._command_line, self.commands))
+        n_workers = min(self.pilot, MAX_ARRAY_JOBS, max(self.n_commands, 1))
+        sys.stderr.write("Writing %d commands to a work queue for %d "
+                         "workers.\n" % (self.n_commands, n_workers))
+
+        with open(self.sh_filename, 'w') as sh_file:
+            self._write_header(sh_file, self.job_name, self.out_filename,
+                               self.err_filename, n_workers, array=True)
+            sh_file.write('# Run commands from the work queue until it is '
+                          'drained\n')
+            sh_file.write('%s -m qtools.pilot %s --worker %s-%s '
+                          '--processes %d\n' % (
+                              sys.executable,
+                              os.path.abspath(self.queue_filename),
+                              self.job_name, self.array_job_identifier,
+                              self.ppn))
+            sh_file.write('\n')
+        sys.stderr.write('Wrote commands to {}.\n'.format(self.sh_filename))
+        self.sh_filenames = [self.sh_filename]
 
-    def _write_sge(self, sh_file):
-        """SGE-queue (oolit) specific header formatting
+        if self.submit:
+            self.job_ids = self._dispatch(self.sh_filenames)
+            return self.job_ids[0]
+        else:
+            return 0
+
+    def _write_manifest(self):
+        """Write the commands, one per line, and the index of their offsets
+
+        Returns
+        -------
+        n_commands : int
+            Number of commands written to the manifest
+        """
+        n_commands = 0
+        offset = 0
+        record = '%0{}d\n'.format(MANIFEST_INDEX_WIDTH - 1)
+        with open(self.manifest_filename, 'wb') as manifest, \
+                open(self.index_filename, 'wb') as index:
+            for command in self.commands:
+                command = self._command_line(command)
+                if '\n' in command:
+                    raise ValueError('Commands in a manifest must be on a '
+                                     'single line. Tried to provide '
+                                     '{!r}'.format(command))
+                line = (command + '\n').encode('utf-8')
+                manifest.write(line)
+                index.write((record % offset).encode('ascii'))
+                offset += len(line)
+                n_commands += 1
+        self.n_commands = n_commands
+        return n_commands
+
+    def _write_manifest_reader(self, sh_file, start=0):
+        """Write the lines that find and run this task's command
+
+        The task looks up its own record of the index by seeking straight
+        to it, then seeks straight to its command in the manifest, so
+        neither file is read from the beginning.
+
+        Parameters
+        ----------
+        sh_file : file
+            Open script to write to
+        start : int
+            Number of commands in the manifest before this script's first
+            command
         """
-        # queue_param_prefix = '#$'
-        sh_file.write("%s -S /bin/bash\n" % self.queue_param_prefix)
-        sh_file.write("%s -cwd\n" % self.queue_param_prefix)
-        self._write_additional_resources(sh_file)
-
-    def _write_additional_resources(self, sh_file):
-        if self.additional_resources:
-            # if self.data['additional_resources']:
-            for key, value in self.additional_resources.iteritems():
-                # for value in self.data['additional_resources'][key]:
-                for v in value:
-                    sh_file.write("%s %s %s\n" % (self.queue_param_prefix,
-                                                  key, v))
+        sh_file.write('# Each task seeks to its own command in the manifest\n')
+        sh_file.write('manifest=%s\n' % os.path.abspath(
+            self.manifest_filename))
+        sh_file.write('index=%s\n' % os.path.abspath(self.index_filename))
+        sh_file.write('task=$((%s + %d))\n' % (self.array_job_identifier,
+                                               start))
+        sh_file.write('offset=$(dd if="$index" bs=%d skip=$((task - 1)) '
+                      'count=1 2>/dev/null)\n' % MANIFEST_INDEX_WIDTH)
+        sh_file.write('eval "$(tail -c +$((10#$offset + 1)) "$manifest" '
+                      '| head -n 1)"\n')
+
+    def _write_packed(self, sh_file, commands):
+        """Write the commands to run up to ppn at a time
+
+        Each command runs in the background in its own subshell, once fewer
+        than ppn commands are running, and appends its index and exit code
+        to the exit codes file when it finishes.
+        """
+        sh_file.write('# Run up to %d commands at a time, recording the exit '
+                      'code of each\n' % self.ppn)
+        sh_file.write('exit_codes=%s\n' % os.path.abspath(
+            self.exit_codes_filename))
+        sh_file.write(': > "$exit_codes"\n')
+        sh_file.write('run_command() {\n')
+        sh_file.write('    while [ "$(jobs -rp | wc -l)" -ge %d ]; do '
+                      'wait -n; done\n' % self.ppn)
+        sh_file.write('    { (eval "$2"); echo "$1 $?" >> "$exit_codes"; '
+                      '} &\n')
+        sh_file.write('}\n')
+        self.n_commands = 0
+        for i, command in enumerate(commands):
+            sh_file.write('run_command %d %s\n' % (
+                i + 1, six.moves.shlex_quote(self._command_line(command))))
+            self.n_commands += 1
+        sh_file.write('wait\n')
+        sh_file.write('# Fail if any of the commands failed\n')
+        sh_file.write('! grep -qv " 0$" "$exit_codes"\n')
+
+    def _split_filename(self, i):
+        """Name of the i-th script when the commands are split up"""
+        root, ext = os.path.splitext(self.sh_filename)
+        return '{}{}{}'.format(root, i, ext)
+
+    def _write_header(self, sh_file, job_name, out_filename, err_filename,
+                      n_tasks, array=None, part=0):
+        """Write the shebang and the scheduler directives of a script
+
+        Parameters
+        ----------
+        part : int, optional
+            Index of the script among the scripts of a split array job,
+            which waits for the same part of the arrays in wait_for_each
+        """
+        array = self.array if array is None else array
+        parts = self._elementwise_parts(part, n_tasks, array)
+        elementwise = self.backend.elementwise_dependencies
+        lines = self.backend.render_header(
+            self, job_name, out_filename, err_filename, n_tasks, array,
+            elementwise=[job_id for job_id, _, _ in parts]
+            if elementwise else ())
+        sh_file.write('\n'.join(lines) + '\n')
+        self.n_tasks[sh_file.name] = n_tasks if array else 1
+        if array:
+            self.array_sh_filenames.add(sh_file.name)
+        if self.sentinels:
+            self._write_sentinel(sh_file, n_tasks, array)
+        if parts and not elementwise:
+            self._write_sentinel_wait(sh_file, parts)
+
+    def _elementwise_parts(self, part, n_tasks, array):
+        """The part of each array job in wait_for_each that a script
+        waits for task by task"""
+        if not self.wait_for_each:
+            return []
+        if not array:
+            raise ValueError('Only array jobs can wait for other array jobs '
+                             'task by task')
+        parts = []
+        for dependency in self.wait_for_each:
+            if part >= len(dependency) or dependency[part][2] not in (
+                    None, n_tasks):
+                raise ValueError('Can only wait task by task for array jobs '
+                                 'of the same number of tasks')
+            parts.append(dependency[part])
+        return parts
+
+    def _write_sentinel_wait(self, sh_file, parts):
+        """Write the lines waiting for the sentinels of the same task of
+        the array jobs this one depends on, failing if one of them failed
+        """
+        status_dirs = []
+        for job_id, status_dir, _ in parts:
+            if status_dir is None:
+                raise ValueError(
+                    'The {} scheduler cannot hold tasks until the tasks of '
+                    'other arrays finish, so the arrays to wait for task by '
+                    'task must be Submitters written with '
+                    'sentinels=True'.format(self.backend.name))
+            status_dirs.append(six.moves.shlex_quote(status_dir))
+        sh_file.write('# Wait for the same task of the jobs this one depends '
+                      'on\n')
+        sh_file.write('for qtools_dependency in %s; do\n' % ' '.join(
+            status_dirs))
+        sh_file.write('    qtools_dependency="$qtools_dependency/%s%s"\n' % (
+            self.array_job_identifier, SENTINEL_SUFFIX))
+        sh_file.write('    qtools_sleep=1\n')
+        sh_file.write('    while [ ! -e "$qtools_dependency" ]; do\n')
+        sh_file.write('        sleep $qtools_sleep\n')
+        sh_file.write('        qtools_sleep=$((qtools_sleep < {0} ? '
+                      'qtools_sleep * 2 : {0}))\n'.format(MAX_POLL_INTERVAL))
+        sh_file.write('    done\n')
+        sh_file.write('    [ "$(cat "$qtools_dependency")" = 0 ] || exit 1\n')
+        sh_file.write('done\n')
+
+    def _write_sentinel(self, sh_file, n_tasks, array):
+        """Write the trap leaving the exit code of the job (or task) in a
+        sentinel file when it finishes"""
+        status_dir = self._status_dir(sh_file.name)
+        if os.path.isdir(status_dir):
+            # Sentinels of an earlier run of the same script
+            for name in os.listdir(status_dir):
+                os.remove(os.path.join(status_dir, name))
+        else:
+            os.makedirs(status_dir)
+
+        task = self.array_job_identifier if array else '1'
+        sh_file.write('# Leave the exit code in a sentinel file when this '
+                      'task finishes. Of several copies of a task, the\n'
+                      '# first to start leaves the start time and the '
+                      'first to finish the exit code.\n')
+        sh_file.write('qtools_sentinel=%s/%s\n' % (
+            six.moves.shlex_quote(status_dir), task))
+        sh_file.write('[ -e "$qtools_sentinel%s" ] || '
+                      ': > "$qtools_sentinel%s"\n' % (START_SUFFIX,
+                                                      START_SUFFIX))
+        sh_file.write('trap \'echo $? > "$qtools_sentinel.$$.tmp" && '
+                      '{ ln "$qtools_sentinel.$$.tmp" "$qtools_sentinel%s" '
+                      '2>/dev/null; rm -f "$qtools_sentinel.$$.tmp"; }\' '
+                      'EXIT\n' % SENTINEL_SUFFIX)
+
+    @staticmethod
+    def _status_dir(sh_filename):
+        """Folder of the sentinel files of a script's tasks"""
+        return os.path.abspath(sh_filename) + '.status'
+
+    def _child(self, commands, job_name, sh, out=None, err=None, array=None,
+               part=0):
+        """Write (but don't submit) the script for a subset of the commands
+
+        The child inherits all the resources of this job, and the parent
+        submits the child's scripts itself with ``_dispatch``. The child
+        waits task by task for part ``part`` of the arrays in wait_for_each.
+        """
+        return Submitter(commands, job_name, queue_type=self.queue_type,
+                         sh=sh, array=array, nodes=self.nodes, ppn=self.ppn,
+                         walltime=self.walltime, queue=self.queue,
+                         account=self.account, out=out, err=err,
+                         max_running=self.max_running, submit=False,
+                         chunksize=None, manifest=self.manifest,
+                         packed=self.packed, pilot=self.pilot,
+                         history=self.history if self._record_history
+                         else None, sentinels=self.sentinels,
+                         wait_for=self.wait_for,
+                         wait_for_each=[dependency[part:part + 1] for
+                                        dependency in self.wait_for_each])
+
+    def _submit_script(self, sh_filename):
+        """Submit a written script to the queue and return its job ID"""
+        job_id = self.backend.submit(sh_filename)
+        sys.stderr.write("Submitted script to queue {}.\n"
+                         " Job ID: {}\n".format(self.queue, job_id))
+        return job_id
+
+    def _dispatch(self, sh_filenames):
+        """Submit several scripts, up to ``dispatch_threads`` at a time, and
+        only as many tasks as fit within ``max_queued``
+
+        Parameters
+        ----------
+        sh_filenames : list of str
+            Scripts to submit
+
+        Returns
+        -------
+        job_ids : list of str
+            Job IDs of the submitted scripts, in the same order as
+            ``sh_filenames``. With max_queued, the same list as
+            ``self.job_ids``, which the rest are appended to as they are
+            submitted.
+        """
+        if self.max_queued is None:
+            return self._submit_scripts(sh_filenames)
+
+        too_many = [sh_filename for sh_filename in sh_filenames
+                    if self.n_tasks[sh_filename] > self.max_queued]
+        if too_many:
+            raise ValueError('{} has {} tasks, more than the {} which may be '
+                             'queued at once'.format(
+                                 too_many[0], self.n_tasks[too_many[0]],
+                                 self.max_queued))
+        self.job_ids = []
+        self._pending = list(sh_filenames)
+        if self._submit_window():
+            sys.stderr.write('Submitting the other {} scripts as the first '
+                             'ones finish.\n'.format(len(self._pending)))
+            # Not a daemon, so the process lives until all are submitted
+            threading.Thread(target=self._dispatch_pending).start()
+        return self.job_ids
+
+    def _submit_window(self):
+        """Submit the waiting scripts which fit within max_queued tasks
+        along with the unfinished ones, and return whether any are left"""
+        n_queued = sum(self._n_unfinished(sh_filename, job_id)
+                       for sh_filename, job_id in zip(self.sh_filenames,
+                                                      self.job_ids))
+        n_fit = 0
+        for sh_filename in self._pending:
+            n_queued += self.n_tasks[sh_filename]
+            if n_queued > self.max_queued:
+                break
+            n_fit += 1
+        if n_fit:
+            job_ids = self._submit_scripts(self._pending[:n_fit])
+            self.job_ids.extend(job_ids)
+            if self._monitor is not None:
+                self._monitor.track(self._submitted_jobs())
+            # Only drop them once their job IDs are in, so that nothing
+            # else sees every script dispatched without every job ID
+            del self._pending[:n_fit]
+        return bool(self._pending)
+
+    def _dispatch_pending(self):
+        """Submit the waiting scripts as room frees up in the queue"""
+        try:
+            wait_for(lambda: None if self._submit_window() else True)
+        except Exception as e:
+            self._dispatch_error = e
+
+    def _n_unfinished(self, sh_filename, job_id):
+        """Number of the tasks of a submitted script which are still queued
+        or running"""
+        n_tasks = self.n_tasks[sh_filename]
+        if self.sentinels:
+            try:
+                names = os.listdir(self._status_dir(sh_filename))
+            except OSError:
+                return n_tasks
+            return n_tasks - sum(name.endswith(SENTINEL_SUFFIX)
+                                 for name in names)
+        monitor = shared_monitor(self.queue_type)
+        monitor.track((job_id, sh_filename in self.array_sh_filenames))
+        if monitor.is_done(job_id):
+            return 0
+        # Finished tasks may have left the queue already, so only count
+        # the ones reported as completed
+        return n_tasks - sum(state == COMPLETED for state in
+                             monitor.task_states(job_id).values())
+
+    def _submit_scripts(self, sh_filenames):
+        """Submit scripts now, up to ``dispatch_threads`` at a time, and
+        return their job IDs"""
+        if not self.dispatch_threads or self.dispatch_threads < 2 \
+                or len(sh_filenames) < 2:
+            return [self._submit_script(sh_filename)
+                    for sh_filename in sh_filenames]
+
+        # Each qsub spends its time waiting on the head node, so threads are
+        # enough to overlap the round trips
+        n_threads = min(self.dispatch_threads, len(sh_filenames))
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            return list(executor.map(self._submit_script, sh_filenames))
+
+
+#: Script resubmitting the failed tasks of a job, the indices of those tasks
+#: and the job ID of the resubmission (None if it wasn't submitted)
+Resubmission = namedtuple('Resubmission', ['sh_filename', 'tasks', 'job_id'])
+
+
+def _read_script(sh_filename):
+    """Backend, lines, directive prefix, indices of the directive lines and
+    of the array option lines, tasks and throttle of a script"""
+    backend = script_backend(sh_filename)
+    with open(sh_filename) as f:
+        lines = f.read().splitlines()
+    prefix = backend.directive_prefix + ' '
+    directives = [i for i, line in enumerate(lines) if line.startswith(prefix)]
+    array_lines = [i for i in directives if lines[i][len(prefix):].startswith(
+        backend.array_option_prefixes)]
+    if array_lines:
+        tasks, max_running = backend.read_array_options(
+            [lines[i][len(prefix):] for i in array_lines])
+    else:
+        tasks, max_running = [1], None
+    return (backend, lines, prefix, directives, array_lines, tasks,
+            max_running)
+
+
+def resubmit_failed(sh_filename, include_missing=False, submit=True):
+    """Rerun only the tasks of a job which failed, with the same resources
+
+    The job must have been written with ``sentinels=True``, so that each of
+    its tasks left its exit code in sh_file.status. The failed tasks are
+    written to sh_file.retry.sh, as an array of only those indices (e.g.
+    ``-t 3,7,19``) where the scheduler allows it, or as an array of as many
+    tasks mapped back to the original indices, and their sentinels are
+    removed so that waiting on the original job waits for the rerun too.
+
+    Parameters
+    ----------
+    sh_filename : str
+        Script written by qtools.Submitter
+    include_missing : bool, optional
+        Also rerun the tasks which left no sentinel, e.g. because they ran
+        out of walltime. Only use this once the job has left the queue.
+    submit : bool, optional
+        If True (default), then submit the rerun to the queue
+
+    Returns
+    -------
+    resubmission : Resubmission or None
+        The rerun of the failed tasks, or None if no tasks failed
+
+    Raises
+    ------
+    ValueError : if the script was written without sentinels
+    """
+    status_dir = Submitter._status_dir(sh_filename)
+    if not os.path.isdir(status_dir):
+        raise ValueError('{} was written without sentinels=True, so the '
+                         'exit codes of its tasks are unknown'.format(
+                             sh_filename))
+    tasks = _read_script(sh_filename)[5]
+
+    failed = []
+    for task in tasks:
+        sentinel = os.path.join(status_dir, '{}{}'.format(task,
+                                                          SENTINEL_SUFFIX))
+        try:
+            with open(sentinel) as f:
+                exit_code = int(f.read().strip() or 0)
+        except (IOError, OSError):
+            if include_missing:
+                failed.append(task)
+            continue
+        if exit_code:
+            failed.append(task)
+            os.remove(sentinel)
+    if not failed:
+        return None
+    return rerun_tasks(sh_filename, failed, 'retry', submit)
+
+
+def rerun_tasks(sh_filename, tasks, suffix='retry', submit=True):
+    """Run some of the tasks of a job again, with the same resources
+
+    The tasks are written to sh_file.<suffix>.sh, as an array of only those
+    indices (e.g. ``-t 3,7,19``) where the scheduler allows it, or as an
+    array of as many tasks mapped back to the original indices. The rerun
+    leaves its sentinels where the original job does, writes its output to
+    files named with the suffix too, e.g. sh_file.sh.<suffix>.out, and
+    doesn't wait for the jobs the original job waited for, which have
+    finished long ago.
+
+    Parameters
+    ----------
+    sh_filename : str
+        Script written by qtools.Submitter
+    tasks : list of int
+        Indices of the tasks to run again
+    suffix : str, optional
+        Added to the name of the script of the rerun
+    submit : bool, optional
+        If True (default), then submit the rerun to the queue
+
+    Returns
+    -------
+    resubmission : Resubmission
+    """
+    backend, lines, prefix, directives, array_lines, _, max_running = \
+        _read_script(sh_filename)
+    rerun_filename = _suffixed(sh_filename, suffix)
+    array_options = []
+    remap = []
+    if array_lines:
+        options = backend.sparse_array_options(tasks, max_running)
+        if options is None:
+            # Task i of the rerun runs task tasks[i - 1] of the original
+            options = backend.array_options(len(tasks), max_running)
+            variable = backend.array_task_id
+            remap = ['# Run these tasks of the original job',
+                     'qtools_tasks=(0 {})'.format(' '.join(
+                         str(task) for task in tasks)),
+                     '{0}=${{qtools_tasks[${0}]}}'.format(variable)]
+        array_options = [prefix + option for option in options]
+
+    directives = set(directives)
+    last_directive = max(directives) if directives else None
+    rerun_lines = []
+    for i, line in enumerate(lines):
+        option = line[len(prefix):] if i in directives else ''
+        if array_lines and i == array_lines[0]:
+            rerun_lines.extend(array_options)
+        if i in directives and option.startswith(
+                backend.output_option_prefixes):
+            # Keep the logs of the original tasks
+            option_prefix = next(
+                option_prefix for option_prefix in
+                backend.output_option_prefixes
+                if option.startswith(option_prefix))
+            line = prefix + option_prefix + _suffixed(
+                option[len(option_prefix):].strip(), suffix)
+        # The jobs the original waited for are long gone
+        if i not in array_lines and not (
+                i in directives and option.startswith(
+                    backend.dependency_option_prefixes)):
+            rerun_lines.append(line)
+        if i == last_directive:
+            rerun_lines.extend(remap)
+    lines = rerun_lines
+    with open(rerun_filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    sys.stderr.write('Wrote {} tasks to {}.\n'.format(len(tasks),
+                                                      rerun_filename))
+
+    job_id = None
+    if submit:
+        job_id = backend.submit(rerun_filename)
+        sys.stderr.write('Submitted the tasks to the queue.\n'
+                         ' Job ID: {}\n'.format(job_id))
+    return Resubmission(rerun_filename, list(tasks), job_id)
+
+
+def _suffixed(filename, suffix):
+    """Filename with a suffix before its extension, e.g. job.retry.sh"""
+    root, ext = os.path.splitext(filename)
+    return '{}.{}{}'.format(root, suffix, ext)
@@ -8,8 +8,15 @@ test_qtools
 Tests for `qtools` module.
 """
 
+import os
+import stat
+import subprocess
+import time
+
 import pytest
 
+import qtools
+
 
 @pytest.fixture
 def command():
@@ -24,7 +31,1028 @@ def commands(request, command):
         return [command]
 
 
+@pytest.fixture
+def fake_qsub(tmpdir, monkeypatch):
+    """Put a ``qsub`` on the PATH that answers with a job ID made from the
+    numbers in the script's name, after a short delay"""
+    bin_dir = tmpdir.mkdir('bin')
+    qsub = bin_dir.join('qsub')
+    qsub.write('#!/bin/bash\n'
+               'sleep 0.2\n'
+               'echo "$(basename $1 .sh | tr -dc 0-9).tscc-mgr.local"\n')
+    qsub.chmod(qsub.stat().mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', '{}{}{}'.format(bin_dir, os.pathsep,
+                                               os.environ['PATH']))
+    monkeypatch.chdir(tmpdir)
+    return qsub
+
+
+@pytest.fixture
+def qtools_path(monkeypatch):
+    """Put this copy of qtools on the PYTHONPATH of the processes that tests
+    start, which run it with ``python -m``"""
+    monkeypatch.setenv('PYTHONPATH', os.path.dirname(
+        os.path.dirname(qtools.__file__)))
+
+
 class TestSubmitter(object):
 
     def test_init(self):
         pass
+
+    @pytest.mark.parametrize('dispatch_threads', [None, 4])
+    def test_chunksize_dispatch(self, fake_qsub, dispatch_threads):
+        commands = ['echo {}'.format(i) for i in range(10)]
+        sub = qtools.Submitter(commands, 'job', chunksize=2,
+                               dispatch_threads=dispatch_threads)
+
+        assert sub.sh_filenames == ['job-{}.sh'.format(i) for i in range(5)]
+        assert sub.job_ids == [str(i) for i in range(5)]
+
+    def test_max_array_jobs_dispatch(self, fake_qsub):
+        commands = ['echo {}'.format(i) for i in range(1201)]
+        sub = qtools.Submitter(commands, 'job', array=True,
+                               dispatch_threads=3)
+
+        assert sub.sh_filenames == ['job1.sh', 'job2.sh', 'job3.sh']
+        assert sub.job_ids == ['1', '2', '3']
+
+    def test_manifest(self, tmpdir):
+        tmpdir.chdir()
+        commands = ['echo "{0} a=b" > out{0}.txt'.format(i)
+                    for i in range(1, 1202)]
+        sub = qtools.Submitter(commands, 'job', array=True, manifest=True,
+                               submit=False)
+
+        assert sub.sh_filenames == ['job1.sh', 'job2.sh', 'job3.sh']
+        assert os.path.getsize('job.sh.index') == \
+            1201 * qtools.submitter.MANIFEST_INDEX_WIDTH
+        for sh_filename, task_id, i in [('job1.sh', 1, 1),
+                                        ('job2.sh', 7, 507),
+                                        ('job3.sh', 201, 1201)]:
+            env = dict(os.environ, PBS_ARRAYID=str(task_id),
+                       PBS_O_WORKDIR=str(tmpdir))
+            subprocess.check_call(['bash', sh_filename], env=env)
+            assert tmpdir.join('out{}.txt'.format(i)).read() == \
+                '{} a=b\n'.format(i)
+
+    @pytest.mark.parametrize('kwargs, sh_filenames', [
+        (dict(chunksize=400), ['job-0.sh', 'job-1.sh', 'job-2.sh']),
+        (dict(array=True), ['job1.sh', 'job2.sh', 'job3.sh']),
+        (dict(array=True, manifest=True), ['job1.sh', 'job2.sh', 'job3.sh']),
+        (dict(array=False), ['job.sh'])])
+    def test_generator(self, tmpdir, kwargs, sh_filenames):
+        tmpdir.chdir()
+        commands = ('echo {}'.format(i) for i in range(1001))
+        sub = qtools.Submitter(commands, 'job', submit=False, **kwargs)
+
+        assert sub.sh_filenames == sh_filenames
+        assert sub.n_commands == 1001
+
+
+@pytest.fixture
+def hostname(monkeypatch):
+    """Pretend to be on another host, detecting the cluster afresh"""
+    def set_hostname(name, **environ):
+        monkeypatch.setattr(qtools.submitter.socket, 'gethostname',
+                            lambda: name)
+        monkeypatch.setattr(qtools.submitter, '_cluster_profile', None)
+        for variable, _ in qtools.submitter.SCHEDULER_ENVIRONMENT_MARKERS:
+            monkeypatch.delenv(variable, raising=False)
+        for variable, value in environ.items():
+            monkeypatch.setenv(variable, value)
+    return set_hostname
+
+
+@pytest.mark.parametrize('name, environ, queue_type, array', [
+    ('tscc-login1.sdsc.edu', {}, 'PBS', False),
+    ('oolite', {}, 'SGE', True),
+    ('laptop', {}, None, None),
+    ('headnode', {'SGE_ROOT': '/opt/sge'}, 'SGE', True)])
+def test_cluster_profile(hostname, name, environ, queue_type, array):
+    hostname(name, **environ)
+    profile = qtools.submitter.cluster_profile()
+
+    assert profile == (name, queue_type, array)
+    assert qtools.submitter.cluster_profile() is profile
+
+
+def test_hostname():
+    import socket
+    from qtools.submitter import HOSTNAME
+    assert HOSTNAME == socket.gethostname()
+
+
+def test_cluster_profile_defaults(hostname, tmpdir):
+    tmpdir.chdir()
+    hostname('oolite')
+    sub = qtools.Submitter(['echo 1', 'echo 2'], 'job', queue_type=None,
+                           submit=False)
+
+    assert sub.queue_type == 'SGE'
+    assert sub.array
+
+
+@pytest.mark.parametrize('queue_type, header', [
+    ('PBS', ['#!/bin/bash',
+             '#PBS -N job',
+             '#PBS -o job.sh.out',
+             '#PBS -e job.sh.err',
+             '#PBS -V',
+             '#PBS -l walltime=0:30:00',
+             '#PBS -l nodes=1:ppn=1',
+             '#PBS -A yeo-group',
+             '#PBS -q home',
+             '#PBS -t 1-2%1',
+             '',
+             '# Go to the directory from which the script was called',
+             'cd $PBS_O_WORKDIR',
+             'cmd[1]="echo 1"',
+             'cmd[2]="echo 2"',
+             'eval ${cmd[$PBS_ARRAYID]}']),
+    ('SGE', ['#!/bin/bash',
+             '#$ -N job',
+             '#$ -o job.sh.out',
+             '#$ -e job.sh.err',
+             '#$ -V',
+             '#$ -S /bin/bash',
+             '#$ -cwd',
+             '#$ -l bigmem',
+             '#$ -l h_vmem=16G',
+             '#$ -t 1-2',
+             '#$ -tc 1',
+             'cmd[1]="echo 1"',
+             'cmd[2]="echo 2"',
+             'eval ${cmd[$SGE_TASK_ID]}']),
+    ('slurm', ['#!/bin/bash',
+               '#SBATCH --job-name=job',
+               '#SBATCH --output=job.sh.out',
+               '#SBATCH --error=job.sh.err',
+               '#SBATCH --export=ALL',
+               '#SBATCH --time=0:30:00',
+               '#SBATCH --nodes=1',
+               '#SBATCH --ntasks-per-node=1',
+               '#SBATCH --account=yeo-group',
+               '#SBATCH --partition=home',
+               '#SBATCH --array=1-2%1',
+               'cmd[1]="echo 1"',
+               'cmd[2]="echo 2"',
+               'eval ${cmd[$SLURM_ARRAY_TASK_ID]}'])])
+def test_backend_scripts(tmpdir, queue_type, header):
+    tmpdir.chdir()
+    qtools.Submitter(['echo 1', 'echo 2'], 'job', queue_type=queue_type,
+                     array=True, max_running=1, submit=False)
+
+    assert tmpdir.join('job.sh').read().splitlines() == header + ['']
+
+
+def test_pbs_array_job_ids():
+    from qtools.backends import get_backend
+    pbs = get_backend('PBS')
+    assert pbs.status_command(['12', '13'], arrays=['13']) == \
+        ['qstat', '-x', '-t', '12', '13[]']
+    assert pbs.cancel_command('13', array=True) == ['qdel', '13[]']
+    assert pbs.cancel_command('13', 4, array=True) == ['qdel', '13[4]']
+
+
+def test_unknown_backend(tmpdir):
+    tmpdir.chdir()
+    with pytest.raises(ValueError):
+        qtools.Submitter(['echo 1'], 'job', queue_type='LSF', submit=False)
+
+
+@pytest.mark.parametrize('kwargs', [dict(array=True, max_running=2),
+                                    dict(array=True, manifest=True),
+                                    dict(array=False)])
+def test_local_backend(tmpdir, kwargs):
+    tmpdir.chdir()
+    commands = ['echo {0} > out{0}.txt'.format(i) for i in range(1, 6)]
+    commands.append('exit 3')
+    sub = qtools.Submitter(commands, 'job', queue_type='local', ppn=4,
+                           **kwargs)
+
+    exit_codes = sub.backend.exit_codes(sub.job_ids[0], timeout=60)
+
+    if kwargs['array']:
+        assert exit_codes == [0, 0, 0, 0, 0, 3]
+    else:
+        assert exit_codes == [3]
+    for i in range(1, 6):
+        assert tmpdir.join('out{}.txt'.format(i)).read() == '{}\n'.format(i)
+
+
+def test_local_backend_resources(tmpdir):
+    tmpdir.chdir()
+    first = qtools.Submitter(['true'], 'first', queue_type='local')
+    sub = qtools.Submitter(['echo 1', 'echo 2'], 'job', queue_type='local',
+                           array=True, ppn=2, wait_for=[first],
+                           submit=False)
+    sub.add_resource('-l', 'mem=4gb')
+    sub.add_resource('-W', 'umask=022')
+    sub.job(submit=True)
+
+    assert sub.backend._read_directives(sub.sh_filename)[2:] == (
+        [1, 2], 2, first.job_ids)
+    assert sub.backend.exit_codes(sub.job_ids[0], timeout=60) == [0, 0]
+
+
+def test_local_backend_cancel_held(tmpdir):
+    tmpdir.chdir()
+    first = qtools.Submitter(['sleep 1'], 'first', queue_type='local')
+    held = qtools.Submitter(['echo 1 > out1.txt', 'echo 2 > out2.txt'],
+                            'held', queue_type='local', array=True,
+                            wait_for=[first])
+    cancelled = qtools.Submitter(['echo 3 > out3.txt'], 'cancelled',
+                                 queue_type='local', wait_for=[first])
+    backend = first.backend
+
+    # Cancelled while held, so they never run once first has succeeded
+    assert backend.cancel(held.job_ids[0], task=1)
+    assert backend.cancel(cancelled.job_ids[0])
+    assert backend.exit_codes(first.job_ids[0], timeout=60) == [0]
+    tasks = backend.jobs[held.job_ids[0]]
+    assert tasks[1].result(timeout=60) == 0
+    assert tasks[0].cancelled()
+    assert backend.jobs[cancelled.job_ids[0]][0].cancelled()
+    assert not tmpdir.join('out1.txt').exists()
+    assert tmpdir.join('out2.txt').read() == '2\n'
+    assert not tmpdir.join('out3.txt').exists()
+
+
+@pytest.fixture
+def fakeq(tmpdir, monkeypatch):
+    """Submit to a stand-in PBS scheduler running on this machine"""
+    from qtools import fakeq
+    bin_dir = fakeq.install(str(tmpdir.join('bin')), slots=4)
+    monkeypatch.setenv('PATH', '{}{}{}'.format(bin_dir, os.pathsep,
+                                               os.environ['PATH']))
+    monkeypatch.chdir(tmpdir)
+    return fakeq.FakeScheduler(os.path.join(bin_dir, 'state'))
+
+
+def _wait_for_fakeq(scheduler, job_ids, timeout=60):
+    start = time.time()
+    while time.time() - start < timeout:
+        jobs = scheduler.jobs(job_ids)
+        if all(task['state'] == 'C' for _, tasks in jobs for task in tasks):
+            return jobs
+        time.sleep(0.1)
+    raise AssertionError('Jobs {} did not finish'.format(job_ids))
+
+
+def test_fakeq(fakeq, tmpdir):
+    commands = ['echo {0} > out{0}.txt'.format(i) for i in range(1, 6)]
+    commands.append('exit 3')
+    sub = qtools.Submitter(commands, 'job', array=True, max_running=2)
+    serial = qtools.Submitter(['sleep 60'], 'serial')
+
+    jobs = _wait_for_fakeq(fakeq, sub.job_ids)
+    assert [task['exit_code'] for task in jobs[0][1]] == [0, 0, 0, 0, 0, 3]
+    for i in range(1, 6):
+        assert tmpdir.join('out{}.txt'.format(i)).read() == '{}\n'.format(i)
+
+    # Like Torque, array jobs are only known as 1[]
+    assert subprocess.call(['qstat', '-x'] + sub.job_ids) != 0
+    xml = subprocess.check_output(
+        ['qstat', '-x'] + ['{}[]'.format(job_id) for job_id in sub.job_ids],
+        universal_newlines=True)
+    assert '<job_state>C</job_state><queue>batch</queue>' \
+           '<exit_status>3</exit_status>' in xml
+
+    subprocess.check_call(['qdel', serial.job_ids[0]])
+    jobs = _wait_for_fakeq(fakeq, serial.job_ids, timeout=10)
+    assert jobs[0][1][0]['exit_code'] == 271
+
+
+def test_fakeq_without_runners(tmpdir, monkeypatch):
+    from qtools import fakeq
+    bin_dir = fakeq.install(str(tmpdir.join('bin')), run_jobs=False)
+    monkeypatch.setenv('PATH', '{}{}{}'.format(bin_dir, os.pathsep,
+                                               os.environ['PATH']))
+    monkeypatch.chdir(tmpdir)
+    sub = qtools.Submitter(['true'], 'job')
+    time.sleep(0.5)
+
+    scheduler = fakeq.FakeScheduler(os.path.join(bin_dir, 'state'))
+    assert scheduler.jobs(sub.job_ids)[0][1][0]['state'] == 'Q'
+
+
+def test_monitor(fakeq):
+    from qtools.monitor import JobMonitor
+    monitor = JobMonitor(poll_interval=3600)
+    sub = qtools.Submitter(['true', 'exit 3'], 'job', array=True,
+                           monitor=monitor)
+    serial = qtools.Submitter(['sleep 60'], 'serial', monitor=monitor)
+    # Unknown to the scheduler, so long gone
+    monitor.track('99999')
+
+    # One query answers every question until the interval is up
+    monitor.states()
+    monitor.state(serial.job_ids[0])
+    monitor.exit_status(sub.job_ids[0])
+    assert monitor.n_polls == 1
+    assert monitor.state('99999') == 'completed'
+
+    _wait_for_fakeq(fakeq, sub.job_ids)
+    monitor.poll(force=True)
+    assert monitor.n_polls == 2
+    assert monitor.state(sub.job_ids[0]) == 'completed'
+    assert monitor.exit_status(sub.job_ids[0]) == 3
+    assert sorted(monitor.task_states(sub.job_ids[0])) == [1, 2]
+    assert monitor.unfinished() == serial.job_ids
+
+    subprocess.check_call(['qdel', serial.job_ids[0]])
+    _wait_for_fakeq(fakeq, serial.job_ids, timeout=10)
+    monitor.poll(force=True)
+    assert monitor.exit_status(serial.job_ids[0]) == 271
+    assert monitor.unfinished() == []
+    # Completed jobs are never asked about again
+    monitor.poll(force=True)
+    assert monitor.n_polls == 3
+
+
+def test_monitor_query_failure(tmpdir, monkeypatch):
+    from qtools.monitor import JobMonitor
+    bin_dir = tmpdir.mkdir('bin')
+    qstat = bin_dir.join('qstat')
+    qstat.write('#!/bin/bash\n'
+                'echo "Cannot connect to server tscc-mgr" >&2\n'
+                'exit 1\n')
+    qstat.chmod(qstat.stat().mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', '{}{}{}'.format(bin_dir, os.pathsep,
+                                               os.environ['PATH']))
+    monitor = JobMonitor('PBS', poll_interval=0)
+    monitor.track(['123', '456'])
+
+    # A failed query says nothing about the jobs it didn't report
+    assert not monitor.is_done('123')
+    assert monitor.state('456') == 'queued'
+
+    # Torque names the jobs which left the queue, and carries on
+    qstat.write('#!/bin/bash\n'
+                'echo "qstat: Unknown Job Id Error 123.tscc-mgr" >&2\n'
+                'echo "<Data></Data>"\n'
+                'exit 153\n')
+    assert monitor.is_done('123')
+    assert monitor.state('456') == 'queued'
+
+    qstat.write('#!/bin/bash\necho "<Data></Data>"\n')
+    assert monitor.is_done('456')
+
+
+@pytest.mark.parametrize('kwargs', [dict(array=True, max_running=2),
+                                    dict(array=True, manifest=True),
+                                    dict(array=False, chunksize=2),
+                                    dict(array=False, packed=True)])
+def test_wait_sentinels(tmpdir, kwargs):
+    tmpdir.chdir()
+    commands = ['sleep 0.2', 'true', 'exit 3']
+    sub = qtools.Submitter(commands, 'job', queue_type='local', ppn=2,
+                           sentinels=True, **kwargs)
+
+    exit_statuses = sub.wait(timeout=60)
+
+    if kwargs.get('chunksize'):
+        assert exit_statuses == [0, 3]
+    elif kwargs.get('packed'):
+        # Packed jobs fail as a whole when any of their commands fails
+        assert exit_statuses == [1]
+    else:
+        assert exit_statuses == [3]
+    assert sub.poll() == exit_statuses
+    for sh_filename in sub.sh_filenames:
+        sentinels = tmpdir.join(sh_filename + '.status').listdir('*.done')
+        assert len(sentinels) == sub.n_tasks[sh_filename]
+
+
+def test_wait_timeout(tmpdir):
+    from concurrent.futures import TimeoutError
+    tmpdir.chdir()
+    sub = qtools.Submitter(['sleep 5'], 'job', queue_type='local',
+                           sentinels=True)
+    start = time.time()
+    with pytest.raises(TimeoutError):
+        sub.wait(timeout=0.5)
+    assert time.time() - start < 2
+    assert sub.poll() is None
+
+
+def test_completed(tmpdir):
+    import asyncio
+    tmpdir.chdir()
+    subs = [qtools.Submitter(['sleep 0.2', 'exit {}'.format(i)],
+                             'job{}'.format(i), queue_type='local',
+                             array=True, sentinels=True) for i in range(3)]
+
+    loop = asyncio.new_event_loop()
+    try:
+        futures = [sub.completed(timeout=60, loop=loop) for sub in subs]
+        assert loop.run_until_complete(asyncio.gather(*futures)) == \
+            [[0], [1], [2]]
+    finally:
+        loop.close()
+
+
+def test_completed_without_sentinels(fakeq):
+    import asyncio
+    import threading
+    sub = qtools.Submitter(['true'], 'job')
+    threads = set()
+
+    def poll():
+        threads.add(threading.current_thread())
+        return sub.poll()
+
+    loop = asyncio.new_event_loop()
+    try:
+        # Scheduler queries run off the loop's thread
+        assert loop.run_until_complete(qtools.monitor.wait_for_async(
+            poll, timeout=60, loop=loop, blocking=True)) == [0]
+        assert threading.current_thread() not in threads
+        assert loop.run_until_complete(sub.completed(timeout=60,
+                                                     loop=loop)) == [0]
+    finally:
+        loop.close()
+
+
+@pytest.mark.parametrize('inotify', [True, False])
+def test_as_completed(tmpdir, monkeypatch, inotify):
+    if not inotify:
+        # Only list the folders, as on NFS
+        monkeypatch.setattr(qtools.watch, '_inotify_libc', None)
+    tmpdir.chdir()
+    commands = ['sleep 1.5; exit 2', 'true', 'sleep 0.7']
+    sub = qtools.Submitter(commands, 'job', queue_type='local', ppn=3,
+                           array=True, sentinels=True)
+
+    start = time.time()
+    finished = []
+    for task in sub.as_completed(timeout=30):
+        finished.append((task.task, task.exit_status))
+        if task.task == 3:
+            # Early tasks are reported while the array is still running
+            assert time.time() - start < 1.4
+    assert finished == [(2, 0), (3, 0), (1, 2)]
+
+    with pytest.raises(qtools.monitor.TimeoutError):
+        list(qtools.Submitter(['sleep 2'], 'slow', queue_type='local',
+                              sentinels=True).as_completed(timeout=0.3))
+
+
+def test_wait_all(fakeq, monkeypatch):
+    from qtools import monitor
+    monkeypatch.setattr(monitor, 'SHARED_POLL_INTERVAL', 0.1)
+    monkeypatch.setattr(monitor, '_shared_monitors', {})
+    sub = qtools.Submitter(['true', 'exit 3'], 'job', array=True)
+    serial = qtools.Submitter(['exit 4'], 'serial', sentinels=True)
+
+    # Array jobs are named with whether they're arrays, as PBS needs
+    assert monitor.wait_all(sub.dependencies + [serial], timeout=60,
+                            queue_type='PBS') == [3, [4]]
+    assert sub.wait(timeout=10) == [3]
+
+
+@pytest.mark.parametrize('queue_type, directive', [
+    ('PBS', '#PBS -W depend=afterok:1,afterokarray:2[]'),
+    ('SGE', '#$ -hold_jid 1,2'),
+    ('SLURM', '#SBATCH --dependency=afterok:1:2')])
+def test_wait_for(tmpdir, queue_type, directive):
+    tmpdir.chdir()
+    qtools.Submitter(['echo 1'], 'job', queue_type=queue_type,
+                     wait_for=['1', ('2', True)], submit=False)
+
+    assert directive in tmpdir.join('job.sh').read().splitlines()
+
+
+def test_add_wait(tmpdir):
+    tmpdir.chdir()
+    sub = qtools.Submitter(['echo 1'], 'job', submit=False)
+    assert '-W depend' not in tmpdir.join('job.sh').read()
+
+    sub.add_wait(12)
+    sub.job()
+    assert '#PBS -W depend=afterok:12' in \
+        tmpdir.join('job.sh').read().splitlines()
+
+    # Chunked scripts are rewritten as chunks
+    sub = qtools.Submitter(['echo 1', 'echo 2', 'echo 3'], 'ch',
+                           chunksize=2, submit=False)
+    sub.add_wait(12)
+    sub.job()
+    assert sub.sh_filenames == ['ch-0.sh', 'ch-1.sh']
+    assert not tmpdir.join('ch.sh').exists()
+    assert '#PBS -W depend=afterok:12' in \
+        tmpdir.join('ch-1.sh').read().splitlines()
+
+    # Generators are used up by the first writing
+    sub = qtools.Submitter(('echo {}'.format(i) for i in range(2)), 'gen',
+                           submit=False)
+    sub.add_wait(12)
+    with pytest.raises(ValueError):
+        sub.job()
+
+
+@pytest.mark.parametrize('queue_type', ['PBS', 'local'])
+def test_pipeline(fakeq, monkeypatch, queue_type):
+    from qtools import monitor
+    from qtools.pipeline import Pipeline
+    monkeypatch.setattr(monitor, 'SHARED_POLL_INTERVAL', 0.1)
+    monkeypatch.setattr(monitor, '_shared_monitors', {})
+
+    pipeline = Pipeline(queue_type=queue_type)
+    pipeline.add('first', ['sleep 0.5; echo first > log.txt'])
+    pipeline.add('second', ['echo second >> log.txt', 'true'],
+                 after=['first'], array=True)
+    pipeline.add('failing', ['exit 3'], after=['first'])
+    pipeline.add('last', ['echo last >> log.txt'],
+                 after=['second', 'failing'])
+    assert pipeline.order() == ['first', 'second', 'failing', 'last']
+
+    submitters = pipeline.submit()
+
+    assert list(submitters) == ['first', 'second', 'failing', 'last']
+    # Jobs whose dependencies failed never run
+    assert pipeline.wait(timeout=60) == dict(first=[0], second=[0],
+                                             failing=[3], last=[None])
+    assert open('log.txt').read() == 'first\nsecond\n'
+
+
+@pytest.mark.parametrize('queue_type, directive', [
+    ('SGE', '#$ -hold_jid_ad 7'),
+    ('SLURM', '#SBATCH --dependency=aftercorr:7')])
+def test_wait_for_each(tmpdir, queue_type, directive):
+    tmpdir.chdir()
+    qtools.Submitter(['echo 1', 'echo 2'], 'job', queue_type=queue_type,
+                     array=True, wait_for_each=['7'], submit=False)
+
+    assert directive in tmpdir.join('job.sh').read().splitlines()
+
+    # PBS can only wait for the sentinels of the tasks
+    with pytest.raises(ValueError):
+        qtools.Submitter(['echo 1', 'echo 2'], 'job', array=True,
+                         wait_for_each=['7'], submit=False)
+
+
+@pytest.mark.parametrize('queue_type, directives', [
+    ('SGE', ['#$ -hold_jid 11', '#$ -hold_jid_ad 12']),
+    ('SLURM', ['#SBATCH --dependency=afterok:11,aftercorr:12'])])
+def test_wait_for_and_each(tmpdir, queue_type, directives):
+    tmpdir.chdir()
+    qtools.Submitter(['echo 1', 'echo 2'], 'job', queue_type=queue_type,
+                     array=True, wait_for=['11'], wait_for_each=['12'],
+                     submit=False)
+
+    lines = tmpdir.join('job.sh').read().splitlines()
+    # sbatch only keeps the last --dependency
+    assert [line for line in lines if 'hold_jid' in line or
+            'dependency' in line] == directives
+
+
+def test_wait_for_each_sentinels(tmpdir):
+    tmpdir.chdir()
+    first = qtools.Submitter(['sleep 3', 'exit 3', 'true'], 'first',
+                             queue_type='local', array=True, ppn=3,
+                             sentinels=True)
+    second = qtools.Submitter(['echo {0} > out{0}.txt'.format(i)
+                               for i in range(1, 4)], 'second',
+                              queue_type='local', array=True, ppn=3,
+                              sentinels=True, wait_for_each=[first])
+
+    # The third task doesn't wait for the first task of the first job
+    start = time.time()
+    while not tmpdir.join('out3.txt').exists():
+        assert time.time() - start < 10
+        time.sleep(0.1)
+    assert first.poll() is None
+
+    assert second.wait(timeout=60) == [1]
+    assert first.poll() == [3]
+    assert tmpdir.join('out1.txt').exists()
+    assert not tmpdir.join('out2.txt').exists()
+
+
+def test_resubmit_failed(fakeq, tmpdir):
+    # Tasks 2, 3 and 5 fail until the file "fixed" exists
+    commands = ['true', '[ -e fixed ]', '[ -e fixed ]', 'true',
+                '[ -e fixed ] || exit 4']
+    sub = qtools.Submitter(commands, 'job', array=True, max_running=2,
+                           sentinels=True)
+    assert sub.wait(timeout=60) == [1]
+
+    tmpdir.join('fixed').write('')
+    resubmissions = sub.resubmit_failed()
+
+    assert [r.tasks for r in resubmissions] == [[2, 3, 5]]
+    assert '#PBS -t 2-3,5%2' in tmpdir.join('job.retry.sh').read()
+    assert sub.wait(timeout=60) == [0]
+    jobs = fakeq.jobs([resubmissions[0].job_id])
+    assert [task['task_id'] for task in jobs[0][1]] == [2, 3, 5]
+    assert qtools.submitter.resubmit_failed('job.sh') is None
+
+
+def test_resubmit_failed_sge(tmpdir):
+    tmpdir.chdir()
+    commands = ['echo {0} > out{0}.txt'.format(i) for i in range(1, 6)]
+    qtools.Submitter(commands, 'job', queue_type='SGE', array=True,
+                     max_running=2, sentinels=True, submit=False)
+    for task, exit_code in [(1, 0), (2, 1), (3, 0), (5, 1)]:
+        tmpdir.join('job.sh.status', '{}.done'.format(task)).write(
+            '{}\n'.format(exit_code))
+
+    resubmission = qtools.submitter.resubmit_failed(
+        'job.sh', include_missing=True, submit=False)
+
+    # SGE arrays are ranges, so the rerun maps its tasks back
+    assert resubmission.tasks == [2, 4, 5]
+    lines = tmpdir.join('job.retry.sh').read().splitlines()
+    assert '#$ -t 1-3' in lines and '#$ -tc 2' in lines
+    assert 'qtools_tasks=(0 2 4 5)' in lines
+    subprocess.check_call(['bash', 'job.retry.sh'],
+                          env=dict(os.environ, SGE_TASK_ID='2'))
+    assert tmpdir.join('out4.txt').read() == '4\n'
+    assert tmpdir.join('job.sh.status', '4.done').read() == '0\n'
+    assert not tmpdir.join('job.sh.status', '2.done').exists()
+
+
+@pytest.mark.parametrize('queue_type, dependency, out', [
+    ('PBS', '#PBS -W depend', '#PBS -o job.sh.retry.out'),
+    ('SGE', '#$ -hold_jid', '#$ -o job.sh.retry.out'),
+    ('SLURM', '#SBATCH --dependency', '#SBATCH --output=job.sh.retry.out')])
+def test_resubmit_failed_directives(tmpdir, queue_type, dependency, out):
+    tmpdir.chdir()
+    qtools.Submitter(['true', 'false'], 'job', queue_type=queue_type,
+                     array=True, sentinels=True, wait_for=['55'],
+                     submit=False)
+    tmpdir.join('job.sh.status', '2.done').write('1\n')
+
+    qtools.submitter.resubmit_failed('job.sh', submit=False)
+
+    # The rerun doesn't wait for long gone jobs, nor overwrite the logs
+    lines = tmpdir.join('job.retry.sh').read().splitlines()
+    assert not any(line.startswith(dependency) for line in lines)
+    assert out in lines
+
+
+@pytest.mark.parametrize('sentinels', [True, False])
+def test_max_queued(fakeq, sentinels):
+    commands = ['sleep 0.5'] * 5
+    with pytest.raises(ValueError):
+        qtools.Submitter(commands, 'job', array=True, max_queued=4)
+    # Nor may the workers of a pilot job
+    with pytest.raises(ValueError):
+        qtools.Submitter(commands, 'job', pilot=5, max_queued=4)
+
+    # Chunks of 2, 2 and 1 commands, but only 3 of them may be queued
+    sub = qtools.Submitter(commands, 'job', array=True, chunksize=2,
+                           max_queued=3, sentinels=sentinels)
+    assert len(sub.job_ids) == 1 and not sub.dispatched
+    with pytest.raises(ValueError):
+        sub.dependencies
+    assert sub.poll() is None
+
+    assert sub.wait(timeout=60) == [0, 0, 0]
+    assert len(sub.job_ids) == 3
+    jobs = fakeq.jobs(sub.job_ids)
+    # The last two were only submitted once the first finished
+    assert min(job['submitted'] for job, _ in jobs[1:]) >= \
+        jobs[0][1][0]['start']
+
+
+def test_speculator(fakeq, tmpdir):
+    from qtools.speculation import Speculator, stragglers, TaskTimes
+    times = {1: TaskTimes(0, 1), 2: TaskTimes(0, 2), 3: TaskTimes(0, 3),
+             4: TaskTimes(0, None), 5: TaskTimes(9, None)}
+    assert stragglers(times, 5, now=10, factor=3, fraction=0.6) == [4]
+    assert stragglers(times, 5, now=10, factor=3, fraction=0.8) == []
+    assert stragglers(times, 5, now=10, min_seconds=20) == []
+
+    # Task 4 hangs the first time it runs, but not the second
+    commands = ['true'] * 3 + [
+        'if [ -e flag ]; then true; else touch flag; sleep 30; fi']
+    sub = qtools.Submitter(commands, 'job', array=True, sentinels=True)
+    speculator = Speculator(sub, factor=3, fraction=0.75, min_seconds=0.5)
+    assert speculator.wait(timeout=30) == [0]
+
+    resubmission, = speculator.resubmissions['job.sh']
+    assert resubmission.tasks == [4]
+    assert '#PBS -t 4' in tmpdir.join('job.speculative1.sh').read()
+    assert tmpdir.join('job.sh.status', '4.done').read() == '0\n'
+    # The copy won, so the original was deleted
+    jobs = _wait_for_fakeq(fakeq, sub.job_ids, timeout=10)
+    assert jobs[0][1][3]['exit_code'] == 271
+
+    with pytest.raises(ValueError):
+        Speculator(qtools.Submitter(['true'], 'plain', submit=False))
+
+
+def test_pipeline_cycle():
+    from qtools.pipeline import Pipeline
+    pipeline = Pipeline()
+    pipeline.add('a', ['true'], after=['b'])
+    pipeline.add('b', ['true'], after=['a'])
+    with pytest.raises(ValueError):
+        pipeline.submit()
+
+    pipeline = Pipeline()
+    pipeline.add('a', ['true'], after=['c'])
+    with pytest.raises(ValueError):
+        pipeline.order()
+
+
+def test_packed(tmpdir):
+    tmpdir.chdir()
+    # Would take 2 seconds one after the other
+    commands = ['sleep 0.5; echo {0} > out{0}.txt'.format(i)
+                for i in range(1, 4)]
+    commands.append("sleep 0.5; echo 'quoted # text' && exit 3")
+    qtools.Submitter(commands, 'job', ppn=4, packed=True, submit=False)
+
+    start = time.time()
+    exit_code = subprocess.call(['bash', 'job.sh'],
+                                env=dict(os.environ,
+                                         PBS_O_WORKDIR=str(tmpdir)))
+    assert time.time() - start < 1.5
+
+    assert exit_code == 1
+    exit_codes = tmpdir.join('job.sh.exitcodes').read().splitlines()
+    assert sorted(exit_codes) == ['1 0', '2 0', '3 0', '4 3']
+    for i in range(1, 4):
+        assert tmpdir.join('out{}.txt'.format(i)).read() == '{}\n'.format(i)
+
+
+def test_pilot(tmpdir, qtools_path):
+    tmpdir.chdir()
+    commands = ['echo {0} > out{0}.txt'.format(i) for i in range(1, 21)]
+    commands.append('exit 3')
+    sub = qtools.Submitter(commands, 'job', queue_type='local', pilot=2,
+                           ppn=2)
+
+    assert sub.backend.exit_codes(sub.job_ids[0], timeout=60) in \
+        ([0, 1], [1, 0], [1, 1])
+    counts = qtools.pilot.WorkQueue(sub.queue_filename).counts()
+    assert counts == dict(pending=0, running=0, done=21, failed=1)
+    for i in range(1, 21):
+        assert tmpdir.join('out{}.txt'.format(i)).read() == '{}\n'.format(i)
+
+
+@pytest.mark.parametrize('method, n_bins', [('lpt', 4), ('ffd', 3)])
+def test_pack(method, n_bins):
+    costs = [10, 60, 20, 30, 50, 40, 30, 60]
+    bins = qtools.planner.pack(costs, target=100, method=method)
+
+    assert sorted(i for indices in bins for i in indices) == list(range(8))
+    assert all(sum(costs[i] for i in indices) <= 100 for indices in bins)
+    assert len(bins) == n_bins
+
+
+def test_pack_oversized():
+    bins = qtools.planner.pack([500, 10, 10], target=100)
+    assert bins == [[0], [1, 2]]
+
+
+def test_walltime():
+    assert qtools.planner.parse_walltime('1:30:24') == 5424
+    assert qtools.planner.parse_walltime('2:00:00:00') == 172800
+    assert qtools.planner.format_walltime(5423.2) == '1:30:24'
+
+
+def test_costs(tmpdir):
+    tmpdir.chdir()
+    commands = ['echo {}'.format(i) for i in range(6)]
+    sub = qtools.Submitter(commands, 'job', walltime='0:01:00',
+                           costs=[50, 10, 10, 40, 20, 30], submit=False)
+
+    assert sub.sh_filenames == ['job-0.sh', 'job-1.sh', 'job-2.sh']
+    assert sub.n_commands == 6
+
+
+def test_outputs(tmpdir, monkeypatch):
+    tmpdir.chdir()
+    tmpdir.mkdir('out')
+    inputs = ['in{}.txt'.format(i) for i in range(6)]
+    outputs = ['out/{}.txt'.format(i) for i in range(6)]
+    commands = ['cp {} {}'.format(*paths) for paths in zip(inputs, outputs)]
+    for i, (input, output) in enumerate(zip(inputs, outputs)):
+        tmpdir.join(input).write(str(i))
+        if i < 5:
+            tmpdir.join(output).write(str(i))
+            os.utime(output, (1000, 1000) if i == 4 else None)
+    os.utime(inputs[4], (2000, 2000))
+
+    scanned = []
+    scandir = qtools.freshness.scandir
+    monkeypatch.setattr(qtools.freshness, 'scandir',
+                        lambda folder: scanned.append(folder) or
+                        scandir(folder))
+    sub = qtools.Submitter(commands, 'job', array=True, inputs=inputs,
+                           outputs=iter(outputs), submit=False)
+
+    # Only the command with an old output and the one without are left
+    assert sub.n_skipped == 4
+    assert sub.n_commands == 2
+    lines = tmpdir.join('job.sh').read().splitlines()
+    assert 'cmd[1]="{}"'.format(commands[4]) in lines
+    assert 'cmd[2]="{}"'.format(commands[5]) in lines
+    # One listing per folder instead of a stat per file
+    assert len(scanned) == 2
+
+    sub = qtools.Submitter(commands, 'costs', inputs=inputs, outputs=outputs,
+                           costs=[1, 2, 3, 4, 50, 60], walltime='0:01:00',
+                           submit=False)
+    assert sub.costs == [50, 60]
+
+    sub = qtools.Submitter(commands[:4], 'done', outputs=outputs[:4])
+    assert sub.n_skipped == 4 and sub.sh_filenames == []
+    assert not tmpdir.join('done.sh').exists()
+
+    with pytest.raises(ValueError):
+        qtools.Submitter(commands, 'mismatched', outputs=outputs[:3],
+                         submit=False)
+
+
+@pytest.mark.parametrize('kwargs', [dict(array=True),
+                                    dict(array=True, manifest=True),
+                                    dict(packed=True)])
+def test_commands_from_sh(tmpdir, kwargs):
+    from qtools.parser import commands_from_sh
+    tmpdir.chdir()
+    commands = ['echo "{0} a=b" > out{0}.txt'.format(i)
+                for i in range(1, 1202)]
+    sub = qtools.Submitter(commands, 'job', submit=False, **kwargs)
+
+    parsed = [commands_from_sh(sh_filename)
+              for sh_filename in sub.sh_filenames]
+    assert [command for index in parsed for command in index] == commands
+    assert parsed[-1][len(parsed[-1])] == commands[-1]
+    assert parsed[0][1] == commands[0]
+    with pytest.raises(KeyError):
+        parsed[0][0]
+
+
+def test_commands_from_sh_sparse(tmpdir):
+    from qtools.parser import commands_from_sh
+    sh = tmpdir.join('job.sh')
+    sh.write('#!/bin/bash\n'
+             '#PBS -t 3,7\n'
+             'cmd[7]="echo \\"seven\\""\n'
+             'cmd[3]="x=1 y=2 echo three"\n'
+             'eval ${cmd[$PBS_ARRAYID]}\n')
+    commands = commands_from_sh(str(sh))
+
+    assert len(commands) == 2
+    assert commands.task_ids() == [3, 7]
+    assert commands[3] == 'x=1 y=2 echo three'
+    assert commands[7] == 'echo \\"seven\\"'
+    assert 5 not in commands
+
+
+def test_commands_from_sh_foreign(tmpdir):
+    from qtools.parser import commands_from_sh
+    sh = tmpdir.join('job.sh')
+    sh.write_binary(b'#!/bin/bash\n'
+                    b'# Caf\xe9 in Latin-1\n'
+                    b'task=foo\n'
+                    b'cmd[1]="echo one"\n')
+    commands = commands_from_sh(str(sh))
+
+    assert commands[1] == 'echo one'
+    assert commands.directives[1] == u'# Caf\ufffd in Latin-1'
+
+
+def test_script_index(tmpdir):
+    from qtools.parser import ScriptIndex
+    tmpdir.mkdir('jobs').chdir()
+    commands = ['echo {} a=b'.format(i) for i in range(1, 1202)]
+    qtools.Submitter(commands, 'job', array=True, submit=False)
+    qtools.Submitter(commands[:3], 'other', queue_type='SLURM', array=True,
+                     walltime='1:00:00', submit=False)
+    index = ScriptIndex(str(tmpdir.join('scripts.db')))
+
+    assert index.refresh('.', processes=2) == (4, 0)
+    assert len(index) == 1204
+    found = index.lookup('echo 507 a=b')
+    assert [(os.path.basename(sh), task, name) for sh, task, name, _ in
+            found] == [('job2.sh', 7, 'job2')]
+    assert '-l walltime=0:30:00' in found[0].resources
+    found = index.lookup('echo 2 a=b')
+    assert [(os.path.basename(sh), task, name) for sh, task, name, _ in
+            found] == [('job1.sh', 2, 'job1'), ('other.sh', 2, 'other')]
+    assert '--time=1:00:00' in found[1].resources
+
+    # Only the scripts that changed are parsed again
+    assert index.refresh('.', processes=1) == (0, 0)
+    tmpdir.join('jobs', 'job3.sh').remove()
+    qtools.Submitter(['echo again'], 'other', queue_type='SLURM',
+                     array=True, submit=False)
+    os.utime('other.sh', (0, 0))
+    assert index.refresh('.') == (1, 1)
+    assert index.lookup('echo 1201 a=b') == []
+    assert index.lookup('echo 2 a=b')[-1].sh_filename.endswith('job1.sh')
+    assert index.lookup('echo again')[0].task == 1
+
+    # A script that can't be parsed, here as its manifest is gone, is left
+    # out, and the rest of the folder is still indexed
+    tmpdir.join('jobs', 'broken.sh').write(
+        '#!/bin/bash\n#PBS -t 1-2\nmanifest=gone.txt\nindex=gone.idx\n'
+        'task=$((PBS_ARRAYID + 0))\n')
+    qtools.Submitter(['echo fourth'], 'job', array=True, submit=False)
+    assert index.refresh('.', processes=2) == (1, 0)
+    assert index.lookup('echo fourth')[0].task == 1
+
+
+def test_cluster_executor(tmpdir, qtools_path):
+    import operator
+    tmpdir.chdir()
+    with qtools.ClusterExecutor(calls_per_task=3, queue_type='local',
+                                ppn=4) as executor:
+        futures = [executor.submit(pow, 2, i) for i in range(7)]
+        failing = executor.submit(int, 'x')
+        executor.flush()
+        products = executor.map(operator.mul, range(10), range(10),
+                                chunksize=4)
+        died = executor.submit(os._exit, 3)
+
+        assert list(products) == [i * i for i in range(10)]
+    assert [future.result() for future in futures] == \
+        [2 ** i for i in range(7)]
+    with pytest.raises(ValueError):
+        failing.result()
+    with pytest.raises(RuntimeError):
+        died.result()
+    # Many calls per array task, and one array job per batch
+    assert [sub.n_commands for sub in executor.submitters] == [3, 3, 1]
+
+
+class _TwoArgsError(Exception):
+    """Pickles, but can't be rebuilt from its args"""
+
+    def __init__(self, a, b):
+        super(_TwoArgsError, self).__init__(a)
+
+
+def _raise_two_args():
+    raise _TwoArgsError(1, 2)
+
+
+def test_cluster_executor_unpicklable(tmpdir, qtools_path):
+    tmpdir.chdir()
+    with qtools.ClusterExecutor(queue_type='local') as executor:
+        future = executor.submit(_raise_two_args)
+    with pytest.raises(TypeError):
+        future.result(timeout=0)
+
+
+@pytest.mark.skipif(not qtools.executor.PICKLE_BUFFERS,
+                    reason='needs pickle protocol 5')
+def test_cluster_executor_buffers(tmpdir, qtools_path):
+    import mmap
+    import pickle
+    tmpdir.chdir()
+    data = bytearray(b'0123456789' * 200000)
+    with qtools.ClusterExecutor(folder='calls',
+                                queue_type='local') as executor:
+        small = executor.submit(pickle.PickleBuffer, bytearray(b'small'))
+        large = executor.submit(pickle.PickleBuffer, data)
+
+    # Large buffers come back memory-mapped from files of their own
+    assert isinstance(large.result(), mmap.mmap)
+    assert large.result()[:] == data
+    assert bytes(small.result()) == b'small'
+    assert tmpdir.join('calls', 'batch0', '1.results.0.buf').size() == \
+        len(data)
+
+
+def test_command_template():
+    assert qtools.history.command_template(
+        'samtools view -q 10 /data/s1.bam > s1.sam') == \
+        'samtools view -q # <.bam> > <.sam>'
+
+
+def test_history(tmpdir, qtools_path):
+    tmpdir.chdir()
+    history = qtools.history.RuntimeHistory(str(tmpdir.join('history.db')))
+    commands = ['sleep 0.{0} && echo {0} > out{0}.txt'.format(i)
+                for i in range(1, 4)]
+    sub = qtools.Submitter(commands, 'job', queue_type='local', array=True,
+                           history=history)
+    assert sub.backend.exit_codes(sub.job_ids[0], timeout=60) == [0, 0, 0]
+    assert tmpdir.join('out3.txt').read() == '3\n'
+
+    assert 0.3 <= history.estimate('sleep 0.5 && echo 5 > out5.txt') < 1
+    history.record('true', 2, 0, job_id='12[1].tscc-mgr', start=10)
+    history.record('false', 3, 1, job_id='12[2].tscc-mgr', start=11)
+    assert history.job_summary('12') == dict(commands=2, failed=1,
+                                             runtime=4, max_rss_kb=None)
+
+    # Short commands are packed into chunks within the walltime
+    sub = qtools.Submitter(commands * 10, 'auto', chunksize='auto',
+                           walltime='auto', history=history, submit=False)
+    assert not sub.array
+    assert sub.sh_filenames == ['auto-0.sh']
+    assert '#PBS -l walltime=0:01:00' in tmpdir.join('auto-0.sh').read()
+
+    # Unknown commands are run as an array
+    sub = qtools.Submitter(['sleep 1000'], 'long', chunksize='auto',
+                           walltime='auto', history=history, submit=False)
+    assert sub.array
+    assert sub.walltime == qtools.history.DEFAULT_WALLTIME
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Notice new files in folders as soon as they appear
+
+Finished tasks leave files behind: sentinel files with their exit codes,
+and the results of ``qtools.ClusterExecutor`` calls. A ``DirectoryWatcher``
+lists the folders they appear in with ``os.scandir`` and reports the new
+files. Between listings, it sleeps on inotify on Linux, so files written
+by this machine wake it right away. inotify never hears about files
+written by other NFS clients, so the listings back off up to a few seconds
+apart rather than stopping, and on network filesystems the watcher only
+lists the folders.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import time
+
+from .freshness import DirectoryListings
+from .monitor import _intervals
+
+__author__ = 'Olga Botvinnik'
+
+# Most seconds between listings of the folders
+MAX_LIST_INTERVAL = 5
+
+# Filesystems whose changes on other hosts inotify never sees
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'lustre', 'gpfs', 'cifs', 'smbfs',
+                       'beegfs', 'fuse.sshfs')
+
+# inotify events of a file appearing whole in a folder
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+
+def _libc():
+    """The C library, if it has inotify"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError, TypeError):
+        return None
+    return libc
+
+
+_inotify_libc = _libc()
+
+
+def filesystem_type(path):
+    """Type of the filesystem a path is on, e.g. 'nfs4', or None if
+    unknown"""
+    path = os.path.realpath(path)
+    best, best_type = '', None
+    try:
+        with open('/proc/self/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(
+                        mount_point.rstrip('/') + '/')) and \
+                        len(mount_point) >= len(best):
+                    best, best_type = mount_point, fields[2]
+    except (IOError, OSError):
+        return None
+    return best_type
+
+
+class DirectoryWatcher(object):
+    """Report the files which appear in folders
+
+    Parameters
+    ----------
+    folders : list of str, optional
+        Folders to watch from the start. Files already in them count as new
+        at the first ``poll``.
+    inotify : bool, optional
+        Whether to sleep on inotify between listings where it's available.
+        By default, only for folders on local filesystems.
+
+    Example
+    -------
+    >>> watcher = DirectoryWatcher(['job.sh.status'])
+    >>> watcher.wait(timeout=60)
+    {'/home/me/job.sh.status': ['3.done', '1.done']}
+    """
+
+    def __init__(self, folders=(), inotify=None):
+        self.inotify = inotify
+        # Names of the files seen so far in each folder
+        self._seen = {}
+        self._fd = None
+        self._watches = {}
+        for folder in folders:
+            self.add(folder)
+
+    def add(self, folder):
+        """Start watching a folder"""
+        folder = os.path.abspath(folder)
+        if folder in self._seen:
+            return
+        self._seen[folder] = set()
+        inotify = self.inotify
+        if inotify is None:
+            inotify = filesystem_type(folder) not in NETWORK_FILESYSTEMS
+        if inotify and _inotify_libc is not None:
+            self._add_watch(folder)
+
+    def remove(self, folder):
+        """Stop watching a folder"""
+        folder = os.path.abspath(folder)
+        self._seen.pop(folder, None)
+        watch = self._watches.pop(folder, None)
+        if watch is not None:
+            _inotify_libc.inotify_rm_watch(self._fd, watch)
+
+    @property
+    def folders(self):
+        return list(self._seen)
+
+    def _add_watch(self, folder):
+        if self._fd is None:
+            fd = _inotify_libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                # e.g. out of inotify instances, so only list the folders
+                return
+            self._fd = fd
+        watch = _inotify_libc.inotify_add_watch(
+            self._fd, folder.encode('utf-8'), WATCH_EVENTS)
+        if watch >= 0:
+            self._watches[folder] = watch
+
+    def poll(self):
+        """List the folders for files which appeared since the last poll
+
+        Returns
+        -------
+        new : dict
+            Names of the new files of each folder with any, by folder
+        """
+        listings = DirectoryListings()
+        new = {}
+        for folder, seen in self._seen.items():
+            names = set(listings.listing(folder)) - seen
+            if names:
+                seen.update(names)
+                new[folder] = sorted(names)
+        return new
+
+    def wait(self, timeout=None):
+        """Block until files appear in the folders
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Give up after this many seconds. By default, wait forever.
+
+        Returns
+        -------
+        new : dict
+            Names of the new files of each folder with any, by folder, or
+            an empty dict if the timeout was up first
+        """
+        start = time.time()
+        for interval in _intervals(MAX_LIST_INTERVAL):
+            new = self.poll()
+            if new:
+                return new
+            if timeout is not None:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    return {}
+                interval = min(interval, remaining)
+            self._sleep(interval)
+
+    def _sleep(self, seconds):
+        """Sleep, waking up early if inotify hears about a new file"""
+        if not self._watches:
+            time.sleep(seconds)
+            return
+        try:
+            ready, _, _ = select.select([self._fd], [], [], seconds)
+        except (OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            # The events only wake us up; the listing finds the files
+            try:
+                while os.read(self._fd, 65536):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def close(self):
+        """Stop watching all the folders"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._watches = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass